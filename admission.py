@@ -0,0 +1,216 @@
+# Admission control
+# =========================================================
+# Under a spike, every request would otherwise get a worker thread in the order it arrived, so a
+# burst of uploads or logins (slow, and mostly waiting for SQLite's single writer or the hashing
+# pool) holds every thread while the cheap pages queue behind them and everyone's latency collapses.
+# This WSGI middleware sorts each request into a class (cheap reads, writes, uploads, auth) and
+# lets only so many of each class run at once in a worker process. A few more may wait, first come,
+# first served, for a short deadline. Anything beyond that is turned away straight away with a 503
+# and Retry-After, which is much cheaper for everyone than a page that arrives after 30 seconds.
+#
+# Requests are sorted by path prefix (worked out once from the URL map), not by matching the URL,
+# which Flask does again anyway. A request only holds its turn until its body starts: a streamed
+# list (?all=1 pages, API lists) would otherwise hold a read turn for as long as a slow client
+# takes to download it.
+#
+# Limits are per process: with a pre-fork server each worker has its own (see gunicorn.conf.py).
+# ADMISSION_CONTROL=False switches it off, ADMISSION_LIMITS changes the limits of some classes,
+# eg: {'upload': (1, 2, 5.0)}. In-flight and queued requests, turned-away counts and wait time
+# percentiles are shown by /_debug/stats.
+import json
+import threading
+import time
+from collections import deque
+from flask import request
+from werkzeug.wrappers import Response
+from db.db import DatabaseBusy
+
+# For each class of route: (requests handled at once per process, requests that may wait for
+# a turn, seconds one may wait before being turned away)
+ROUTE_CLASS_LIMITS = {
+    'read': (16, 32, 1.0),
+    'write': (4, 8, 3.0),
+    'upload': (2, 4, 5.0),
+    'auth': (2, 8, 2.0),
+}
+
+# Endpoints that are never limited: static files (cheap, and pages need them) and the stats
+# (so a worker that is turning requests away can still be looked at)
+UNLIMITED_ENDPOINTS = {'static', 'static_dist', 'static_uploads', 'debugStats'}
+
+# Endpoints whose form posts check or hash a password
+AUTH_ENDPOINTS = {'login', 'register'}
+
+# Seconds a turned-away client is asked to wait before trying again
+RETRY_AFTER_SECONDS = 1
+
+# Number of recent waits kept for the latency percentiles
+ADMISSION_WAIT_SAMPLES = 1000
+
+
+# Limits
+# =========================================================
+# How many requests of one class may run at once, with a bounded first come, first served queue
+class RouteClassLimit:
+
+    def __init__(self, concurrency, max_queued, deadline):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.waiters = deque()
+        self.in_flight = 0
+        self.stats = {'admitted': 0, 'queue_full': 0, 'timed_out': 0, 'max_queued': 0}
+        self.waits = deque(maxlen=ADMISSION_WAIT_SAMPLES)
+
+    # Wait for a turn, returns False if the request should be turned away
+    def enter(self):
+        started = time.perf_counter()
+        with self.lock:
+            if self.in_flight < self.concurrency:
+                self.in_flight += 1
+                self.stats['admitted'] += 1
+                self.waits.append(0.0)
+                return True
+            if len(self.waiters) >= self.max_queued:
+                self.stats['queue_full'] += 1
+                return False
+            waiter = threading.Event()
+            self.waiters.append(waiter)
+            self.stats['max_queued'] = max(self.stats['max_queued'], len(self.waiters))
+        if not waiter.wait(self.deadline):
+            with self.lock:
+                # The turn may have been handed over just as the deadline passed
+                if not waiter.is_set():
+                    self.waiters.remove(waiter)
+                    self.stats['timed_out'] += 1
+                    return False
+        with self.lock:
+            self.stats['admitted'] += 1
+            self.waits.append(time.perf_counter() - started)
+        return True
+
+    # Give the turn to the next request waiting (or free it)
+    def leave(self):
+        with self.lock:
+            if self.waiters:
+                self.waiters.popleft().set()
+            else:
+                self.in_flight -= 1
+
+    # Counters, requests running and waiting now, and wait percentiles (in milliseconds)
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats, in_flight=self.in_flight, queued=len(self.waiters),
+                         concurrency=self.concurrency, max_queue=self.max_queued)
+            waits = sorted(self.waits)
+        for name, percentile in (('wait_p50_ms', 0.50), ('wait_p95_ms', 0.95), ('wait_p99_ms', 0.99)):
+            stats[name] = round(waits[int(percentile * (len(waits) - 1))] * 1000, 2) if waits else None
+        return stats
+
+
+# Middleware
+# =========================================================
+class AdmissionControl:
+
+    def __init__(self):
+        self.app = None
+        self.limits = {}
+        self.prefixes = None
+
+    # Wrap a Flask app's WSGI app (unless ADMISSION_CONTROL is False) and turn DatabaseBusy into a 503
+    def init_app(self, app):
+        app.extensions['admission'] = self
+        app.register_error_handler(DatabaseBusy, lambda error: busy_response(request.path))
+        if not app.config.get('ADMISSION_CONTROL', True):
+            return
+        limits = dict(ROUTE_CLASS_LIMITS, **app.config.get('ADMISSION_LIMITS', {}))
+        self.limits = {name: RouteClassLimit(*limit) for name, limit in limits.items()}
+        self.app = app
+        app.wsgi_app = self.middleware(app.wsgi_app)
+
+    # The paths of the unlimited and auth endpoints: [(path up to its first variable, whether that is
+    # the whole path, endpoint)], longest first (routes are added after init_app(), so on first use)
+    def get_prefixes(self):
+        if self.prefixes is None:
+            prefixes = [(rule.rule.split('<', 1)[0], '<' not in rule.rule, rule.endpoint)
+                        for rule in self.app.url_map.iter_rules()
+                        if rule.endpoint in UNLIMITED_ENDPOINTS or rule.endpoint in AUTH_ENDPOINTS]
+            self.prefixes = sorted(prefixes, key=lambda prefix: len(prefix[0]), reverse=True)
+        return self.prefixes
+
+    # The unlimited or auth endpoint a path belongs to (None for any other path)
+    def match_prefix(self, path):
+        for prefix, exact, endpoint in self.get_prefixes():
+            if path == prefix if exact else path.startswith(prefix):
+                return endpoint
+        return None
+
+    # Class of a request: None (not limited), 'read', 'auth', 'upload' or 'write'
+    def classify(self, environ):
+        endpoint = self.match_prefix(environ.get('PATH_INFO', ''))
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return None
+        if environ['REQUEST_METHOD'] in ('GET', 'HEAD', 'OPTIONS'):
+            return 'read'
+        if endpoint in AUTH_ENDPOINTS:
+            return 'auth'
+        if environ.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
+            return 'upload'
+        return 'write'
+
+    def middleware(self, wsgi_app):
+        def admit(environ, start_response):
+            limit = self.limits.get(self.classify(environ))
+            if limit is None:
+                return wsgi_app(environ, start_response)
+            if not limit.enter():
+                return busy_response(environ.get('PATH_INFO', ''))(environ, start_response)
+            try:
+                app_iter = wsgi_app(environ, start_response)
+            except BaseException:
+                limit.leave()
+                raise
+            return AdmittedResponse(app_iter, limit)
+        return admit
+
+    # Each class's counters (see RouteClassLimit.get_stats())
+    def get_stats(self):
+        return {name: limit.get_stats() for name, limit in self.limits.items()}
+
+# Response body of an admitted request: its turn is given up once the first chunk of the body has been
+# produced (all of it for most pages, the start of a streamed list), or when the server closes it
+class AdmittedResponse:
+
+    def __init__(self, app_iter, limit):
+        self.app_iter = app_iter
+        self.limit = limit
+        self.left = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.app_iter:
+                self.leave()
+                yield chunk
+        finally:
+            self.leave()
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.leave()
+
+    def leave(self):
+        if not self.left:
+            self.left = True
+            self.limit.leave()
+
+# 503 for a request that was turned away (JSON for the API)
+def busy_response(path):
+    message = 'The server is busy right now. Please try again in a moment.'
+    headers = {'Retry-After': str(RETRY_AFTER_SECONDS)}
+    if path.startswith('/api/'):
+        return Response(json.dumps({'error': message}), status=503, headers=headers, mimetype='application/json')
+    return Response(message, status=503, headers=headers, mimetype='text/plain')
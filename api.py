@@ -0,0 +1,241 @@
+# JSON API
+# =========================================================
+# A versioned JSON API for films (so integrations don't have to scrape the HTML pages):
+#   GET /api/v1/films                   every film
+#   PATCH /api/v1/films                 change some of the logged-in user's films at once (see below)
+#   GET /api/v1/users/<user_id>/films   one user's films
+#   GET /api/v1/films/<film_id>         one film
+#   GET /api/v1/actors?q=<prefix>       actors whose name starts with the prefix (the film forms' typeahead)
+#   GET /api/v1/changes?since=<seq>     what changed after a point in the change feed (see below)
+#
+# Query string options:
+#   fields=title,release_year   only select these columns ('id' is always included; 'username'
+#                               adds the owner's name, and for one film 'actors' adds its actors)
+#   order=title|-title|created|-created
+#   limit=50&after=<cursor>     cursor pagination, the cursor for the next page is sent after the films
+#   format=ndjson               one JSON object per line instead of a single JSON document
+#
+# Lists are streamed straight from the database cursor, so memory use stays flat however many
+# films match. Every response has an ETag made from the response cache's versions and the change
+# feed's position, so polling with If-None-Match gets a 304 Not Modified after one cheap query per
+# database (the position is what tells a worker about writes another worker made).
+#
+# Keeping a copy in sync: call /changes without ?since= to get the current position ("next_since"),
+# fetch the films, then keep calling /changes?since=<next_since> and re-fetch (or drop) whatever is
+# listed. Each entity appears once per batch with its latest op; "has_more" means call again straight
+# away. A 410 Gone means the changes after ?since= were pruned, and everything must be fetched again.
+# With DATABASE_SHARDS the position is one number per shard ("120.87.93"), pass it back as it is.
+#
+# Bulk edits: PATCH /api/v1/films with {"ids": [1, 2, 3], "set": {"watched": true, "rating": 4, "genre": "Drama"}}
+# ("rating": null clears it) changes just those columns of every listed film, all or nothing, and answers
+# {"updated": [IDs of the films that were different]}. It uses the login session of the site, so like any
+# form post it needs the page's CSRF token, sent as an X-CSRFToken header.
+import json
+from flask import Blueprint, Response, current_app, g, jsonify, request, session, stream_with_context
+from db.db import CHANGES_BATCH_SIZE, CHANGES_MAX_BATCH_SIZE, FILM_COLUMNS, ChangesExpired, FilmsNotOwned, bulk_update_films, get_changes, get_latest_change_position, iter_films, get_film_by_id, get_usernames, make_film_cursor, parse_change_position, parse_film_cursor, search_actors
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Seconds browsers may re-use an actor typeahead response without asking again
+ACTOR_SEARCH_MAX_AGE = 60
+
+# ?order= values mapped to db.py's FILM_ORDERINGS
+API_ORDERINGS = {
+    'title': 'title ASC',
+    '-title': 'title DESC',
+    'created': 'created ASC',
+    '-created': 'created DESC',
+}
+
+
+# Helpers
+# =========================================================
+# An error response in JSON, eg: {"error": "Film not found"}
+def api_error(status, message):
+    return jsonify(error=message), status
+
+# Get the fields asked for with ?fields= (None means every column)
+# Raises ValueError for anything that isn't a film column or one of the extra fields
+def get_fields(extra_fields=('username',)):
+    if not request.args.get('fields'):
+        return None
+    fields = [name.strip() for name in request.args['fields'].split(',') if name.strip()]
+    unknown = [name for name in fields if name not in FILM_COLUMNS and name not in extra_fields]
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+    return fields
+
+# Turn a films row into a dict with just the requested fields
+def film_to_dict(film, fields):
+    names = film.keys() if fields is None else ['id'] + [name for name in fields if name != 'id']
+    data = {name: film[name] for name in names if name in film.keys()}
+    if data.get('watched') is not None:
+        data['watched'] = bool(data['watched'])
+    return data
+
+def to_json(data):
+    return json.dumps(data, separators=(',', ':'), default=str)
+
+# Answer with 304 Not Modified if the client already has the current version, otherwise None
+# The change feed's position is part of the ETag: every write to films, their actors or users moves it,
+# and unlike the versions of the in-process cache backend it is the same for every worker
+def check_not_modified(version_names):
+    g.api_etag = current_app.extensions['response_cache'].make_etag(version_names, get_latest_change_position())
+    if g.api_etag not in request.if_none_match:
+        return None
+    response = Response(status=304)
+    response.set_etag(g.api_etag)
+    return response
+
+# Add the ETag and caching headers to an API response
+def add_cache_headers(response):
+    response.set_etag(g.api_etag)
+    # Clients may keep the response, but should check it is still current (which is cheap)
+    response.cache_control.no_cache = True
+    return response
+
+
+# Film lists
+# =========================================================
+# Stream a list of films as NDJSON or as one JSON document: {"films": [...], "next_cursor": ...}
+def stream_films(user_id):
+    order_by = API_ORDERINGS.get(request.args.get('order', 'title'))
+    if order_by is None:
+        return api_error(400, f'order must be one of: {", ".join(API_ORDERINGS)}')
+    try:
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+        if limit is not None and limit < 1:
+            raise ValueError
+    except ValueError:
+        return api_error(400, 'limit must be a whole number above 0')
+    try:
+        fields = get_fields()
+    except ValueError as error:
+        return api_error(400, str(error))
+    try:
+        after = parse_film_cursor(request.args.get('after'))
+    except ValueError:
+        return api_error(400, 'after must be a next_cursor from an earlier response')
+
+    # Ask for one extra film to find out whether there is another page
+    columns = None if fields is None else [name for name in fields if name != 'username']
+    films = iter_films(user_id, columns=columns, limit=limit + 1 if limit else None, order_by=order_by,
+                       with_username=fields is None or 'username' in fields, after=after)
+
+    ndjson = request.args.get('format') == 'ndjson'
+
+    # Films are turned into JSON one at a time as they are read from the cursor
+    def generate():
+        if not ndjson:
+            yield '{"films":['
+        count = 0
+        next_cursor = None
+        for film in films:
+            if count == limit:
+                # The extra film exists, so there is another page after the last one sent
+                next_cursor = make_film_cursor(last, order_by)
+                break
+            data = to_json(film_to_dict(film, fields))
+            if ndjson:
+                yield data + '\n'
+            else:
+                yield data if count == 0 else ',' + data
+            last = film
+            count += 1
+        # NDJSON ends with a {"next_cursor": ...} line when there are more films
+        if ndjson:
+            if next_cursor:
+                yield to_json({'next_cursor': next_cursor}) + '\n'
+        else:
+            yield '],"next_cursor":' + to_json(next_cursor) + '}'
+
+    # stream_with_context keeps the request (and its database connection) open until the last film is sent
+    response = Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson' if ndjson else 'application/json')
+    return add_cache_headers(response)
+
+
+# Routes
+# =========================================================
+@api.route('/films')
+def films():
+    return check_not_modified(['films']) or stream_films(None)
+
+@api.route('/films', methods=('PATCH',))
+def edit_films():
+    user_id = session.get('user_id')
+    if user_id is None:
+        return api_error(401, 'Log in to change films')
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('ids'), list) or not isinstance(data.get('set'), dict):
+        return api_error(400, 'Send {"ids": [film IDs], "set": {column: value}}')
+    try:
+        updated = bulk_update_films(user_id, data['ids'], data['set'])
+    except FilmsNotOwned as error:
+        return jsonify(error='These films are not yours', ids=error.film_ids), 403
+    except ValueError as error:
+        return api_error(400, str(error))
+    response = jsonify(updated=updated)
+    response.cache_control.no_store = True
+    return response
+
+@api.route('/users/<int:user_id>/films')
+def user_films(user_id):
+    not_modified = check_not_modified([f'user:{user_id}'])
+    if not_modified:
+        return not_modified
+    if user_id not in get_usernames([user_id]):
+        return api_error(404, 'User not found')
+    return stream_films(user_id)
+
+@api.route('/films/<int:film_id>')
+def film(film_id):
+    not_modified = check_not_modified([f'film:{film_id}'])
+    if not_modified:
+        return not_modified
+    try:
+        fields = get_fields(extra_fields=('username', 'actors'))
+    except ValueError as error:
+        return api_error(400, str(error))
+
+    include_actors = fields is None or 'actors' in fields
+    columns = None if fields is None else [name for name in fields if name not in ('username', 'actors')]
+    result = get_film_by_id(film_id, include_actors=include_actors, with_username=fields is None or 'username' in fields,
+                            columns=columns)
+    film_row = result[0] if include_actors else result
+    if film_row is None:
+        return api_error(404, 'Film not found')
+
+    data = film_to_dict(film_row, fields)
+    if include_actors:
+        data['actors'] = [{'id': actor['id'], 'name': actor['name']} for actor in result[1]]
+    return add_cache_headers(jsonify(data))
+
+@api.route('/actors')
+def actors():
+    actor_list = search_actors(request.args.get('q', ''))
+    response = jsonify(actors=[{'id': actor['id'], 'name': actor['name']} for actor in actor_list])
+    response.cache_control.public = True
+    response.cache_control.max_age = ACTOR_SEARCH_MAX_AGE
+    return response
+
+@api.route('/changes')
+def changes():
+    if not request.args.get('since'):
+        response = jsonify(changes=[], next_since=get_latest_change_position(), has_more=False)
+        response.cache_control.no_store = True
+        return response
+    try:
+        since = parse_change_position(request.args['since'])
+        limit = int(request.args.get('limit', CHANGES_BATCH_SIZE))
+        if not 1 <= limit <= CHANGES_MAX_BATCH_SIZE:
+            raise ValueError
+    except ValueError:
+        return api_error(400, f'since must be a next_since from an earlier response, and limit from 1 to {CHANGES_MAX_BATCH_SIZE}')
+    try:
+        change_list, next_since, has_more = get_changes(since, limit)
+    except ChangesExpired:
+        return api_error(410, 'Changes after since have been pruned, fetch the films again')
+    response = jsonify(changes=change_list, next_since=next_since, has_more=has_more)
+    response.cache_control.no_store = True
+    return response
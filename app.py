@@ -1,37 +1,146 @@
 # This code imports the Flask library and some functions from it.
-from flask import Flask, render_template, url_for, request, flash, redirect, session
+from flask import Flask, current_app, render_template, stream_template, url_for, request, flash, redirect, session, jsonify, abort
 from flask_wtf import CSRFProtect
 from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup, escape
+from werkzeug.local import LocalProxy
 from db.db import *
+from db.db import SEARCH_MARK_START, SEARCH_MARK_END
+from db.auth import HashingBusy, login_throttle, get_auth_stats
+from db.bulk import films_cli
+from db.similar import similar_films_updater, similar_command
+from db.shards import shards_command, move_user_command, rebalance_command
+import instrumentation
+from posters import save_poster, poster_srcset
+from cache import ResponseCache, TemplateCache, set_last_modified
+from api import api
+from assets import Assets
+from preload import get_process_stats, warm_up_command
+from admission import AdmissionControl
+
+# Extensions shared by every app made by create_app()
+# Cache rendered pages for the read-heavy routes; film changes in db.py make the affected pages stale
+response_cache = ResponseCache()
+# {% cache %} fragments in templates (eg: film cards) and compiled template bytecode kept on disk
+template_cache = TemplateCache(response_cache)
+# Fingerprinted, precompressed static files ('flask assets build') and long-lived uploads (see assets.py)
+assets = Assets()
+csrf = CSRFProtect()  # This automatically protects all POST routes
+# Limits how many reads, writes, uploads and logins run at once, turning the rest away with a 503 (see admission.py)
+admission = AdmissionControl()
+
+# Number of films shown on each page of a films list
+FILMS_PAGE_SIZE = 24
+# Number of films listed on each page of the bulk edit page
+BULK_EDIT_PAGE_SIZE = 100
+# Number of results shown on each page of search results
+SEARCH_PAGE_SIZE = 20
+# Characters of a streamed page sent to the browser at a time
+STREAM_CHUNK_SIZE = 16 * 1024
+# Number of other films listed under each actor on a film's page
+ACTOR_OTHER_FILMS = 3
 
-# Create a Flask application instance
-app = Flask(__name__)
+# Global variable for site name: Used in templates to display the site name
+siteName = "List Your Films!"
 
-# Allowed image extensions for uploads
-ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-UPLOADS_PATH = "."
 
-app.secret_key = 'your_secret_key'  # Required for CSRF protection
-csrf = CSRFProtect(app)  # This automatically protects all POST routes
-# Create the csrf_token global variable
-@app.context_processor
+# Application factory
+#=========================================================
+# Routes are collected here (with @route, like @app.route) and added to each app made by create_app()
+routes = []
+
+def route(rule, **options):
+    def decorator(view):
+        routes.append((rule, view, options))
+        return view
+    return decorator
+
+# Create a Flask application: settings come from FLASK_<NAME> environment variables
+# (eg: FLASK_SQL_INSTRUMENTATION=true), then from `config` (eg: create_app({'DATABASE': 'test.db'}))
+# Nothing here opens a database connection, so a pre-fork server can build the app in its master
+# process (see wsgi.py and preload.py) and every worker opens its own connections
+def create_app(config=None):
+    app = Flask(__name__)
+    app.secret_key = 'your_secret_key'  # Required for CSRF protection
+    app.config.from_prefixed_env()
+    if config:
+        app.config.update(config)
+
+    # Share one pooled database connection per request (returned to the pool at teardown)
+    init_app(app)
+
+    response_cache.init_app(app)
+    template_cache.init_app(app)
+    assets.init_app(app)
+    csrf.init_app(app)
+    admission.init_app(app)
+    # Its background thread also drops change feed entries older than CHANGES_RETENTION_DAYS (at most hourly)
+    similar_films_updater.init_app(app)
+
+    # Versioned JSON API under /api/v1 (see api.py)
+    app.register_blueprint(api)
+
+    # Command line tools (see films_cli below), and 'flask warm-up' to time the pre-fork start-up work
+    app.cli.add_command(films_cli)
+    app.cli.add_command(warm_up_command)
+
+    # Optional query timing, Server-Timing headers, slow query log and sampling profiler
+    # (switched on with the SQL_INSTRUMENTATION and PROFILE_SAMPLING settings)
+    instrumentation.init_app(app)
+
+    # Templates get a lazy csrf_token (see below, it replaces the csrf_token() function Flask-WTF
+    # adds, as the templates use {{ csrf_token }}) and the site name
+    app.context_processor(inject_csrf_token)
+    app.jinja_env.globals['siteName'] = siteName
+    # Make poster_srcset() available in templates to list a poster's thumbnails
+    # eg: <img src="{{ film['poster'] }}" srcset="{{ poster_srcset(film['poster']) }}">
+    app.jinja_env.globals['poster_srcset'] = poster_srcset
+    app.add_template_filter(get_username)
+    app.add_template_filter(mark_matches)
+
+    for rule, view, options in routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    return app
+
+
+# The csrf_token template variable, only generated (and stored in the session) when a template renders
+# {{ csrf_token }}: read-only pages for visitors don't set a session cookie, so a CDN or reverse proxy
+# can store them (see ResponseCache.cached() in cache.py)
+csrf_token = LocalProxy(generate_csrf)
+
 def inject_csrf_token():
-    return dict(csrf_token=generate_csrf())
+    return dict(csrf_token=csrf_token)
 
 
-# Global variable for site name: Used in templates to display the site name
-siteName = "List Your Films!"
-# Set the site name in the app context
-@app.context_processor
-def inject_site_name():
-    return dict(siteName=siteName)
+# Film change listeners (registered once for the process, whichever app made the change)
+# Every cached page showing a changed film is made stale
+add_film_change_listener(response_cache.films_changed)
+
+# Keep each film's "You might also like" list up to date in the background after films change
+# (a refreshed list changes that film's page, so its cached copy is made stale)
+add_film_change_listener(similar_films_updater.films_changed)
+similar_films_updater.add_refresh_listener(lambda film_ids: response_cache.bump(*(f'film:{film_id}' for film_id in film_ids)))
+
+# Command line tools: 'flask films import FILE', 'flask films export FILE', 'flask films similar',
+# and for DATABASE_SHARDS 'flask films shards', 'flask films move-user' and 'flask films rebalance'
+films_cli.add_command(similar_command)
+films_cli.add_command(shards_command)
+films_cli.add_command(move_user_command)
+films_cli.add_command(rebalance_command)
+
 
 # Helper function to get a username by user ID and provide it to templates 
 # eg: {{ film['user']|get_username }})
-@app.template_filter()
+# Prefer selecting films with_username=True so no lookup is needed at all; this filter only
+# falls back to the batched/cached resolver and never aborts in the middle of a render
 def get_username(user_id):
-    user = get_user_by_id(user_id)
-    return user['username'] if user else 'Unknown'
+    return get_usernames([user_id]).get(user_id, 'Unknown')
+
+# Helper function to show the matched words in search results, eg: {{ result['snippet']|mark_matches }}
+# The text is escaped first, so only the <mark> tags added here are rendered as HTML
+def mark_matches(text):
+    text = str(escape(text or ''))
+    return Markup(text.replace(SEARCH_MARK_START, '<mark>').replace(SEARCH_MARK_END, '</mark>'))
 
 
 # Routes
@@ -39,7 +148,8 @@ def get_username(user_id):
 # These define which template is loaded, or action is taken, depending on the URL requested
 #===================
 # Home Page
-@app.route('/')
+@route('/')
+@response_cache.cached(lambda: ['films'])
 def index():
     # This defines a variable 'studentName' that will be passed to the output HTML
     studentName = "SHU Student"
@@ -48,7 +158,8 @@ def index():
         studentName = session['username']
 
     # Get a list of films to display on the homepage
-    films = get_all_films(limit=5, order_by='created DESC')  # Fetch the latest 5 films added
+    films = get_all_films(limit=5, order_by='created DESC', with_username=True)  # Fetch the latest 5 films added (with owner names)
+    set_last_modified(*[film['updated'] or film['created'] for film in films])
 
     # Render the 'index.html' template and pass the 'name' variable to it and a title to set the page title dynamically
     return render_template('index.html', title="Welcome", username=studentName, films=films)
@@ -56,8 +167,8 @@ def index():
 
 
 # About Page
-@app.route('/about/')
-@app.route('/about/<name>')
+@route('/about/')
+@route('/about/<name>')
 def aboutName(name = "My Default Name"):
     # Render HTML with the name in a H1 tag
     # return f"<h1>About {name}!</h1><p>It is easy to create new routes</p>"
@@ -65,7 +176,7 @@ def aboutName(name = "My Default Name"):
 
 
 # Register Page
-@app.route('/register/', methods=('GET', 'POST'))
+@route('/register/', methods=('GET', 'POST'))
 def register():
 
     # If the request method is POST, process the form submission
@@ -98,7 +209,12 @@ def register():
 
         # If no errors, insert the new user
         if error is None:
-            create_user(username, password)
+            try:
+                create_user(username, password)
+            except HashingBusy:
+                # Every password hashing worker is busy: turn the request away quickly
+                flash(category='danger', message='The server is busy right now. Please try again in a moment.')
+                return render_template('register.html', title="Register"), 503, {'Retry-After': '1'}
             flash(category='success', message=f"Registration successful! Welcome {username}!")
             return redirect(url_for('login'))
         else:
@@ -111,7 +227,7 @@ def register():
     return render_template('register.html', title="Register")
 
 # Login
-@app.route('/login/', methods=('GET', 'POST'))
+@route('/login/', methods=('GET', 'POST'))
 def login():
 
     # If the request method is POST, process the login form
@@ -128,10 +244,22 @@ def login():
         elif not password:
             error = 'Password is required!'
         
+        # Limit how often each username and IP address can try to log in (LOGIN_THROTTLE=False turns this off, eg: for load tests)
+        if error is None and current_app.config.get('LOGIN_THROTTLE', True):
+            wait = login_throttle.attempt(username, request.remote_addr)
+            if wait:
+                flash(category='danger', message='Too many login attempts! Please wait a moment and try again.')
+                return render_template('login.html', title="Log In"), 429, {'Retry-After': str(int(wait) + 1)}
+
         # [TO-DO]: Add real authentication logic here
         # Validate user credentials
         if error is None:
-            user = validate_login(username, password)
+            try:
+                user = validate_login(username, password)
+            except HashingBusy:
+                # Every password hashing worker is busy: turn the request away quickly
+                flash(category='danger', message='The server is busy right now. Please try again in a moment.')
+                return render_template('login.html', title="Log In"), 503, {'Retry-After': '1'}
             if user is None:
                 error = 'Invalid username or password!'
             else:
@@ -150,7 +278,7 @@ def login():
     return render_template('login.html', title="Log In")
 
 # Logout
-@app.route('/logout/')
+@route('/logout/')
 def logout():
     # Clear the session and redirect to the index page with a flash message
     session.clear()
@@ -158,8 +286,46 @@ def logout():
     return redirect(url_for('index'))
 
 
+# Helper function to get the page of films requested with ?after=<title,id> or ?before=<title,id>
+def get_films_list_page(user_id, page_size=FILMS_PAGE_SIZE):
+    try:
+        return get_films_page(user_id, page_size=page_size,
+                              after=request.args.get('after'), before=request.args.get('before'))
+    except ValueError:
+        # The cursor in the URL was not in the "<title>,<id>" format
+        abort(400)
+
+
+# Helper function to stream every film in a list (?all=1) instead of one page
+# The films come straight from the database cursor as the page is sent, so the start of the
+# page reaches the browser straight away and memory use doesn't grow with the number of films
+def stream_films_list(user_id, title):
+    page = stream_template('films.html', title=title, films=iter_films(user_id), films_user=user_id,
+                           next_cursor=None, prev_cursor=None, show_all=True)
+    return current_app.response_class(join_chunks(page, STREAM_CHUNK_SIZE))
+
+# Jinja yields a streamed page in thousands of tiny pieces, so send them in chunks of about `size` characters
+def join_chunks(chunks, size):
+    buffer = []
+    length = 0
+    try:
+        for chunk in chunks:
+            buffer.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                yield ''.join(buffer)
+                buffer = []
+                length = 0
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        # Let the template (and its database cursor) finish up if the client goes away
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
 # Films List Page
-@app.route('/films/')
+@route('/films/')
 def films():
     
     # Get the logged-in user's ID from the session
@@ -170,35 +336,125 @@ def films():
         flash(category='warning', message='You must be logged in to view this page.')
         return redirect(url_for('login'))
     
-    # Get films list data
-    film_list = get_all_films(user_id)  
+    # Every film at once
+    if request.args.get('all'):
+        return stream_films_list(user_id, "Your Films")
+
+    # Get one page of the films list
+    film_list, next_cursor, prev_cursor = get_films_list_page(user_id)
 
     # Render the films.html template with a list of films
-    return render_template('films.html', title="Your Films", films=film_list, films_user=user_id)
+    return render_template('films.html', title="Your Films", films=film_list, films_user=user_id,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+# Edit Several Films Page: tick some of your films and set watched, rating and/or genre for all of them at once
+@route('/films/edit/', methods=('GET', 'POST'))
+def bulkEdit():
+
+    # Get the logged-in user's ID from the session
+    user_id = session.get('user_id')
+
+    # Ensure user is logged in to edit films
+    if user_id is None:
+        flash(category='warning', message='You must be logged in to edit films.')
+        return redirect(url_for('login'))
+
+    # If the request method is POST, apply the change to every ticked film
+    if request.method == 'POST':
+
+        # Only the fields given a value are changed ('' leaves them as they are, rating 'none' clears it)
+        changes = {name: request.form[name] for name in ('watched', 'rating', 'genre') if request.form.get(name)}
+        if changes.get('rating') == 'none':
+            changes['rating'] = None
+        film_ids = request.form.getlist('film_ids')
+
+        # Check for errors (ownership of every ticked film is checked in one go by bulk_update_films)
+        error = None
+        if not film_ids:
+            error = 'Select at least one film!'
+        elif not changes:
+            error = 'Choose something to change!'
+        else:
+            try:
+                updated = bulk_update_films(user_id, film_ids, changes)
+            except FilmsNotOwned:
+                error = 'You do not have permission to edit some of these films.'
+            except ValueError as e:
+                error = str(e)
+
+        # Display appropriate flash messages and go back to the same page of films
+        if error is None:
+            flash(category='success', message=f"Updated {len(updated)} film{'' if len(updated) == 1 else 's'}!")
+        else:
+            flash(category='danger', message=error)
+        return redirect(url_for('bulkEdit', after=request.args.get('after'), before=request.args.get('before')))
+
+    # Get one page of the films list
+    film_list, next_cursor, prev_cursor = get_films_list_page(user_id, page_size=BULK_EDIT_PAGE_SIZE)
+
+    return render_template('bulk_edit.html', title="Edit Several Films", films=film_list,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 # Users Films List Page
-@app.route('/films/<int:user_id>/')
+@route('/films/<int:user_id>/')
+@response_cache.cached(lambda user_id: [f'user:{user_id}'])
 def userFilms(user_id):
+
+    # Every film at once (streamed, so it is never put in the page cache)
+    if request.args.get('all'):
+        user = get_user_by_id(user_id)
+        return stream_films_list(user_id, f"Films added by {user['username']}")
     
-    # Get films list data
-    film_list = get_all_films(user_id)  
+    # Get one page of the films list
+    film_list, next_cursor, prev_cursor = get_films_list_page(user_id)
+    set_last_modified(*[film['updated'] or film['created'] for film in film_list])
 
     # Get user info
     user = get_user_by_id(user_id)
 
     # Render the films.html template with a list of films
-    return render_template('films.html', title=f"Films added by {user['username']}", films=film_list, films_user=user_id)
+    return render_template('films.html', title=f"Films added by {user['username']}", films=film_list, films_user=user_id,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+# User Stats Page: counts by genre, rating, decade and watched (read from user_film_stats, not the films)
+@route('/stats/<int:user_id>/')
+@response_cache.cached(lambda user_id: [f'user:{user_id}'])
+def userStats(user_id):
+
+    user = get_user_by_id(user_id)
+    stats = get_user_stats(user_id)
+
+    return render_template('stats.html', title=f"Stats for {user['username']}", stats_user=user, stats=stats,
+                           watched=dict(stats['watched']))
+
+# Database Pool (and write queue), Cache, Template Cache, Password Hashing, Similar Films, Admission Control
+# and this process's memory/start-up Stats
+# (only available in debug mode or when DEBUG_STATS is enabled)
+@route('/_debug/stats')
+def debugStats():
+    if not (current_app.debug or current_app.config.get('DEBUG_STATS')):
+        abort(404)
+    return jsonify(pool=get_pool_stats(), response_cache=response_cache.get_stats(), template_cache=template_cache.get_stats(),
+                   auth=get_auth_stats(), similar_films=similar_films_updater.get_stats(),
+                   admission=admission.get_stats(), process=get_process_stats())
 
 # Film Detail Page
-@app.route('/film/<int:id>/')
+@route('/film/<int:id>/')
+@response_cache.cached(lambda id: [f'film:{id}'])
 def film(id):
     
-    # Get film data
-    film_data, film_actors, film_actor_ids = get_film_by_id(id)
+    # Get film data (with the owner's username)
+    film_data, film_actors, film_actor_ids = get_film_by_id(id, with_username=True)
 
     if film_data:
+        set_last_modified(film_data['updated'] or film_data['created'])
+        # A few other films of each actor, all fetched with one query
+        actor_films = get_films_for_actors(film_actor_ids, per_actor=ACTOR_OTHER_FILMS, exclude_film=id)
+        # "You might also like" (worked out ahead of time, see db/similar.py)
+        similar_films = get_similar_films(id)
         # Render the film.html template with film details
-        return render_template('film.html', title=film_data['title'], film=film_data, film_actors=film_actors)
+        return render_template('film.html', title=film_data['title'], film=film_data, film_actors=film_actors,
+                               actor_films=actor_films, similar_films=similar_films)
     else:
         # If film not found, redirect to films list with a flash message
         flash(category='warning', message='Requested film not found!')
@@ -207,8 +463,44 @@ def film(id):
 
 
 
+# Actor Page: the actor's films, newest first
+@route('/actor/<int:id>/')
+@response_cache.cached(lambda id: ['films'])
+def actor(id):
+
+    actor_data = get_actor(id)
+    if actor_data is None:
+        abort(404)
+
+    # Get one page of the actor's films (?before=<film id> is the next page)
+    actor_films, next_cursor = get_actor_films(id, limit=FILMS_PAGE_SIZE, before=request.args.get('before', type=int))
+
+    return render_template('actor.html', title=actor_data['name'], actor=actor_data, films=actor_films, next_cursor=next_cursor)
+
+
+# Search Films Page
+@route('/search')
+def search():
+
+    # Get the search text (and optionally a user to search within) from the URL
+    query = request.args.get('q', '').strip()
+    search_user = request.args.get('user', type=int)
+
+    results, next_cursor = [], None
+    if query:
+        try:
+            results, next_cursor = search_films(query, user=search_user, limit=SEARCH_PAGE_SIZE, cursor=request.args.get('after'))
+        except ValueError:
+            # The cursor in the URL was not in the "<rank>,<id>" format
+            abort(400)
+
+    # Render the search.html template with the results
+    return render_template('search.html', title="Search Films", query=query, results=results,
+                           next_cursor=next_cursor, search_user=search_user)
+
+
 # Add A Film Page
-@app.route('/create/', methods=('GET', 'POST'))
+@route('/create/', methods=('GET', 'POST'))
 def create():
     
     # Get the logged-in user's ID from the session
@@ -219,9 +511,6 @@ def create():
         flash(category='warning', message='You must be logged in to add a film.')
         return redirect(url_for('login'))
     
-    # Get all actors for the multi-select
-    all_actors = get_all_actors()
-
     # If the request method is POST, process the form submission
     if request.method == 'POST':
 
@@ -234,16 +523,10 @@ def create():
         watched = True if request.form.get('watched') == 'on' else False
         rating = int(request.form['rating']) if request.form.get('rating') else None
         review = request.form['review']
-        # Handle poster image upload
+        # Handle poster image upload (stored under its content hash, thumbnails are made in the background)
         poster = None
         if 'poster' in request.files:
-            poster_file = request.files['poster']
-            # Check it is an image file and save it
-            if poster_file and poster_file.filename.rsplit('.', 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS:
-                # Save the file to the static/uploads directory
-                poster_url = f"/static/uploads/{poster_file.filename}"
-                poster_file.save(f"{UPLOADS_PATH}{poster_url}")
-                poster = poster_url  # Use the uploaded file URL in database
+            poster = save_poster(request.files['poster'])
 
 
         # Validate the input
@@ -251,27 +534,24 @@ def create():
             flash(category='danger', message='Title is required!')
             return redirect(url_for('create'))
 
-        # Use the database function to insert the new film
-        film_id = create_film(user, title, tagline, director, poster, release_year, genre, watched, rating, review)
-
-        # Update the film actors
+        # Use the database function to insert the new film and its actors (in one transaction)
         actor_ids = request.form.getlist('actor_ids')
-        update_film_actors(film_id, actor_ids)
+        film_id = create_film(user, title, tagline, director, poster, release_year, genre, watched, rating, review, actor_ids=actor_ids)
         
         # Flash a success message
         flash(category='success', message='Created successfully!')
         return redirect(url_for('films'))
 
-    return render_template('create.html', all_actors=all_actors)
+    return render_template('create.html')
 
 
 # Edit A Film Page
-@app.route('/update/<int:id>/', methods=('GET', 'POST'))
+@route('/update/<int:id>/', methods=('GET', 'POST'))
 def update(id):
 
     # Get film and actors data
+    # Only the film's own actors are put in the form, the rest are found with the actor typeahead
     film, film_actors, film_actor_ids = get_film_by_id(id)
-    all_actors = get_all_actors()
 
     # Check for errors
     error = None
@@ -301,16 +581,10 @@ def update(id):
         if request.form.get('rating'):
             rating = int(request.form['rating'])
         review = request.form['review']
-        # Handle poster image upload
+        # Handle poster image upload (stored under its content hash, thumbnails are made in the background)
         poster = film['poster']  # Default to existing poster
         if 'poster' in request.files:
-            poster_file = request.files['poster']
-            # Check it is an image file and save it
-            if poster_file and poster_file.filename.rsplit('.', 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS:
-                # Save the file to the static/uploads directory
-                poster_url = f"/static/uploads/{poster_file.filename}"
-                poster_file.save(f"{UPLOADS_PATH}{poster_url}")
-                poster = poster_url  # Use the uploaded file URL in database
+            poster = save_poster(request.files['poster']) or poster
 
 
         # Validate the input
@@ -318,23 +592,20 @@ def update(id):
             flash(category='danger', message='Title is required!')
             return redirect(url_for('update', id=id))
 
-        # Use the database function to update the film
-        update_film(id, title, tagline, director, poster, release_year, genre, watched, rating, review)
-        
-        # Update the film actors
+        # Use the database function to update the film and its actors (in one transaction)
         actor_ids = request.form.getlist('actor_ids')
-        update_film_actors(id, actor_ids)
+        update_film(id, title, tagline, director, poster, release_year, genre, watched, rating, review, actor_ids=actor_ids)
 
         # Flash a success message and redirect to the index page
         flash(category='success', message='Updated successfully!')
         return redirect(url_for('film', id=id))
 
-    return render_template('update.html', film=film, film_actors=film_actors, film_actor_ids=film_actor_ids, all_actors=all_actors)
+    return render_template('update.html', film=film, film_actors=film_actors, film_actor_ids=film_actor_ids)
 
 
 
 # Delete A Film
-@app.route('/delete/<int:id>', methods=('POST',))
+@route('/delete/<int:id>', methods=('POST',))
 def delete(id):
 
     # Get the film 
@@ -353,9 +624,8 @@ def delete(id):
     if error:
         return redirect(url_for('films'))
 
-    # Use the database function to delete the film
+    # Use the database function to delete the film (its actor links are deleted with it)
     delete_film(id)
-    delete_film_actors(id)
     
     # Flash a success message and redirect to the index page
     flash(category='success', message='Film deleted successfully!')
@@ -371,4 +641,5 @@ if __name__ == '__main__':
     print("Starting Flask application...")
     print("Open Your Application in Your Browser: http://localhost:81")
     # The app will run on port 81, accessible from any local IP address
-    app.run(host='0.0.0.0', port=81, debug=True)
\ No newline at end of file
+    # (for production use a pre-fork WSGI server with wsgi.py instead, see preload.py)
+    create_app().run(host='0.0.0.0', port=81, debug=True)
\ No newline at end of file
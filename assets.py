@@ -0,0 +1,161 @@
+# Static assets and uploads
+# =========================================================
+# 'flask assets build' copies every file in static/ (except uploads) to static/dist/ under a
+# name that includes a hash of its contents (eg: styles.3f2a9c1b7d4e.css), with gzip and
+# Brotli copies of the text files made ahead of time, and writes static/dist/manifest.json.
+# Once built, url_for('static', filename='styles.css') points at the hashed copy. As a
+# changed file gets a new name, browsers may keep these files forever (Cache-Control:
+# immutable), so repeat page loads don't download any static files at all.
+#
+# Uploaded posters are stored under the hash of their contents too (see posters.py), so
+# they get the same long cache lifetime. They are sent with range request support, and can
+# be handed to the web server instead: USE_X_SENDFILE (Apache/lighttpd) or
+# UPLOADS_ACCEL_REDIRECT='/internal-uploads/' (an nginx internal location for static/uploads).
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import click
+from flask import Response, abort, request, send_file
+from flask.cli import AppGroup
+
+# Brotli is optional, without it only gzip copies are made
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+# Where built assets go (inside static/), and folders of static/ that are not built
+DIST_FOLDER = 'dist'
+SKIPPED_FOLDERS = {DIST_FOLDER, 'uploads'}
+MANIFEST_NAME = 'manifest.json'
+
+# Number of hex characters of the content hash put in file names
+HASH_LENGTH = 12
+# File types worth compressing (images and fonts are compressed already)
+COMPRESSED_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map'}
+
+# Seconds browsers may keep files whose name changes with their contents (one year)
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# Uploads named by their content hash: aa/<sha256>.jpg or aa/<sha256>-card.webp
+HASHED_UPLOAD = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{64}(-[a-z]+)?\.[a-z0-9]+$')
+# Seconds browsers may keep older uploads that were saved under their original names
+UPLOAD_MAX_AGE = 60 * 60
+
+assets_cli = AppGroup('assets', help='Build fingerprinted static assets.')
+
+
+# Build
+# =========================================================
+# Hash, copy and compress every asset, returns the manifest ({'styles.css': 'dist/styles.<hash>.css'})
+def build_assets(static_folder=STATIC_FOLDER):
+    dist_folder = os.path.join(static_folder, DIST_FOLDER)
+    if os.path.isdir(dist_folder):
+        shutil.rmtree(dist_folder)
+    os.makedirs(dist_folder)
+
+    manifest = {}
+    for folder, folders, files in os.walk(static_folder):
+        relative_folder = os.path.relpath(folder, static_folder)
+        if relative_folder == '.':
+            folders[:] = [name for name in folders if name not in SKIPPED_FOLDERS]
+        for name in files:
+            source = os.path.join(folder, name)
+            filename = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            stem, extension = os.path.splitext(filename)
+            built_name = f'{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{extension}'
+            target = os.path.join(dist_folder, built_name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            if extension in COMPRESSED_EXTENSIONS:
+                with open(target + '.gz', 'wb') as f:
+                    f.write(gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(target + '.br', 'wb') as f:
+                        f.write(brotli.compress(data, quality=11))
+            manifest[filename] = f'{DIST_FOLDER}/{built_name}'
+
+    with open(os.path.join(dist_folder, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+@assets_cli.command('build')
+def build_command():
+    """Copy static files to static/dist/ under content-hashed names (run on every deploy)."""
+    manifest = build_assets()
+    click.echo(f'Built {len(manifest)} assets' + ('' if brotli else ' (install brotli for .br copies)'), err=True)
+
+
+# Serving
+# =========================================================
+class Assets:
+
+    def __init__(self):
+        self.manifest = {}
+
+    # Load the manifest (if 'flask assets build' has been run) and add the routes
+    def init_app(self, app):
+        path = os.path.join(app.static_folder, DIST_FOLDER, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+        self.static_folder = app.static_folder
+        self.accel_redirect = app.config.get('UPLOADS_ACCEL_REDIRECT')
+        app.url_defaults(self.fingerprint_url)
+        app.add_url_rule(f'/static/{DIST_FOLDER}/<path:filename>', 'static_dist', self.send_asset)
+        app.add_url_rule('/static/uploads/<path:filename>', 'static_uploads', self.send_upload)
+        app.cli.add_command(assets_cli)
+
+    # Point url_for('static', filename=...) at the built copy of the file
+    def fingerprint_url(self, endpoint, values):
+        if endpoint == 'static' and values.get('filename') in self.manifest:
+            values['filename'] = self.manifest[values['filename']]
+
+    # Send a built asset, precompressed if the browser accepts it
+    def send_asset(self, filename):
+        folder = os.path.join(self.static_folder, DIST_FOLDER)
+        path = os.path.realpath(os.path.join(folder, filename))
+        if not path.startswith(folder + os.sep) or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+        encoding = None
+        for name, extension in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings[name] and os.path.exists(path + extension):
+                encoding, path = name, path + extension
+                break
+
+        response = send_file(path, mimetype=mimetype, conditional=True, max_age=IMMUTABLE_MAX_AGE)
+        if encoding:
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    # Send an uploaded poster (or thumbnail), with range requests, or have the web server send it
+    def send_upload(self, filename):
+        folder = os.path.join(self.static_folder, 'uploads')
+        path = os.path.realpath(os.path.join(folder, filename))
+        if not path.startswith(folder + os.sep) or not os.path.isfile(path):
+            abort(404)
+        immutable = bool(HASHED_UPLOAD.match(filename))
+
+        if self.accel_redirect:
+            # nginx sends the file itself from its internal location
+            response = Response(headers={'X-Accel-Redirect': self.accel_redirect.rstrip('/') + '/' + filename})
+            response.headers.pop('Content-Type')
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE if immutable else UPLOAD_MAX_AGE
+        else:
+            # send_file answers Range/If-None-Match requests, and uses X-Sendfile when USE_X_SENDFILE is set
+            response = send_file(path, conditional=True, max_age=IMMUTABLE_MAX_AGE if immutable else UPLOAD_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = immutable
+        return response
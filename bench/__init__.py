@@ -0,0 +1,6 @@
+# Load benchmarks for the films app
+# =========================================================
+# Build a synthetic database, then drive every route and compare against a saved baseline:
+#   python -m bench build --db /tmp/bench.db --users 200 --films-per-user 50
+#   python -m bench run --db /tmp/bench.db --concurrency 8 --duration 10 --save baseline.json
+#   python -m bench run --db /tmp/bench.db --concurrency 8 --duration 10 --compare baseline.json
@@ -0,0 +1,62 @@
+# Command line for the benchmarks: python -m bench build|run --help
+import argparse
+import json
+import sys
+from bench.dataset import build_dataset
+from bench.runner import ROUTE_NAMES, DEFAULT_TOLERANCE, run_benchmark, format_report, save_report, compare_reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Load benchmarks for the films app.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='Build a synthetic database.')
+    build.add_argument('--db', required=True, help='Database file to create (replaced if it exists).')
+    build.add_argument('--users', type=int, default=100)
+    build.add_argument('--films-per-user', type=int, default=20, help='Average films per user.')
+    build.add_argument('--actors', type=int, default=1000)
+    build.add_argument('--actors-per-film', type=int, default=4)
+    build.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent for film ownership (0 = even).')
+    build.add_argument('--seed', type=int, default=42)
+
+    run = commands.add_parser('run', help='Drive the routes and report latency/throughput.')
+    run.add_argument('--db', required=True, help='Database built with "build" (write routes change it).')
+    run.add_argument('--routes', default=','.join(ROUTE_NAMES), help='Comma separated routes to run.')
+    run.add_argument('--concurrency', type=int, default=4)
+    run.add_argument('--duration', type=float, default=5, help='Seconds per route.')
+    run.add_argument('--requests', type=int, help='Maximum requests per route.')
+    run.add_argument('--server', action='store_true', help='Use a local WSGI server instead of the Flask test client.')
+    run.add_argument('--save', help='Save the report as JSON (eg: a new baseline).')
+    run.add_argument('--compare', help='Baseline JSON to compare with (exit code 1 on regressions).')
+    run.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        summary = build_dataset(args.db, users=args.users, films_per_user=args.films_per_user, actors=args.actors,
+                                actors_per_film=args.actors_per_film, zipf=args.zipf, seed=args.seed)
+        print(json.dumps(summary))
+        return 0
+
+    # Imported here so building a dataset doesn't need the whole app
+    from app import create_app
+    app = create_app()
+    report = run_benchmark(app, args.db, routes=args.routes.split(','), concurrency=args.concurrency,
+                           duration=args.duration, max_requests=args.requests, use_server=args.server)
+    print(format_report(report))
+    if args.save:
+        save_report(report, args.save)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
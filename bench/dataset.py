@@ -0,0 +1,102 @@
+# Synthetic dataset generator
+# =========================================================
+# Builds a database with the same schema as db/schema.sql (and the search index from
+# db/search.sql) filled with made-up users, actors and films. Film ownership follows a
+# Zipf distribution, so a few users own most of the films like in real catalogues.
+import os
+import random
+import sqlite3
+import time
+from werkzeug.security import generate_password_hash
+from db.auth import PASSWORD_HASH_METHOD
+
+DB_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'db')
+
+# Every synthetic user has this password
+BENCH_PASSWORD = 'password'
+
+GENRES = ['Action', 'Adventure', 'Comedy', 'Drama', 'Horror', 'Romance', 'Sci-Fi', 'Documentary', 'Other']
+WORDS = ['night', 'star', 'river', 'ghost', 'city', 'love', 'war', 'king', 'dream', 'shadow', 'summer', 'last',
+         'secret', 'road', 'fire', 'ocean', 'storm', 'garden', 'mirror', 'silver', 'wolf', 'empire', 'island', 'heart']
+FIRST_NAMES = ['Ana', 'Ben', 'Cara', 'Dev', 'Eli', 'Fay', 'Gus', 'Hana', 'Ivo', 'Jun', 'Kai', 'Lea', 'Max', 'Nia', 'Oto', 'Pia']
+LAST_NAMES = ['Stone', 'Rivers', 'Marsh', 'Hale', 'Quinn', 'Moss', 'Vale', 'Frost', 'Lane', 'Reyes', 'Shah', 'Okafor']
+
+# Number of rows written per executemany
+BATCH_SIZE = 10000
+
+
+# Make a random title/sentence from WORDS
+def make_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+# Cumulative Zipf weights for ranks 1..count (rank 1 is the most common)
+def zipf_weights(count, exponent):
+    total = 0.0
+    weights = []
+    for rank in range(1, count + 1):
+        total += 1 / rank ** exponent
+        weights.append(total)
+    return weights
+
+# Build a synthetic database at db_path (any existing file is replaced), returns a summary dict
+def build_dataset(db_path, users=100, films_per_user=20, actors=1000, actors_per_film=4, zipf=1.1, seed=42):
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    with open(os.path.join(DB_FOLDER, 'schema.sql')) as f:
+        conn.executescript(f.read())
+
+    # Users all share one password hash (hashing it per user would take minutes)
+    password_hash = generate_password_hash(BENCH_PASSWORD, PASSWORD_HASH_METHOD)
+    conn.executemany('INSERT INTO users (id, username, password) VALUES (?, ?, ?)',
+                     [(user_id, f'user{user_id}', password_hash) for user_id in range(1, users + 1)])
+
+    conn.executemany('INSERT INTO actors (id, name, birth_year, height) VALUES (?, ?, ?, ?)',
+                     [(actor_id, f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {actor_id}',
+                       rng.randint(1930, 2005), rng.randint(150, 200)) for actor_id in range(1, actors + 1)])
+
+    # Films: owners are picked with Zipf weights, actors uniformly
+    total_films = users * films_per_user
+    owner_weights = zipf_weights(users, zipf)
+    owners = list(range(1, users + 1))
+    actor_ids = list(range(1, actors + 1))
+    films = []
+    links = []
+    for film_id in range(1, total_films + 1):
+        films.append((film_id, rng.choices(owners, cum_weights=owner_weights)[0], make_text(rng, rng.randint(1, 4)),
+                      make_text(rng, 6), f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}', None,
+                      rng.randint(1920, 2025), rng.choice(GENRES), rng.random() < 0.5, rng.randint(1, 5),
+                      make_text(rng, 20), f'20{rng.randint(10, 25):02d}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 12:00:00'))
+        for actor_id in rng.sample(actor_ids, min(actors_per_film, actors)):
+            links.append((film_id, actor_id))
+        if len(films) >= BATCH_SIZE:
+            write_films(conn, films, links)
+            films, links = [], []
+    write_films(conn, films, links)
+    conn.commit()
+
+    # Build the search index and user stats last (search.sql and stats.sql fill them for every film at once),
+    # the change feed starts empty (nothing needs syncing until the data changes)
+    for name in ('search.sql', 'stats.sql', 'changes.sql'):
+        with open(os.path.join(DB_FOLDER, name)) as f:
+            conn.executescript(f.read())
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+    return {'users': users, 'films': total_films, 'actors': actors, 'links': total_films * min(actors_per_film, actors),
+            'seconds': round(time.perf_counter() - started, 2)}
+
+# Write a batch of films and their actor links
+def write_films(conn, films, links):
+    conn.executemany('''
+        INSERT INTO films (id, user, title, tagline, director, poster, release_year, genre, watched, rating, review, created)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', films)
+    conn.executemany('INSERT INTO film_actors (film_id, actor_id) VALUES (?, ?)', links)
@@ -0,0 +1,308 @@
+# Route load runner
+# =========================================================
+# Drives each route of app.py with a number of concurrent clients (Flask test clients, or
+# real HTTP clients against a local WSGI server) and reports throughput, p50/p95/p99 latency,
+# SQL queries and template render time per request, and the share of responses a CDN or
+# reverse proxy could store. Results can be saved as a baseline and compared later.
+import http.cookiejar
+import json
+import random
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from flask import before_render_template, template_rendered
+from werkzeug.serving import make_server
+from db.db import add_connection_listener
+from bench.dataset import BENCH_PASSWORD, zipf_weights
+
+# Routes that can be benchmarked, in the order they are run
+# Writes go last so reads are measured against the same data every time
+ROUTE_NAMES = ['index', 'about', 'films', 'user_films', 'film', 'search', 'login', 'create', 'update', 'delete']
+
+# Routes visited without logging in, each request as a new visitor (no cookies), as a CDN sees them
+ANONYMOUS_ROUTES = ('index', 'about', 'user_films', 'film', 'search', 'login')
+
+# Statements that are not counted as queries
+UNCOUNTED_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA', 'SAVEPOINT', 'RELEASE')
+
+# Allowed slowdown before a comparison counts as a regression (0.2 = 20%)
+DEFAULT_TOLERANCE = 0.2
+
+
+# Query counting
+# =========================================================
+# Every statement run by a request's thread is counted and returned in an X-Query-Count header
+_query_counter = threading.local()
+
+# Statements run inside triggers and virtual tables (SQLite reports these starting with '--',
+# or for FTS5 housekeeping quoted as 'main'.'table') are part of the query that caused them
+def count_statement(statement):
+    statement = statement.lstrip()
+    if statement.startswith('--') or "'main'." in statement or statement.upper().startswith(UNCOUNTED_STATEMENTS):
+        return
+    _query_counter.count = getattr(_query_counter, 'count', 0) + 1
+
+def trace_connection(conn):
+    conn.set_trace_callback(count_statement)
+
+# Time spent rendering templates by a request's thread, returned in an X-Render-Ms header
+# (a streamed page is rendered while it is sent, so only the start of it is counted)
+def start_render(sender, template, context, **extra):
+    _query_counter.render_started = time.perf_counter()
+
+def finish_render(sender, template, context, **extra):
+    _query_counter.render_time += time.perf_counter() - _query_counter.render_started
+
+def instrument_app(app):
+    add_connection_listener(trace_connection)
+    before_render_template.connect(start_render, app)
+    template_rendered.connect(finish_render, app)
+
+    @app.before_request
+    def reset_query_count():
+        _query_counter.count = 0
+        _query_counter.render_time = 0.0
+
+    @app.after_request
+    def add_query_count(response):
+        response.headers['X-Query-Count'] = str(getattr(_query_counter, 'count', 0))
+        response.headers['X-Render-Ms'] = f"{getattr(_query_counter, 'render_time', 0.0) * 1000:.3f}"
+        return response
+
+# Whether a shared cache (a CDN or reverse proxy) may store a response: a successful page that
+# doesn't set a cookie and says so explicitly (public, s-maxage or max-age), not private or no-store
+def is_cacheable(status, headers):
+    directives = {directive.strip().split('=')[0] for directive in (headers.get('Cache-Control') or '').lower().split(',')}
+    return (status == 200 and not headers.get('Set-Cookie')
+            and bool(directives & {'public', 's-maxage', 'max-age'})
+            and not directives & {'private', 'no-store'})
+
+
+# Clients
+# =========================================================
+# A logged-in (or anonymous) user using the Flask test client
+class TestClient:
+
+    def __init__(self, app, use_cookies=True):
+        self.client = app.test_client(use_cookies=use_cookies)
+
+    # Returns (status code, headers)
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.close()
+        return response.status_code, response.headers
+
+# A user talking HTTP to a local server (redirects are not followed, so each route is timed on its own)
+class HttpClient:
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url, use_cookies=True):
+        self.base_url = base_url
+        handlers = [urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())] if use_cookies else []
+        self.opener = urllib.request.build_opener(*handlers, self.NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data, doseq=True).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                response.read()
+                return response.status, response.headers
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, error.headers
+
+
+# Scenarios
+# =========================================================
+# What each route needs: the dataset's film/user IDs, and for each client its user and that user's films
+class Scenario:
+
+    def __init__(self, db_path, seed=1):
+        conn = sqlite3.connect(db_path)
+        self.user_ids = [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+        self.max_film_id = conn.execute('SELECT max(id) FROM films').fetchone()[0] or 1
+        # Users ordered by how many films they own (the dataset makes ownership Zipf-skewed)
+        self.owners = [row[0] for row in conn.execute('SELECT user FROM films GROUP BY user ORDER BY count(*) DESC')]
+        conn.close()
+        self.db_path = db_path
+        self.user_weights = zipf_weights(len(self.user_ids), 1.1)
+        self.seed = seed
+
+    # Films owned by a user, for update/delete
+    def films_of(self, user_id):
+        conn = sqlite3.connect(self.db_path)
+        films = [row[0] for row in conn.execute('SELECT id FROM films WHERE user = ?', (user_id,))]
+        conn.close()
+        return films
+
+    # The request to make for a route: (method, path, form data)
+    def make_request(self, route, rng, client):
+        if route == 'index':
+            return 'GET', '/', None
+        if route == 'about':
+            return 'GET', '/about/', None
+        if route == 'films':
+            return 'GET', '/films/', None
+        if route == 'user_films':
+            return 'GET', f'/films/{rng.choices(self.user_ids, cum_weights=self.user_weights)[0]}/', None
+        if route == 'film':
+            return 'GET', f'/film/{rng.randint(1, self.max_film_id)}/', None
+        if route == 'search':
+            return 'GET', f'/search?q={rng.choice(["night", "star river", "ghost", "summer ki", "wolf"])}', None
+        if route == 'login':
+            return 'POST', '/login/', {'username': f'user{client.user_id}', 'password': BENCH_PASSWORD}
+        if route == 'create':
+            return 'POST', '/create/', film_form(rng, [str(rng.randint(1, 50)) for _ in range(3)])
+        if route == 'update':
+            if not client.films:
+                return None
+            return 'POST', f'/update/{rng.choice(client.films)}/', film_form(rng, [str(rng.randint(1, 50)) for _ in range(3)])
+        if route == 'delete':
+            if not client.films:
+                return None
+            return 'POST', f'/delete/{client.films.pop()}', None
+        raise ValueError(f'Unknown route: {route}')
+
+# Form fields for creating/updating a film
+def film_form(rng, actor_ids):
+    return {'title': f'Bench film {rng.randint(1, 10**9)}', 'tagline': 'Benchmarks', 'director': 'Bench', 'release_year': '2020',
+            'genre': 'Drama', 'watched': 'on', 'rating': str(rng.randint(1, 5)), 'review': 'Made by the benchmark', 'actor_ids': actor_ids}
+
+
+# Running
+# =========================================================
+# Percentile of a sorted list
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# Run one route with `concurrency` clients for `duration` seconds (or until `max_requests`), returns its stats
+def run_route(route, scenario, make_client, concurrency, duration, max_requests=None):
+    results = []
+    results_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    remaining = [max_requests]
+
+    def worker(index):
+        rng = random.Random(scenario.seed * 1000 + index)
+        anonymous = route in ANONYMOUS_ROUTES
+        client = make_client(not anonymous)
+        # Each client logs in as one of the users owning the most films (so it has films to update/delete)
+        client.user_id = scenario.owners[index % len(scenario.owners)]
+        client.films = scenario.films_of(client.user_id)
+        rng.shuffle(client.films)
+        if not anonymous:
+            client.request('POST', '/login/', {'username': f'user{client.user_id}', 'password': BENCH_PASSWORD})
+
+        while time.perf_counter() < deadline:
+            if max_requests is not None:
+                with results_lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+            request_args = scenario.make_request(route, rng, client)
+            if request_args is None:
+                break
+            started = time.perf_counter()
+            status, headers = client.request(*request_args)
+            elapsed = time.perf_counter() - started
+            with results_lock:
+                results.append((elapsed, status, int(headers.get('X-Query-Count', 0)),
+                                float(headers.get('X-Render-Ms', 0)), is_cacheable(status, headers)))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started
+
+    latencies = sorted(result[0] for result in results)
+    count = len(results)
+    errors = sum(1 for result in results if result[1] >= 400)
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput': round(count / wall_time, 1) if wall_time else 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if count else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if count else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if count else None,
+        'queries_per_request': round(sum(result[2] for result in results) / count, 2) if count else None,
+        'render_ms': round(sum(result[3] for result in results) / count, 3) if count else None,
+        'cacheable': round(sum(result[4] for result in results) / count, 3) if count else None,
+    }
+
+# Run every requested route and return the report
+def run_benchmark(app, db_path, routes=ROUTE_NAMES, concurrency=4, duration=5, max_requests=None, use_server=False, seed=1):
+    app.config.update(DATABASE=db_path, WTF_CSRF_ENABLED=False, LOGIN_THROTTLE=False)
+    instrument_app(app)
+    scenario = Scenario(db_path, seed)
+
+    server = None
+    if use_server:
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+        make_client = lambda use_cookies: HttpClient(base_url, use_cookies)
+    else:
+        make_client = lambda use_cookies: TestClient(app, use_cookies)
+
+    report = {'meta': {'db': db_path, 'concurrency': concurrency, 'duration': duration, 'mode': 'server' if use_server else 'test_client',
+                       'films': scenario.max_film_id, 'users': len(scenario.user_ids)},
+              'routes': {}}
+    try:
+        for route in routes:
+            report['routes'][route] = run_route(route, scenario, make_client, concurrency, duration, max_requests)
+    finally:
+        if server:
+            server.shutdown()
+    return report
+
+
+# Reporting
+# =========================================================
+def format_report(report):
+    lines = [f"{'route':<12}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}"
+             f"{'render ms':>11}{'cacheable':>11}"]
+    for route, stats in report['routes'].items():
+        lines.append(f"{route:<12}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput']:>10}"
+                     f"{stats['p50_ms'] or '-':>10}{stats['p95_ms'] or '-':>10}{stats['p99_ms'] or '-':>10}"
+                     f"{stats['queries_per_request'] if stats['queries_per_request'] is not None else '-':>9}"
+                     f"{stats['render_ms'] if stats['render_ms'] is not None else '-':>11}"
+                     f"{stats['cacheable'] if stats['cacheable'] is not None else '-':>11}")
+    return '\n'.join(lines)
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+# Compare a report with a saved baseline, returns a list of regressions (empty if none)
+# Latency, throughput and queries per request may be `tolerance` worse than the baseline
+# (query counts vary a little with cache hits, an N+1 query shows up as a much bigger jump)
+# Render time may also be `tolerance` worse (plus 0.5ms of noise), and no more responses may become uncacheable
+# (both are skipped for baselines saved before they were measured)
+def compare_reports(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    regressions = []
+    for route, stats in report['routes'].items():
+        base = baseline['routes'].get(route)
+        if not base or not stats['requests'] or not base['requests']:
+            continue
+        if stats['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {stats['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if stats['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{route}: {stats['throughput']} req/s vs baseline {base['throughput']} req/s")
+        if stats['queries_per_request'] > base['queries_per_request'] * (1 + tolerance) + 0.1:
+            regressions.append(f"{route}: {stats['queries_per_request']} queries/request vs baseline {base['queries_per_request']}")
+        if base.get('render_ms') is not None and stats['render_ms'] > base['render_ms'] * (1 + tolerance) + 0.5:
+            regressions.append(f"{route}: {stats['render_ms']}ms rendering vs baseline {base['render_ms']}ms")
+        if base.get('cacheable') is not None and stats['cacheable'] < base['cacheable'] - 0.01:
+            regressions.append(f"{route}: {stats['cacheable']:.0%} cacheable vs baseline {base['cacheable']:.0%}")
+    return regressions
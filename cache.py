@@ -0,0 +1,334 @@
+# Response cache
+# =========================================================
+# Caches rendered pages for read-heavy routes and answers conditional GETs (ETag /
+# Last-Modified) with 304 Not Modified without rendering anything. TemplateCache adds
+# cached template fragments ({% cache %}) and a bytecode cache for compiled templates.
+#
+# Cache keys include version numbers (eg: 'films', 'user:2', 'film:5') that are bumped
+# whenever db.py changes a film, so a write makes the old entries unreachable instead of
+# having to find and delete them. The versions live in the cache backend too, so with a
+# shared backend every worker sees the same versions. With the in-process backend (the default,
+# one per worker) the keys also include the change feed's position, read from the database, so a
+# write handled by another worker makes this worker's pages stale as well.
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+from flask import Response, g, make_response, request, session
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from db.db import get_latest_change_position
+
+# Redis is only needed for the shared backend
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Maximum number of entries kept by the in-process backend
+CACHE_MAX_ENTRIES = 1024
+# Seconds a cached page is kept before it is rendered again
+CACHE_TIMEOUT = 300
+
+
+# Cache backends
+# =========================================================
+# Any object with get(key), set(key, value, timeout) and incr(key) can be used as a backend
+
+# In-process LRU cache (each worker process has its own copy)
+class MemoryCacheBackend:
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # Counters are kept apart from the LRU entries: evicting a version would make old pages current again
+        self.counters = {}
+        self.lock = threading.Lock()
+        # Every process counts its versions from 0, so ETags made from them also include this
+        # (another worker then never mistakes a different 'films=3' for its own)
+        self.scope = os.urandom(8).hex()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.counters:
+                return self.counters[key]
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.monotonic() + timeout if timeout else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+# Redis cache shared by every worker (and every server) that points at the same Redis
+class RedisCacheBackend:
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('The redis package is needed for RedisCacheBackend (pip install redis)')
+        self.client = redis.Redis.from_url(url)
+        # The versions are shared, so ETags made from them are valid on every worker
+        self.scope = ''
+
+    def get(self, key):
+        value = self.client.get(key)
+        if value is None:
+            return None
+        return int(value) if key.startswith('version:') else value
+
+    def set(self, key, value, timeout=None):
+        self.client.set(key, value, ex=timeout)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+
+# Cache manager
+# =========================================================
+class ResponseCache:
+
+    def __init__(self, backend=None, timeout=CACHE_TIMEOUT):
+        self.backend = backend or MemoryCacheBackend()
+        self.timeout = timeout
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+        self.lock = threading.Lock()
+
+    # Use a Flask app's config: CACHE_REDIS_URL switches to the shared Redis backend,
+    # CACHE_TIMEOUT sets how long pages are kept
+    def init_app(self, app):
+        if app.config.get('CACHE_REDIS_URL'):
+            self.backend = RedisCacheBackend(app.config['CACHE_REDIS_URL'])
+        self.timeout = app.config.get('CACHE_TIMEOUT', self.timeout)
+        app.extensions['response_cache'] = self
+
+    # Make every page that depends on a version name stale (eg: bump('film:5'))
+    def bump(self, *names):
+        for name in names:
+            self.backend.incr(f'version:{name}')
+
+    # Bump the versions affected by changes to films (registered as a db.py film change listener)
+    # A batch of one user's films bumps 'films' and their 'user:' version once
+    def films_changed(self, changes):
+        names = {'films'}
+        for film_id, user_id in changes:
+            names.update((f'film:{film_id}', f'user:{user_id}'))
+        self.bump(*names)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    # The current version of one name (0 until it is first bumped)
+    def get_version(self, name):
+        return self.backend.get(f'version:{name}') or 0
+
+    # The current versions as a string, eg: 'films=3,user:2=1'
+    def get_versions(self, version_names):
+        return ','.join(f'{name}={self.get_version(name)}' for name in version_names)
+
+    # ETag for a response that only changes when the given versions (or the URL) change
+    # Unlike cached(), this doesn't need the body, so it works for streamed responses too
+    # validator is mixed in as it is: something read from the database that every worker agrees on
+    # (the in-process backend's versions only see the writes this process made)
+    def make_etag(self, version_names, validator=''):
+        args = '&'.join(f'{name}={value}' for name, value in sorted(request.args.items(multi=True)))
+        raw = f'{getattr(self.backend, "scope", "")}|{request.path}|{args}|{self.get_versions(version_names)}|{validator}'
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    # What every worker agrees the database looks like: the change feed's position, moved by every write
+    # of any worker ('' with a shared backend, whose versions already see them all). Read once per request
+    def get_validator(self):
+        if not getattr(self.backend, 'scope', ''):
+            return ''
+        if 'cache_validator' not in g:
+            g.cache_validator = get_latest_change_position()
+        return g.cache_validator
+
+    # Build the cache key for this request: the route and its arguments, the logged-in user
+    # and the current version of everything the page depends on
+    def make_key(self, version_names):
+        versions = self.get_versions(version_names)
+        args = '&'.join(f'{name}={value}' for name, value in sorted(request.args.items(multi=True)))
+        user_id = session.get('user_id')
+        # Logged-in pages contain forms with the session's CSRF token
+        csrf = session.get('csrf_token', '') if user_id else ''
+        raw = f'{request.endpoint}|{request.view_args}|{args}|{user_id}|{csrf}|{versions}|{self.get_validator()}'
+        return 'page:' + hashlib.sha256(raw.encode()).hexdigest()
+
+    # Decorator for a view whose page only changes when the given versions change
+    # versions is a function that gets the view's arguments and returns the version names, eg:
+    # @response_cache.cached(lambda id: [f'film:{id}'])
+    def cached(self, versions):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**kwargs):
+                # Only cache plain GETs, and never a page that is about to show flash messages
+                if request.method != 'GET' or '_flashes' in session:
+                    return view(**kwargs)
+
+                key = self.make_key(versions(**kwargs))
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self.count('hits')
+                    response = load_response(entry)
+                else:
+                    self.count('misses')
+                    response = make_response(view(**kwargs))
+                    # Only successful pages are cached (not redirects or errors), and never
+                    # streamed pages (reading their body would wait for the whole page)
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    response.set_etag(hashlib.sha256(response.get_data()).hexdigest())
+                    if 'last_modified' in g:
+                        response.last_modified = g.last_modified
+                    # Nor a page that changed the session: eg: one that generated the session's first CSRF
+                    # token was looked up without it, and the user's other sessions never got that token
+                    if not session.modified:
+                        self.backend.set(key, dump_response(response), self.timeout)
+
+                # Let browsers re-use their copy, but always check it is still current
+                # A visitor's page that didn't touch their session (so has no cookie to set) is the same
+                # for every visitor, so shared caches (a CDN or reverse proxy) may store it too,
+                # kept apart from logged-in pages by Vary: Cookie
+                if session.get('user_id') is None and not session.modified:
+                    response.cache_control.public = True
+                else:
+                    response.cache_control.private = True
+                response.cache_control.no_cache = True
+                response.vary.add('Cookie')
+                response = response.make_conditional(request)
+                if response.status_code == 304:
+                    self.count('not_modified')
+                return response
+            return wrapper
+        return decorator
+
+
+# Record when the data shown on this page last changed (used as the Last-Modified header)
+# Accepts SQLite timestamp strings ('YYYY-MM-DD HH:MM:SS', UTC), None values are ignored
+def set_last_modified(*timestamps):
+    for timestamp in timestamps:
+        if not timestamp:
+            continue
+        modified = datetime.strptime(str(timestamp)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        if 'last_modified' not in g or modified > g.last_modified:
+            g.last_modified = modified
+
+# Turn a response into bytes for the cache (body plus the headers worth keeping)
+def dump_response(response):
+    headers = '\n'.join(f'{name}: {value}' for name, value in response.headers.items()
+                        if name.lower() in ('content-type', 'etag', 'last-modified'))
+    return headers.encode() + b'\n\n' + response.get_data()
+
+# Turn cached bytes back into a response
+def load_response(entry):
+    headers, body = entry.split(b'\n\n', 1)
+    response = Response(body)
+    for line in headers.decode().splitlines():
+        name, value = line.split(': ', 1)
+        response.headers[name] = value
+    return response
+
+
+# Template caches
+# =========================================================
+# {% cache %} keeps the HTML rendered inside it, so a fragment that shows the same thing
+# (eg: a film card) is only rendered once, eg:
+#   {% cache 'film-card', film['id'], cache_version('film:' ~ film['id']), film['updated'] %} ... {% endcache %}
+# Everything after 'cache' makes up the key, so include a version that changes with the content
+# (cache_version() changes with every write, a timestamp only once a second)
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('render_fragment', [nodes.List(key_parts)]), [], [], body).set_lineno(lineno)
+
+    def render_fragment(self, key_parts, caller):
+        template_cache = getattr(self.environment, 'template_cache', None)
+        if template_cache is None:
+            return caller()
+        return template_cache.get_fragment(key_parts, caller)
+
+# Bytecode cache that counts how many templates were loaded already compiled
+class CountingBytecodeCache(FileSystemBytecodeCache):
+
+    def __init__(self, directory, stats, lock):
+        super().__init__(directory)
+        self.stats = stats
+        self.lock = lock
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+        with self.lock:
+            self.stats['bytecode_hits' if bucket.code is not None else 'bytecode_misses'] += 1
+
+# Sets up {% cache %} fragments (stored in the same backend as a ResponseCache) and the bytecode cache
+class TemplateCache:
+
+    def __init__(self, response_cache):
+        self.response_cache = response_cache
+        self.stats = {'fragment_hits': 0, 'fragment_misses': 0, 'bytecode_hits': 0, 'bytecode_misses': 0}
+        self.lock = threading.Lock()
+
+    # TEMPLATE_BYTECODE_CACHE (on by default) stores compiled templates in TEMPLATE_BYTECODE_CACHE_DIR
+    # (the instance folder by default), so a new worker loads them instead of compiling every template
+    def init_app(self, app):
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.template_cache = self
+        # Versions bumped by every write (see ResponseCache.bump()), to key fragments on
+        app.jinja_env.globals['cache_version'] = self.response_cache.get_version
+        if app.config.get('TEMPLATE_BYTECODE_CACHE', True):
+            directory = app.config.get('TEMPLATE_BYTECODE_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+            os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = CountingBytecodeCache(directory, self.stats, self.lock)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    # Return the cached HTML for a fragment, or render it with caller() and cache it
+    # (keyed on the response cache's validator too, as cache_version() only sees this worker's writes)
+    def get_fragment(self, key_parts, caller):
+        raw = '|'.join(str(part) for part in key_parts) + f'|{self.response_cache.get_validator()}'
+        key = 'fragment:' + hashlib.sha256(raw.encode()).hexdigest()
+        backend = self.response_cache.backend
+        cached = backend.get(key)
+        if cached is not None:
+            self.count('fragment_hits')
+            return Markup(cached.decode())
+        self.count('fragment_misses')
+        html = caller()
+        backend.set(key, html.encode(), self.response_cache.timeout)
+        return html
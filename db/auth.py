@@ -0,0 +1,195 @@
+# Password hashing and login throttling
+# =========================================================
+# Password hashes are deliberately slow to compute, so they are done in a small pool of
+# worker processes instead of the web worker handling the request. The pool only accepts
+# a limited number of waiting jobs: when it is full, new logins/registrations are turned
+# away straight away (HashingBusy) instead of queueing up behind a burst of attempts.
+# Login attempts are also limited per username and per IP address with token buckets.
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Hash method used for new passwords (werkzeug format: 'scrypt:N:r:p' or 'pbkdf2:sha256:iterations')
+# Changing this makes existing users' hashes get upgraded the next time they log in
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+
+# Number of worker processes for hashing, and how many jobs may wait for a worker
+HASHING_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 2))
+HASHING_MAX_PENDING = HASHING_WORKERS * 4
+# Seconds to wait for a hash before giving up
+HASHING_TIMEOUT = 5
+
+# Login attempts allowed in a burst, and how many seconds it takes to get one attempt back
+LOGIN_BURST_PER_USERNAME = 5
+LOGIN_REFILL_SECONDS_PER_USERNAME = 12
+LOGIN_BURST_PER_IP = 20
+LOGIN_REFILL_SECONDS_PER_IP = 3
+# Maximum number of usernames/IP addresses tracked at once (least recently seen are dropped)
+LOGIN_THROTTLE_MAX_KEYS = 10000
+
+# Number of recent hash timings kept for the latency percentiles
+HASHING_LATENCY_SAMPLES = 1000
+
+
+# Raised when the hashing pool is full (or too slow) to take another password
+class HashingBusy(Exception):
+    pass
+
+
+# Hashing pool
+# =========================================================
+class HashingPool:
+
+    def __init__(self, workers=HASHING_WORKERS, max_pending=HASHING_MAX_PENDING, timeout=HASHING_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = 0
+        self.stats = {'completed': 0, 'rejected': 0, 'timed_out': 0, 'max_pending': 0}
+        self.latencies = deque(maxlen=HASHING_LATENCY_SAMPLES)
+
+    # The process pool is started on first use, and again after a fork,
+    # because a pre-fork server's workers can't share the master's pool
+    # By then the web worker is running many threads, and forking a process with threads can leave the
+    # child holding locks nobody will release, so the pool's processes come from a fork server instead
+    # (started fresh, without threads) or are spawned where there isn't one
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context(start_method))
+                self.pid = os.getpid()
+            return self.executor
+
+    # Run a hashing function in the pool and wait for the result
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.stats['rejected'] += 1
+            raise HashingBusy('Too many password checks in progress')
+
+        started = time.perf_counter()
+        with self.lock:
+            self.pending += 1
+            self.stats['max_pending'] = max(self.stats['max_pending'], self.pending)
+        try:
+            future = self.get_executor().submit(function, *args)
+        except BaseException:
+            self.release_slot()
+            raise
+        # The slot is given back when the hash has finished (or was cancelled before it started),
+        # not when the caller stops waiting: a timed-out hash that is already running keeps its
+        # slot, so the pool never holds more than max_pending hashes
+        future.add_done_callback(lambda future: self.release_slot())
+        try:
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            with self.lock:
+                self.stats['timed_out'] += 1
+            raise HashingBusy('Password check took too long')
+
+        with self.lock:
+            self.stats['completed'] += 1
+            self.latencies.append(time.perf_counter() - started)
+        return result
+
+    def release_slot(self):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    # Counters, current queue depth and latency percentiles (in milliseconds)
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pending'] = self.pending
+            latencies = sorted(self.latencies)
+        for name, percentile in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+            stats[name] = round(latencies[int(percentile * (len(latencies) - 1))] * 1000, 2) if latencies else None
+        return stats
+
+
+hashing_pool = HashingPool()
+
+# Hash a new password (in the hashing pool)
+def hash_password(password):
+    return hashing_pool.run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+# Check a password against a stored hash (in the hashing pool)
+def check_password(password_hash, password):
+    return hashing_pool.run(check_password_hash, password_hash, password)
+
+# Check whether a stored hash was made with different settings than PASSWORD_HASH_METHOD
+def needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != PASSWORD_HASH_METHOD
+
+
+# Login throttling
+# =========================================================
+# Token bucket per key: each attempt takes a token, and tokens come back over time
+class TokenBuckets:
+
+    def __init__(self, burst, refill_seconds, max_keys=LOGIN_THROTTLE_MAX_KEYS):
+        self.burst = burst
+        self.refill_seconds = refill_seconds
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Take a token for this key, returns 0 if allowed or the seconds until the next token
+    def take(self, key):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) / self.refill_seconds)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                self.buckets.move_to_end(key)
+                return (1 - tokens) * self.refill_seconds
+            self.buckets[key] = (tokens - 1, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return 0
+
+
+# Limits login attempts per username and per IP address
+class LoginThrottle:
+
+    def __init__(self):
+        self.usernames = TokenBuckets(LOGIN_BURST_PER_USERNAME, LOGIN_REFILL_SECONDS_PER_USERNAME)
+        self.addresses = TokenBuckets(LOGIN_BURST_PER_IP, LOGIN_REFILL_SECONDS_PER_IP)
+        self.lock = threading.Lock()
+        self.stats = {'allowed': 0, 'throttled': 0}
+
+    # Record a login attempt, returns 0 if it may go ahead or the seconds to wait before trying again
+    # The username's bucket is only used once the address is allowed, so an address that is being
+    # throttled can't use up (and lock out) someone else's username
+    def attempt(self, username, address):
+        wait = self.addresses.take(address)
+        if not wait:
+            wait = self.usernames.take(username.lower())
+        with self.lock:
+            self.stats['throttled' if wait else 'allowed'] += 1
+        return wait
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+login_throttle = LoginThrottle()
+
+# Hashing and throttling metrics, eg: for a stats page
+def get_auth_stats():
+    return {'hashing': hashing_pool.get_stats(), 'login_throttle': login_throttle.get_stats()}
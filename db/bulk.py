@@ -0,0 +1,316 @@
+# Bulk import/export of films (with their actors)
+# =========================================================
+# Adds the 'flask films import' and 'flask films export' commands (and 'flask films stats' and 'prune-changes').
+# Files are CSV or NDJSON (one JSON object per line), one film per row with these fields:
+#   username, title, tagline, director, poster, release_year, genre, watched, rating, review, created, actors
+# 'actors' is a list of actor names (in CSV the names are separated by '|').
+# Both commands stream the file, so memory use stays flat however many films there are.
+# A row with a bad value is reported with its line number and skipped, the rest of the file is still imported.
+import csv
+import json
+import os
+import time
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from db.db import (FILM_INDEXES, BASE_DIR, allocate_film_ids, copy_to_shards, get_db_connection, get_latest_change_seq,
+                   get_shard_count, get_user_shard, notify_films_changed, prune_changes, rebuild_user_stats, transaction,
+                   write_turn)
+from db.similar import REFRESH_MAX_FILMS, similar_films_updater
+
+# Film columns written/read by import and export (plus 'username' and 'actors')
+FILM_FIELDS = ['title', 'tagline', 'director', 'poster', 'release_year', 'genre', 'watched', 'rating', 'review', 'created']
+FILE_FIELDS = ['username'] + FILM_FIELDS + ['actors']
+
+# Separator between actor names in a CSV 'actors' column
+CSV_ACTOR_SEPARATOR = '|'
+
+# Number of films written in each transaction
+IMPORT_CHUNK_SIZE = 5000
+# Print progress every this many films
+PROGRESS_EVERY = 50000
+
+# Triggers that keep the search index up to date (dropped during a bulk import, search.sql puts them back)
+SEARCH_TRIGGERS = ['films_fts_insert', 'films_fts_update', 'films_fts_delete',
+                   'film_actors_fts_insert', 'film_actors_fts_delete', 'actors_fts_update']
+# Triggers that keep user_film_stats up to date (also dropped, the stats are counted again afterwards)
+STATS_TRIGGERS = ['films_stats_insert', 'films_stats_update', 'films_stats_delete']
+
+films_cli = AppGroup('films', help='Import and export films.')
+
+
+# Helpers
+# =========================================================
+# Work out the file format from --format or the file name
+def get_format(file_format, file):
+    if file_format:
+        return file_format
+    name = getattr(file, 'name', '')
+    return 'csv' if name.endswith('.csv') else 'ndjson'
+
+# Read rows one at a time from a CSV or NDJSON file: (line number, row)
+# A line that isn't valid JSON is read as the error message (a str) instead of a row
+def read_rows(file, file_format):
+    if file_format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            actors = row.get('actors') or ''
+            row['actors'] = [name.strip() for name in actors.split(CSV_ACTOR_SEPARATOR) if name.strip()]
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(file, 1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError as error:
+                    yield line_number, f'not valid JSON ({error})'
+
+# Turn an imported value into an int (or None if it is empty), raises ValueError if it isn't a whole number
+def to_int(value, name):
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be a whole number, got {value!r}') from None
+
+# Turn an imported value into a boolean
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+    return bool(value)
+
+# Print progress and throughput to stderr
+def report(action, count, started):
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    click.echo(f'{action} {count} films in {elapsed:.1f}s ({count / elapsed:,.0f} rows/s)', err=True)
+
+# Check a row and turn it into the films columns after id and user: (title, tagline, ... created)
+# Raises ValueError (with a message for the user) if a value can't be imported
+def parse_film(row):
+    if not isinstance(row, dict):
+        raise ValueError(row if isinstance(row, str) else 'not a JSON object')
+    actors = row.get('actors') or []
+    if not isinstance(actors, list) or not all(isinstance(name, str) for name in actors):
+        raise ValueError('actors must be a list of names')
+    return (row.get('title'), row.get('tagline'), row.get('director'), row.get('poster'),
+            to_int(row.get('release_year'), 'release_year'), row.get('genre'), to_bool(row.get('watched')),
+            to_int(row.get('rating'), 'rating'), row.get('review'), row.get('created') or None)
+
+# Get the next free film ID (films uses AUTOINCREMENT, so IDs of deleted films are never reused)
+def get_next_film_id(conn):
+    row = conn.execute('''
+        SELECT max(coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'films'), 0),
+                   coalesce((SELECT max(id) FROM films), 0)) AS last_id
+    ''').fetchone()
+    return row['last_id'] + 1
+
+# Drop the film indexes, search and stats triggers before a big import
+def drop_indexes_and_triggers(conn):
+    for name in FILM_INDEXES:
+        conn.execute(f'DROP INDEX IF EXISTS {name}')
+    for name in SEARCH_TRIGGERS + STATS_TRIGGERS:
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    conn.commit()
+
+# Re-create the film indexes, and the search triggers, then index every film again and count every
+# user's stats again (which also puts the stats triggers back). Both are rebuilt from scratch, as the
+# site may have changed films while the triggers were gone; searches use the old index until it is done.
+def restore_indexes_and_triggers(conn):
+    for statement in FILM_INDEXES.values():
+        conn.execute(statement)
+    conn.commit()
+    with open(os.path.join(BASE_DIR, 'search.sql')) as f:
+        script = f.read()
+    with write_turn(conn):
+        conn.executescript('BEGIN IMMEDIATE; DELETE FROM films_fts;' + script + 'COMMIT;')
+    rebuild_user_stats(conn)
+
+
+# Import
+# =========================================================
+# Write one chunk of films and their actor links in a single transaction (one per shard with DATABASE_SHARDS)
+# rows are (line number, row) pairs, rows with a bad value are reported and skipped before anything is written
+# Returns (films imported, rows skipped, [(film_id, user_id)] of the imported films)
+def import_chunk(rows, user_ids, actor_ids, default_user):
+    skipped = 0
+    films_by_shard = {}
+    new_actors = {}
+    for line_number, row in rows:
+        try:
+            film = parse_film(row)
+        except ValueError as error:
+            click.echo(f'Line {line_number}: {error}, skipped', err=True)
+            skipped += 1
+            continue
+        user_id = user_ids.get(row.get('username')) if row.get('username') else default_user
+        if user_id is None or not film[0]:
+            skipped += 1
+            continue
+        names = list(dict.fromkeys(row.get('actors') or []))
+        new_actors.update((name, None) for name in names if name not in actor_ids)
+        films_by_shard.setdefault(get_user_shard(user_id), []).append((user_id, film, names))
+
+    imported = []
+    with transaction() as catalogue:
+        # Actors are looked up in the in-memory map, new names are added to the actors table
+        # (in the catalogue, and copied to every shard)
+        for name in new_actors:
+            actor_ids[name] = catalogue.execute('INSERT INTO actors (name) VALUES (?)', (name,)).lastrowid
+        if new_actors:
+            copy_to_shards('INSERT OR IGNORE INTO actors (id, name) VALUES (?, ?)', [(actor_ids[name], name) for name in new_actors])
+
+        # Without DATABASE_SHARDS shard 0 is the catalogue, so this joins the transaction above
+        for shard, entries in films_by_shard.items():
+            with transaction(shard) as conn:
+                film_id = allocate_film_ids(conn, len(entries)) or get_next_film_id(conn)
+                latest = get_latest_change_seq(conn)
+                films = []
+                links = []
+                for user_id, film, names in entries:
+                    films.append((film_id, user_id) + film)
+                    links.extend((film_id, actor_ids[name]) for name in names)
+                    film_id += 1
+
+                conn.executemany('''
+                    INSERT INTO films (id, user, title, tagline, director, poster, release_year, genre, watched, rating, review, created)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, coalesce(?, CURRENT_TIMESTAMP))
+                ''', films)
+                conn.executemany('INSERT OR IGNORE INTO film_actors (film_id, actor_id) VALUES (?, ?)', links)
+                # The change feed's 'insert' of each new film covers its actors, so their changes aren't kept
+                # (this transaction holds the write lock, so every change after `latest` is from this chunk)
+                conn.execute("DELETE FROM changes WHERE seq > ? AND entity = 'film_actors'", (latest,))
+                imported.extend((film[0], film[1]) for film in films)
+    return len(imported), skipped, imported
+
+@films_cli.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']), help='File format (default: from the file name).')
+@click.option('--user', 'default_username', help='Username to add films to when a row has no username.')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True, help='Films written per transaction.')
+@click.option('--defer-indexes/--keep-indexes', default=True, show_default=True,
+              help='Drop the film indexes, search and stats triggers during the import and rebuild them at the end.')
+def import_command(file, file_format, default_username, chunk_size, defer_indexes):
+    """Import films from a CSV or NDJSON FILE ('-' for stdin)."""
+    conn = get_db_connection()
+
+    # Usernames and actor names are resolved with in-memory maps instead of a query per row
+    user_ids = {row['username']: row['id'] for row in conn.execute('SELECT id, username FROM users')}
+    actor_ids = {row['name']: row['id'] for row in conn.execute('SELECT id, name FROM actors')}
+    default_user = None
+    if default_username:
+        default_user = user_ids.get(default_username)
+        if default_user is None:
+            raise click.BadParameter(f'No user called {default_username!r}', param_hint='--user')
+
+    started = time.perf_counter()
+    imported = skipped = 0
+    changes = []
+    next_report = PROGRESS_EVERY
+    chunk = []
+    try:
+        if defer_indexes:
+            for shard in range(get_shard_count()):
+                drop_indexes_and_triggers(get_db_connection(shard))
+        for line_number, row in read_rows(file, get_format(file_format, file)):
+            chunk.append((line_number, row))
+            if len(chunk) >= chunk_size:
+                added, missed, films = import_chunk(chunk, user_ids, actor_ids, default_user)
+                imported, skipped, chunk = imported + added, skipped + missed, []
+                changes.extend(films)
+                if imported >= next_report:
+                    report('Imported', imported, started)
+                    next_report += PROGRESS_EVERY
+        if chunk:
+            added, missed, films = import_chunk(chunk, user_ids, actor_ids, default_user)
+            imported, skipped = imported + added, skipped + missed
+            changes.extend(films)
+    finally:
+        # Put the triggers back even if the import failed part way (the chunks written so far stay)
+        if defer_indexes:
+            click.echo('Rebuilding indexes, search index and user stats...', err=True)
+            for shard in range(get_shard_count()):
+                restore_indexes_and_triggers(get_db_connection(shard))
+        # Tell the film change listeners (cached pages, similar films) about every film imported,
+        # and wait for the similar films to be refreshed before the command exits
+        if changes:
+            notify_films_changed(changes)
+            similar_films_updater.join()
+
+    report('Imported', imported, started)
+    if imported > REFRESH_MAX_FILMS:
+        click.echo("Run 'flask films similar' to find the similar films of the imported films", err=True)
+    if skipped:
+        click.echo(f'Skipped {skipped} rows with a bad value, no title or an unknown username', err=True)
+
+
+# User stats
+# =========================================================
+@films_cli.command('stats')
+def stats_command():
+    """Count every user's film stats again (they are normally kept up to date by triggers)."""
+    started = time.perf_counter()
+    users = sum(rebuild_user_stats(get_db_connection(shard)) for shard in range(get_shard_count()))
+    click.echo(f'Counted film stats for {users} users in {time.perf_counter() - started:.1f}s', err=True)
+
+
+# Change feed
+# =========================================================
+@films_cli.command('prune-changes')
+@click.option('--days', type=click.IntRange(min=0), help='Keep this many days of changes (default: CHANGES_RETENTION_DAYS).')
+def prune_changes_command(days):
+    """Delete change feed entries older than the retention period."""
+    if days is None:
+        days = current_app.config['CHANGES_RETENTION_DAYS']
+    deleted = sum(prune_changes(get_db_connection(shard), days) for shard in range(get_shard_count()))
+    click.echo(f'Deleted {deleted} changes older than {days} days', err=True)
+
+
+# Export
+# =========================================================
+@films_cli.command('export')
+@click.argument('file', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']), help='File format (default: from the file name, NDJSON for stdout).')
+@click.option('--user', 'username', help='Only export this user\'s films.')
+def export_command(file, file_format, username):
+    """Export films to a CSV or NDJSON FILE (default: stdout)."""
+    file_format = get_format(file_format, file)
+
+    query = f'''
+        SELECT users.username, {', '.join('films.' + field for field in FILM_FIELDS)},
+               (SELECT group_concat(actors.name, char(31)) FROM film_actors JOIN actors ON actors.id = film_actors.actor_id
+                WHERE film_actors.film_id = films.id) AS actors
+        FROM films
+        LEFT JOIN users ON users.id = films.user
+    '''
+    params = []
+    if username:
+        query += ' WHERE users.username = ?'
+        params.append(username)
+    query += ' ORDER BY films.id'
+
+    writer = None
+    if file_format == 'csv':
+        writer = csv.DictWriter(file, fieldnames=FILE_FIELDS)
+        writer.writeheader()
+
+    started = time.perf_counter()
+    exported = 0
+    # Iterating the cursors streams rows from SQLite one at a time (no fetchall), one shard after another
+    rows = (row for shard in range(get_shard_count()) for row in get_db_connection(shard).execute(query, params))
+    for row in rows:
+        film = dict(row)
+        film['watched'] = bool(film['watched'])
+        actors = film['actors'].split('\x1f') if film['actors'] else []
+        if writer:
+            film['actors'] = CSV_ACTOR_SEPARATOR.join(actors)
+            writer.writerow(film)
+        else:
+            film['actors'] = actors
+            file.write(json.dumps(film, ensure_ascii=False) + '\n')
+        exported += 1
+        if exported % PROGRESS_EVERY == 0:
+            report('Exported', exported, started)
+
+    file.flush()
+    report('Exported', exported, started)
@@ -0,0 +1,56 @@
+-- Change feed: one row for every film, film actor list and user that is added, changed or deleted
+-- The triggers write it in the same transaction as the change itself, so the feed can never miss
+-- a committed change (or show one that was rolled back). seq only ever goes up (AUTOINCREMENT never
+-- reuses a number), so a client that has seen everything up to seq N asks for the changes after N.
+--   entity       'film', 'film_actors' (entity_id is the film) or 'user'
+--   op           'insert', 'update' or 'delete'
+-- Old rows are pruned after CHANGES_RETENTION_DAYS (see prune_changes() in db.py).
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    entity TEXT NOT NULL,
+    entity_id INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    -- Milliseconds, so changes from different shards can be put in order
+    changed TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+);
+
+CREATE TRIGGER IF NOT EXISTS films_changes_insert AFTER INSERT ON films BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('film', new.id, 'insert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS films_changes_update AFTER UPDATE ON films BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('film', new.id, 'update');
+END;
+
+CREATE TRIGGER IF NOT EXISTS films_changes_delete AFTER DELETE ON films BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('film', old.id, 'delete');
+END;
+
+-- update_film_actors() deletes and inserts a row per actor, but one change per film is enough: nothing is
+-- written if the newest change is already this film's actors. Links removed along with their film
+-- (ON DELETE CASCADE) aren't written either, the film's own 'delete' covers them.
+CREATE TRIGGER IF NOT EXISTS film_actors_changes_insert AFTER INSERT ON film_actors BEGIN
+    INSERT INTO changes (entity, entity_id, op)
+    SELECT 'film_actors', new.film_id, 'update'
+    WHERE NOT EXISTS (SELECT 1 FROM changes WHERE seq = (SELECT max(seq) FROM changes) AND entity = 'film_actors' AND entity_id = new.film_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS film_actors_changes_delete AFTER DELETE ON film_actors BEGIN
+    INSERT INTO changes (entity, entity_id, op)
+    SELECT 'film_actors', old.film_id, 'update'
+    WHERE EXISTS (SELECT 1 FROM films WHERE id = old.film_id)
+      AND NOT EXISTS (SELECT 1 FROM changes WHERE seq = (SELECT max(seq) FROM changes) AND entity = 'film_actors' AND entity_id = old.film_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_changes_insert AFTER INSERT ON users BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('user', new.id, 'insert');
+END;
+
+-- Only the username is public (password hashes being upgraded aren't changes anyone needs to sync)
+CREATE TRIGGER IF NOT EXISTS users_changes_update AFTER UPDATE OF username ON users BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('user', new.id, 'update');
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_changes_delete AFTER DELETE ON users BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('user', old.id, 'delete');
+END;
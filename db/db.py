@@ -1,47 +1,779 @@
-from db.test_data import films_data # Import the test data
+import heapq
+import json
 import sqlite3
 import os
-from flask import abort
-from werkzeug.security import check_password_hash, generate_password_hash
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import islice
+from queue import LifoQueue, Empty, Full
+from flask import abort, current_app, g, has_app_context
+from db.auth import hash_password, check_password, needs_rehash
 
 # This defines which functions are available for import when using 'from db.db import *'
 __all__ = [
+    "init_app",
+    "get_pool_stats",
+    "add_film_change_listener",
+    "add_connection_listener",
+    "close_connections",
+    "warm_caches",
+    "transaction",
+    "write_transaction",
+    "DatabaseBusy",
+    "user_transaction",
+    "film_transaction",
+    "get_shard_paths",
+    "get_shard_count",
+    "is_sharded",
+    "get_user_shard",
+    "get_film_shard",
     "get_all_films",
+    "iter_films",
+    "get_films_page",
+    "make_film_cursor",
+    "parse_film_cursor",
     "get_film_by_id",
     "create_film",
     "update_film",
+    "bulk_update_films",
+    "FilmsNotOwned",
     "delete_film",
     "create_user",
     "validate_login",
     "get_user_by_username",
     "get_user_by_id",
-    "get_all_actors",
-    "update_film_actors",
-    "delete_film_actors"
+    "get_usernames",
+    "search_films",
+    "search_actors",
+    "get_actor",
+    "get_actor_films",
+    "get_films_for_actors",
+    "get_similar_films",
+    "get_user_stats",
+    "rebuild_user_stats",
+    "get_changes",
+    "get_latest_change_position",
+    "parse_change_position",
+    "prune_changes",
+    "prune_changes_if_due",
+    "ChangesExpired",
+    "update_film_actors"
 ]
 
-# Establish connection to the SQLite database
-def get_db_connection():
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    DB_PATH = os.path.join(BASE_DIR, 'database.db')
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Default location of the SQLite database (can be overridden with app.config['DATABASE'])
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, 'database.db')
+
+# Settings applied once to every new connection
+# WAL lets readers and the writer work at the same time, NORMAL sync is safe with WAL,
+# mmap and a bigger page cache cut down on read syscalls, busy_timeout waits for locks instead of failing
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16000,   # Negative value is in KiB, so this is ~16MB
+    'busy_timeout': 5000,   # Milliseconds
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',   # Needed for ON DELETE CASCADE
+}
+
+# Maximum number of idle connections each pool keeps around for reuse
+DB_POOL_SIZE = 8
+
+# Number of recent waits for a turn to write kept for the latency percentiles
+WRITE_WAIT_SAMPLES = 1000
+
+# Film IDs made on shard n start after n * SHARD_ID_SPAN, so a film's ID tells which shard it was
+# created on (and stays the same if its owner is moved to another shard)
+SHARD_ID_SPAN = 10 ** 12
+
+# Maximum number of user id -> username entries kept in memory
+USERNAME_CACHE_SIZE = 4096
+
+# Film list orderings that may be requested, mapped to (sort column, direction)
+# The film id is always added as a tie-breaker so keyset cursors are unique
+# Each one is served by an index in schema.sql, so listings are index range scans instead of sorts
+FILM_ORDERINGS = {
+    'title ASC': ('title', 'ASC'),
+    'title DESC': ('title', 'DESC'),
+    'created ASC': ('created', 'ASC'),
+    'created DESC': ('created', 'DESC'),
+}
+
+# Columns of the films table that can be selected one by one (eg: by the JSON API's ?fields=)
+FILM_COLUMNS = ('id', 'user', 'title', 'tagline', 'director', 'poster', 'release_year', 'genre',
+                'watched', 'rating', 'review', 'created', 'updated')
+
+# Number of words shown around each match in search result snippets
+SEARCH_SNIPPET_WORDS = 16
+
+# Characters that wrap the matched words in search titles/snippets
+# (the templates escape the text first, then turn these into <mark> tags)
+SEARCH_MARK_START = '\x02'
+SEARCH_MARK_END = '\x03'
+
+# Number of actors returned by search_actors() (the typeahead list)
+ACTOR_SEARCH_LIMIT = 10
+# Maximum number of actor name prefixes kept in memory, and seconds before they are looked up again
+# (actors are only added by imports, which may run in another process)
+ACTOR_PREFIX_CACHE_SIZE = 1024
+ACTOR_PREFIX_CACHE_SECONDS = 60
+
+# Film columns shown in actor filmographies (with the owner's username)
+ACTOR_FILM_COLUMNS = 'films.id, films.title, films.release_year, films.poster, films.genre, films.user, users.username AS username'
+# Maximum number of actors whose films are fetched by one query (SQLite allows 500 UNION ALL branches)
+ACTOR_BATCH_SIZE = 100
+
+# Columns a bulk edit can change, and the most films one bulk edit can change
+BULK_EDIT_COLUMNS = ('watched', 'rating', 'genre')
+BULK_EDIT_MAX_FILMS = 1000
+
+# Maximum number of changes read by one get_changes() call (the API's default and largest ?limit=)
+CHANGES_BATCH_SIZE = 500
+CHANGES_MAX_BATCH_SIZE = 5000
+# Days the change feed is kept for (app.config['CHANGES_RETENTION_DAYS']), and seconds between prunes
+CHANGES_RETENTION_DAYS = 7
+CHANGES_PRUNE_SECONDS = 60 * 60
+
+# Indexes on films, by name (also used to re-create them after a bulk import)
+FILM_INDEXES = {
+    'idx_films_title': 'CREATE INDEX IF NOT EXISTS idx_films_title ON films (title)',
+    'idx_films_created': 'CREATE INDEX IF NOT EXISTS idx_films_created ON films (created)',
+    'idx_films_user_title': 'CREATE INDEX IF NOT EXISTS idx_films_user_title ON films (user, title)',
+    'idx_films_user_created': 'CREATE INDEX IF NOT EXISTS idx_films_user_created ON films (user, created)',
+    'idx_films_director': 'CREATE INDEX IF NOT EXISTS idx_films_director ON films (director)',
+}
+
+# Schema changes for databases created before they were added to schema.sql
+# Every statement is safe to run again, they are applied once per database file
+SCHEMA_UPGRADES = [
+    *FILM_INDEXES.values(),
+    'CREATE INDEX IF NOT EXISTS idx_actors_name_key ON actors(name_key, name)',
+    'CREATE INDEX IF NOT EXISTS idx_film_actors_actor ON film_actors(actor_id, film_id)',
+    '''CREATE TABLE IF NOT EXISTS film_similar (
+        film_id INTEGER NOT NULL REFERENCES films(id) ON DELETE CASCADE,
+        similar_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (film_id, similar_id)
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS idx_film_similar_similar ON film_similar(similar_id)',
+    'CREATE TABLE IF NOT EXISTS user_shards (user_id INTEGER PRIMARY KEY, shard INTEGER NOT NULL)',
+    '''CREATE TABLE IF NOT EXISTS shard_moves (
+        user_id INTEGER PRIMARY KEY,
+        source INTEGER NOT NULL,
+        target INTEGER NOT NULL,
+        started TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS shard_info (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        shard INTEGER NOT NULL,
+        next_film_id INTEGER NOT NULL
+    )''',
+]
+
+# Columns added after the first version of schema.sql: (table, column, definition)
+# ALTER TABLE can't use CURRENT_TIMESTAMP as a default, so older rows have NULL until they are next updated
+SCHEMA_COLUMNS = [
+    ('films', 'updated', 'TIMESTAMP'),
+    ('actors', 'name_key', 'TEXT GENERATED ALWAYS AS (lower(trim(name))) VIRTUAL'),
+]
+
+
+# Connection pool
+# =========================================================
+# Keeps open connections to one database file so requests can reuse them
+# instead of opening (and re-configuring) a new connection every time
+# factory is the class of its connections (an app's DB_CONNECTION_FACTORY, eg: one that times every statement)
+class ConnectionPool:
+
+    def __init__(self, db_path, factory=sqlite3.Connection, writer=None, max_idle=DB_POOL_SIZE):
+        self.db_path = db_path
+        self.factory = factory
+        self.idle = LifoQueue(maxsize=max_idle)
+        self.lock = threading.Lock()
+        self.stats = {'opened': 0, 'closed': 0, 'acquired': 0, 'reused': 0, 'in_use': 0}
+        self.upgraded = False
+        # Queue for this process's writers to the file (see WriteCoordinator), shared by every pool for the file
+        self.writer = writer or WriteCoordinator()
+        # Set by get_pool() when the file is one of DATABASE_SHARDS (prepared on first use, see prepare_shard())
+        self.shard = None
+        self.catalogue_path = None
+        self.shard_prepared = False
+
+    # Open and configure a brand new connection
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=DB_PRAGMAS['busy_timeout'] / 1000, check_same_thread=False,
+                               factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        for name, value in DB_PRAGMAS.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        _connection_writers[id(conn)] = self.writer
+        with self.lock:
+            self.stats['opened'] += 1
+            if not self.upgraded:
+                upgrade_schema(conn)
+                self.upgraded = True
+        for listener in _connection_listeners:
+            listener(conn)
+        return conn
+
+    # Take an idle connection from the pool, or open one if none are free
+    def acquire(self):
+        try:
+            conn = self.idle.get_nowait()
+            reused = True
+        except Empty:
+            conn = self.connect()
+            reused = False
+        with self.lock:
+            self.stats['acquired'] += 1
+            self.stats['in_use'] += 1
+            if reused:
+                self.stats['reused'] += 1
+            if self.shard is not None and not self.shard_prepared:
+                prepare_shard(conn, self.shard, self.catalogue_path)
+                self.shard_prepared = True
+        return conn
+
+    # Give a connection back to the pool (closing it if the pool is already full)
+    def release(self, conn):
+        # Never hand a half-finished transaction to the next request
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            self.stats['in_use'] -= 1
+        try:
+            self.idle.put_nowait(conn)
+        except Full:
+            _connection_writers.pop(id(conn), None)
+            conn.close()
+            with self.lock:
+                self.stats['closed'] += 1
+
+    # Close the idle connections (eg: before a pre-fork server forks its workers)
+    def close_idle(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Empty:
+                return
+            _connection_writers.pop(id(conn), None)
+            conn.close()
+            with self.lock:
+                self.stats['closed'] += 1
+
+    # Start again with no connections in a forked process (the schema upgrade and shard set-up are kept)
+    # The parent's connections are left open but never used: closing them here could checkpoint
+    # (or remove) a WAL file the parent is still using
+    def forget_connections(self):
+        _inherited_connections.append(self.idle)
+        self.idle = LifoQueue(maxsize=self.idle.maxsize)
+        self.lock = threading.Lock()
+        self.writer = get_writer(self.db_path)
+        self.stats = {'opened': 0, 'closed': 0, 'acquired': 0, 'reused': 0, 'in_use': 0}
+
+    # Snapshot of the pool counters (and its writers' queue)
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['idle'] = self.idle.qsize()
+        stats['open'] = stats['opened'] - stats['closed']
+        stats['writes'] = self.writer.get_stats()
+        return stats
+
+
+# Write coordinator
+# =========================================================
+# SQLite lets one connection at a time write to a database file. Left to itself, every thread that
+# wants to write sends BEGIN IMMEDIATE and, while someone else holds the lock, SQLite's busy handler
+# sleeps and tries again with longer and longer sleeps: writers wait longer than they need to and,
+# under load, give up with 'database is locked'. Instead, a process's writers to each file queue
+# here (first come, first served) and only the writer whose turn it is asks SQLite for the lock.
+# Writers in other processes (eg: the other workers of a pre-fork server) still meet at SQLite's lock.
+class WriteCoordinator:
+
+    def __init__(self, timeout=DB_PRAGMAS['busy_timeout'] / 1000):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.waiters = deque()
+        self.busy = False
+        self.stats = {'writes': 0, 'timed_out': 0, 'max_queued': 0}
+        self.waits = deque(maxlen=WRITE_WAIT_SAMPLES)
+
+    # Wait for this thread's turn to write (raises DatabaseBusy after `timeout` seconds)
+    def acquire(self):
+        started = time.perf_counter()
+        waiter = None
+        with self.lock:
+            if self.busy:
+                waiter = threading.Event()
+                self.waiters.append(waiter)
+                self.stats['max_queued'] = max(self.stats['max_queued'], len(self.waiters))
+            else:
+                self.busy = True
+        if waiter is not None and not waiter.wait(self.timeout):
+            with self.lock:
+                # The turn may have been handed over just as the wait ran out
+                if not waiter.is_set():
+                    self.waiters.remove(waiter)
+                    self.stats['timed_out'] += 1
+                    raise DatabaseBusy(f'database is locked ({len(self.waiters)} more writers waiting)')
+        with self.lock:
+            self.stats['writes'] += 1
+            self.waits.append(time.perf_counter() - started)
+
+    # Hand the turn to the next writer in line
+    def release(self):
+        with self.lock:
+            if self.waiters:
+                self.waiters.popleft().set()
+            else:
+                self.busy = False
+
+    # Counters, writers waiting now and wait percentiles (in milliseconds)
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['queued'] = len(self.waiters)
+            stats['writing'] = self.busy
+            waits = sorted(self.waits)
+        for name, percentile in (('wait_p50_ms', 0.50), ('wait_p95_ms', 0.95), ('wait_p99_ms', 0.99)):
+            stats[name] = round(waits[int(percentile * (len(waits) - 1))] * 1000, 2) if waits else None
+        return stats
+
+# Raised when a write can't get the database's write lock in time (the request should be retried later)
+class DatabaseBusy(sqlite3.OperationalError):
+    pass
+
+# The write coordinator of each pooled connection's file (by id of the connection)
+_connection_writers = {}
+
+# Wait for this process's turn to write to a connection's database file
+# (connections that aren't from a pool, eg: in scripts, go straight to SQLite's lock)
+@contextmanager
+def write_turn(conn):
+    writer = _connection_writers.get(id(conn))
+    if writer is None:
+        yield
+        return
+    writer.acquire()
+    try:
+        yield
+    finally:
+        writer.release()
+
+# Write transaction on a connection: waits for this process's turn, takes SQLite's write lock
+# (BEGIN IMMEDIATE), then commits the with block (or rolls it back if anything fails), eg:
+#   with write_transaction(conn):
+#       conn.execute(...)
+@contextmanager
+def write_transaction(conn):
+    with write_turn(conn):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as error:
+            # Another process held the lock for longer than busy_timeout
+            if 'locked' in str(error):
+                raise DatabaseBusy(str(error)) from error
+            raise
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+# Functions called as listener(conn) for every new connection (eg: to trace or time its queries)
+_connection_listeners = []
+
+# Register a function to be called with every new database connection
+def add_connection_listener(listener):
+    _connection_listeners.append(listener)
+
+# Bring an existing database up to date with SCHEMA_COLUMNS, SCHEMA_UPGRADES and the search index
+# (a brand new file, eg: a shard that was just added to DATABASE_SHARDS, gets schema.sql first)
+def upgrade_schema(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'films'").fetchone() is None:
+        with open(os.path.join(BASE_DIR, 'schema.sql')) as f:
+            conn.executescript(f.read())
+    for table, column, definition in SCHEMA_COLUMNS:
+        # table_xinfo also lists generated columns (table_info leaves them out)
+        columns = [row['name'] for row in conn.execute(f'PRAGMA table_xinfo({table})')]
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    upgrade_film_actors(conn)
+    for statement in SCHEMA_UPGRADES:
+        conn.execute(statement)
+    conn.commit()
+    for name in ('search.sql', 'stats.sql', 'changes.sql'):
+        with open(os.path.join(BASE_DIR, name)) as f:
+            conn.executescript(f.read())
+
+
+# Older databases created film_actors without ON DELETE CASCADE, and SQLite can't change
+# a foreign key in place, so the table is rebuilt (search.sql re-creates its triggers afterwards)
+def upgrade_film_actors(conn):
+    foreign_keys = conn.execute('PRAGMA foreign_key_list(film_actors)').fetchall()
+    if not foreign_keys or all(fk['on_delete'] == 'CASCADE' for fk in foreign_keys):
+        return
+    conn.executescript('''
+        BEGIN;
+        CREATE TABLE film_actors_new (
+            film_id INTEGER NOT NULL,
+            actor_id INTEGER NOT NULL,
+            PRIMARY KEY (film_id, actor_id),
+            FOREIGN KEY (film_id) REFERENCES films(id) ON DELETE CASCADE,
+            FOREIGN KEY (actor_id) REFERENCES actors(id) ON DELETE CASCADE
+        );
+        INSERT INTO film_actors_new (film_id, actor_id)
+            SELECT film_id, actor_id FROM film_actors
+            WHERE film_id IN (SELECT id FROM films) AND actor_id IN (SELECT id FROM actors);
+        DROP TABLE film_actors;
+        ALTER TABLE film_actors_new RENAME TO film_actors;
+        COMMIT;
+    ''')
+
+
+# One pool per database file and connection class, with one WriteCoordinator per file
+_pools = {}
+_writers = {}
+_pools_lock = threading.Lock()
+
+# Connections used outside of a Flask app context (scripts, shell) are kept per thread (by database file)
+_thread_conns = threading.local()
+
+# Connections a forked process got from its parent (kept so they are never closed, see forget_connections())
+_inherited_connections = []
+
+# SQLite connections must not be used across a fork, so a forked process (eg: a pre-fork server's worker)
+# starts with empty pools and opens its own connections on first use
+def forget_connections_after_fork():
+    global _pools_lock, _thread_conns
+    _pools_lock = threading.Lock()
+    _connection_writers.clear()
+    _writers.clear()
+    _inherited_connections.append(getattr(_thread_conns, 'conns', None))
+    _thread_conns = threading.local()
+    for pool in _pools.values():
+        pool.forget_connections()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget_connections_after_fork)
+
+# Close every idle connection in this process, and this thread's own ones (used outside a request)
+# A pre-fork server's master calls this (through preload.warm_up()) before forking its workers
+def close_connections():
+    for pool, conn in getattr(_thread_conns, 'conns', {}).values():
+        pool.release(conn)
+    _thread_conns.conns = {}
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_idle()
+
+# Get the WriteCoordinator for a database file (the caller holds _pools_lock)
+def get_writer(db_path):
+    if db_path not in _writers:
+        _writers[db_path] = WriteCoordinator()
+    return _writers[db_path]
+
+# Get (or create) the pool for a database file
+# shard is the file's position in DATABASE_SHARDS, so it is prepared as that shard before its first use
+# Each app gets connections of its own DB_CONNECTION_FACTORY class (plain sqlite3.Connection outside an app)
+def get_pool(db_path=None, shard=None):
+    if db_path is None:
+        db_path = get_database_path()
+    factory = current_app.config.get('DB_CONNECTION_FACTORY', sqlite3.Connection) if has_app_context() else sqlite3.Connection
+    with _pools_lock:
+        if (db_path, factory) not in _pools:
+            _pools[db_path, factory] = ConnectionPool(db_path, factory, get_writer(db_path))
+        pool = _pools[db_path, factory]
+    if shard is not None and pool.shard is None:
+        with pool.lock:
+            pool.shard, pool.catalogue_path = shard, get_database_path()
+    return pool
+
+# Get the pool counters for every database file
+def get_pool_stats():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.db_path if pool.factory is sqlite3.Connection else f'{pool.db_path} ({pool.factory.__name__})': pool.get_stats()
+            for pool in pools}
+
+# Get the connection to the SQLite database: the catalogue (DATABASE: users, actors) by default,
+# or the shard with that number (see get_user_shard() and get_film_shard())
+# Inside a request the same connection is shared by every helper and returned at teardown,
+# outside a request each thread keeps its own connection open
+# Without DATABASE_SHARDS, shard 0 is DATABASE itself, so every call gets the same connection
+def get_db_connection(shard=None):
+    db_path = get_database_path() if shard is None else get_shard_paths()[shard]
+    if has_app_context():
+        conns = g.setdefault('db_conns', {})
+    else:
+        conns = getattr(_thread_conns, 'conns', None)
+        if conns is None:
+            conns = _thread_conns.conns = {}
+    if db_path not in conns:
+        pool = get_pool(db_path, shard if is_sharded() else None)
+        conns[db_path] = (pool, pool.acquire())
+    return conns[db_path][1]
+
+# Return the request's connections to their pools when the app context ends
+def release_db_connection(exception=None):
+    for pool, conn in g.pop('db_conns', {}).values():
+        pool.release(conn)
+
+# Register the database teardown with a Flask app
+def init_app(app):
+    app.config.setdefault('DATABASE', DB_PATH)
+    app.config.setdefault('DATABASE_SHARDS', [])
+    app.config.setdefault('DB_CONNECTION_FACTORY', sqlite3.Connection)
+    app.config.setdefault('CHANGES_RETENTION_DAYS', CHANGES_RETENTION_DAYS)
+    app.teardown_appcontext(release_db_connection)
+
+
+# Shards
+# =========================================================
+# SQLite has one writer per file, so films can be split across several files (DATABASE_SHARDS) to
+# write to them at the same time. Each user's films (with their actor links, similar films, stats,
+# search index and change feed) live on one shard, found in the catalogue's user_shards table.
+# Users and actors belong to the catalogue (DATABASE), and every shard keeps a copy of them so its
+# joins, foreign keys and search triggers work as they do in a single database. Lists across all
+# users (the home page, all films, search, actor pages) ask every shard and merge the results.
+# 'flask films move-user' moves a user to another shard (see db/shards.py).
+def get_database_path():
+    return current_app.config.get('DATABASE', DB_PATH) if has_app_context() else DB_PATH
+
+# The shard files in order (without DATABASE_SHARDS there is one shard: DATABASE)
+def get_shard_paths():
+    shards = current_app.config.get('DATABASE_SHARDS') if has_app_context() else None
+    return list(shards) if shards else [get_database_path()]
+
+def get_shard_count():
+    return len(get_shard_paths())
+
+# Whether films are kept apart from the catalogue (DATABASE_SHARDS is set)
+def is_sharded():
+    return get_shard_paths() != [get_database_path()]
+
+# Get the shard holding a user's films
+# New users are spread across the shards by ID (see create_user()), users from before sharding was
+# switched on have no user_shards row and stay on shard 0. Lookups are remembered for the request,
+# cached=False always reads user_shards (eg: to check the user hasn't just been moved)
+def get_user_shard(user_id, cached=True):
+    if not is_sharded():
+        return 0
+    user_id = int(user_id)
+    request_cache = g.setdefault('user_shards', {}) if has_app_context() else {}
+    if cached and user_id in request_cache:
+        return request_cache[user_id]
+    row = get_db_connection().execute('SELECT shard FROM user_shards WHERE user_id = ?', (user_id,)).fetchone()
+    request_cache[user_id] = row['shard'] if row else 0
+    return request_cache[user_id]
+
+# Get the shard holding a film: the one its ID was made on, unless its owner has since moved
+# (then the other shards are checked); a film that doesn't exist is looked for on the shard of its ID
+def get_film_shard(film_id, cached=True):
+    if not is_sharded():
+        return 0
+    film_id = int(film_id)
+    request_cache = g.setdefault('film_shards', {}) if has_app_context() else {}
+    if cached and film_id in request_cache:
+        return request_cache[film_id]
+    count = get_shard_count()
+    origin = min(max(film_id - 1, 0) // SHARD_ID_SPAN, count - 1)
+    shard = origin
+    for candidate in [origin] + [other for other in range(count) if other != origin]:
+        if get_db_connection(candidate).execute('SELECT 1 FROM films WHERE id = ?', (film_id,)).fetchone():
+            shard = candidate
+            break
+    request_cache[film_id] = shard
+    return shard
+
+# Forget the user/film shards looked up during this request (eg: after moving a user)
+def forget_shard_lookups():
+    if has_app_context():
+        g.pop('user_shards', None)
+        g.pop('film_shards', None)
+
+# Get ready to use a database file as a shard: check it is the right one, set up its film ID range,
+# and copy any users/actors it is missing from the catalogue (create_user() and imports copy new ones)
+def prepare_shard(conn, shard, catalogue_path):
+    row = conn.execute('SELECT shard FROM shard_info').fetchone()
+    if row is not None and row['shard'] != shard:
+        raise RuntimeError(f'Database file holds shard {row["shard"]}, but DATABASE_SHARDS lists it as shard {shard}')
+    base = shard * SHARD_ID_SPAN
+    conn.execute('''
+        INSERT OR IGNORE INTO shard_info (id, shard, next_film_id)
+        VALUES (0, ?, coalesce((SELECT max(id) FROM films WHERE id > ? AND id <= ?), ?) + 1)
+    ''', (shard, base, base + SHARD_ID_SPAN, base))
+    conn.commit()
+
+    if os.path.abspath(conn.execute('PRAGMA database_list').fetchone()['file']) == os.path.abspath(catalogue_path):
+        return
+    conn.execute('ATTACH DATABASE ? AS catalogue', (catalogue_path,))
+    try:
+        conn.execute('''
+            INSERT INTO main.users (id, username, password)
+            SELECT id, username, '' FROM catalogue.users WHERE id > (SELECT coalesce(max(id), 0) FROM main.users)
+        ''')
+        conn.execute('''
+            INSERT INTO main.actors (id, name, birth_year, height)
+            SELECT id, name, birth_year, height FROM catalogue.actors WHERE id > (SELECT coalesce(max(id), 0) FROM main.actors)
+        ''')
+        conn.commit()
+    finally:
+        conn.execute('DETACH DATABASE catalogue')
+
+# Run a statement for every row of params_list on every shard except the catalogue itself
+# (keeps the shards' copies of users and actors up to date)
+def copy_to_shards(sql, params_list):
+    if not is_sharded():
+        return
+    catalogue = get_db_connection()
+    for shard in range(get_shard_count()):
+        conn = get_db_connection(shard)
+        if conn is not catalogue:
+            with transaction(shard):
+                conn.executemany(sql, params_list)
+
+# Reserve `count` film IDs on a shard, returns the first one
+# Returns None when the database isn't a shard (then SQLite's AUTOINCREMENT picks IDs as usual)
+def allocate_film_ids(conn, count=1):
+    row = conn.execute('UPDATE shard_info SET next_film_id = next_film_id + ? RETURNING next_film_id - ? AS first_id',
+                       (count, count)).fetchone()
+    return row['first_id'] if row else None
+
+# Run a film query on the shard holding a user's films, or on every shard when user is None
+# Each shard's rows are already in order, so they are merged by `key` (descending when reverse is True)
+# and cut to `limit`, eg: the newest 5 films of all are among the newest 5 of each shard
+def query_shards(user, query, params, key, reverse=False, limit=None):
+    if user:
+        return get_db_connection(get_user_shard(user)).execute(query, params).fetchall()
+    results = [get_db_connection(shard).execute(query, params).fetchall() for shard in range(get_shard_count())]
+    if len(results) == 1:
+        return results[0]
+    return list(islice(heapq.merge(*results, key=key, reverse=reverse), limit))
+
+# Film change listeners
+# =========================================================
+# Functions called as listener(changes) after films or their actors are changed, where changes is a
+# list of (film_id, user_id) pairs: one call for everything a transaction changed (eg: a bulk edit),
+# so a batch of films makes each cached page stale once
+# (used to invalidate cached pages without db.py having to know about the cache)
+_film_change_listeners = []
+
+# Register a function to be called whenever films change
+def add_film_change_listener(listener):
+    _film_change_listeners.append(listener)
+
+# Tell every listener that some films have changed
+def notify_films_changed(changes):
+    for listener in _film_change_listeners:
+        listener(changes)
+
+# Film changes made inside a transaction() are held back until it commits, so nothing sees a change
+# that might still be rolled back (keyed by id of the connection, each a dict of {(film_id, user_id): True})
+_pending_changes = {}
+
+# Record that a film has changed: listeners are told straight away, or when the transaction commits
+def film_changed(conn, film_id, user_id):
+    pending = _pending_changes.get(id(conn))
+    if pending is None:
+        notify_films_changed([(film_id, user_id)])
+    else:
+        pending[(film_id, user_id)] = True
+
+# Unit of work: everything done with the connection inside the with block is committed
+# together, or rolled back together if anything fails, eg:
+#   with transaction() as conn:
+#       conn.execute(...)
+# A transaction() inside another one just joins the outer transaction
+# shard picks the database as get_db_connection() does (default: the catalogue)
+@contextmanager
+def transaction(shard=None):
+    conn = get_db_connection(shard)
+    if conn.in_transaction:
+        yield conn
+        return
+
+    # IMMEDIATE takes the write lock straight away, instead of failing with
+    # 'database is locked' if another writer gets in between our read and our write
+    with notify_after_commit(conn), write_transaction(conn):
+        yield conn
+
+# Tell the film change listeners about the changes made in the with block once it is over
+# (after the commit and after the write lock is let go, as listeners may write too), or forget them if it fails
+@contextmanager
+def notify_after_commit(conn):
+    _pending_changes[id(conn)] = {}
+    try:
+        yield
+    finally:
+        changes = list(_pending_changes.pop(id(conn), {}))
+    if changes:
+        notify_films_changed(changes)
+
+# A transaction() on the shard found by find_shard(). Once the shard's write lock is held,
+# holds(conn, shard) checks the data is still there: if it was moved to another shard while
+# waiting for the lock, the transaction starts again on the new one
+@contextmanager
+def routed_transaction(find_shard, holds):
+    while True:
+        shard = find_shard()
+        conn = get_db_connection(shard)
+        if conn.in_transaction:
+            yield conn
+            return
+        with notify_after_commit(conn), write_transaction(conn):
+            if not is_sharded() or holds(conn, shard):
+                yield conn
+                return
+
+# A transaction on the shard holding a user's films, eg: with user_transaction(user_id) as conn:
+def user_transaction(user_id):
+    return routed_transaction(lambda: get_user_shard(user_id),
+                              lambda conn, shard: get_user_shard(user_id, cached=False) == shard)
+
+# A transaction on the shard holding a film
+def film_transaction(film_id):
+    return routed_transaction(lambda: get_film_shard(film_id),
+                              lambda conn, shard: (conn.execute('SELECT 1 FROM films WHERE id = ?', (film_id,)).fetchone() is not None
+                                                   or get_film_shard(film_id, cached=False) == shard))
+
+# Get the ID of the user who owns a film (None if the film doesn't exist)
+def get_film_owner(film_id):
+    conn = get_db_connection(get_film_shard(film_id))
+    row = conn.execute('SELECT user FROM films WHERE id = ?', (film_id,)).fetchone()
+    return row['user'] if row else None
+
 
 # Authentication functions
 # =========================================================
 # Insert a new user (Register)
+# The password is hashed in the hashing pool (raises HashingBusy if it is full)
+# With DATABASE_SHARDS, the user is given a shard and copied to every shard (without the password hash)
 def create_user(username, password):
-    hashed_password = generate_password_hash(password)
-    conn = get_db_connection()
-    conn.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, hashed_password))
-    conn.commit()
-    conn.close()
+    hashed_password = hash_password(password)
+    with transaction() as conn:
+        user_id = conn.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, hashed_password)).lastrowid
+        if is_sharded():
+            conn.execute('INSERT INTO user_shards (user_id, shard) VALUES (?, ?)', (user_id, user_id % get_shard_count()))
+    copy_to_shards("INSERT OR IGNORE INTO users (id, username, password) VALUES (?, ?, '')", [(user_id, username)])
 
 # Validate user exists with password (Login)
+# The password is checked in the hashing pool (raises HashingBusy if it is full), and the stored
+# hash is upgraded if it was made with older settings than PASSWORD_HASH_METHOD
 def validate_login(username, password):
     user = get_user_by_username(username)
-    if user and check_password_hash(user['password'], password):
+    if user and check_password(user['password'], password):
+        if needs_rehash(user['password']):
+            password_hash = hash_password(password)
+            with transaction() as conn:
+                conn.execute('UPDATE users SET password = ? WHERE id = ?', (password_hash, user['id']))
         return user
     return None
 
@@ -49,49 +781,208 @@ def validate_login(username, password):
 def get_user_by_username(username):
     conn = get_db_connection()
     user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-    conn.close()
     return user
 
-# Get user by ID
+# Get user by ID (never includes the password hash)
 def get_user_by_id(user_id):
     conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
+    user = conn.execute('SELECT id, username FROM users WHERE id = ?', (user_id,)).fetchone()
     if user is None:
         abort(404)
     return user
 
+# Username lookups
+# =========================================================
+# Usernames never change once registered, so they are kept in a process-wide LRU cache
+_username_cache = OrderedDict()
+_username_cache_lock = threading.Lock()
+
+# Get usernames for many user IDs at once, returns a dict of {user_id: username}
+# Anything not already cached (for this request or the process) is loaded with a single IN query
+def get_usernames(user_ids):
+    user_ids = {int(user_id) for user_id in user_ids if user_id is not None}
+
+    # Usernames already resolved during this request
+    request_cache = g.setdefault('usernames', {}) if has_app_context() else {}
+    usernames = {user_id: request_cache[user_id] for user_id in user_ids if user_id in request_cache}
+
+    # Then the process-wide LRU cache
+    with _username_cache_lock:
+        for user_id in user_ids - usernames.keys():
+            if user_id in _username_cache:
+                _username_cache.move_to_end(user_id)
+                usernames[user_id] = _username_cache[user_id]
+
+    # Finally, one query for everything that is left
+    missing = list(user_ids - usernames.keys())
+    if missing:
+        conn = get_db_connection()
+        placeholders = ', '.join('?' * len(missing))
+        rows = conn.execute(f'SELECT id, username FROM users WHERE id IN ({placeholders})', missing).fetchall()
+        with _username_cache_lock:
+            for row in rows:
+                usernames[row['id']] = row['username']
+                _username_cache[row['id']] = row['username']
+                _username_cache.move_to_end(row['id'])
+            while len(_username_cache) > USERNAME_CACHE_SIZE:
+                _username_cache.popitem(last=False)
+
+    request_cache.update(usernames)
+    return usernames
+
+# Fill the in-memory caches before any requests come in (see preload.py): the usernames of the users
+# with the most films, and the actor typeahead's one-letter prefixes (which also reads the actor name
+# index into the OS page cache, shared by every process). Returns {'usernames': n, 'actor_prefixes': n}
+def warm_caches(usernames=USERNAME_CACHE_SIZE):
+    counts = []
+    for shard in range(get_shard_count()):
+        counts.extend(get_db_connection(shard).execute(
+            "SELECT count, user FROM user_film_stats WHERE stat = 'total' ORDER BY count DESC LIMIT ?", (usernames,)))
+    # Loaded fewest films first, so the busiest users are the last to be dropped from the LRU cache
+    user_ids = [row['user'] for row in reversed(heapq.nlargest(usernames, counts, key=lambda row: row['count']))]
+    with _username_cache_lock:
+        _username_cache.clear()
+    for start in range(0, len(user_ids), 500):
+        get_usernames(user_ids[start:start + 500])
+
+    letters = [row['letter'] for row in get_db_connection().execute(
+        'SELECT DISTINCT substr(name_key, 1, 1) AS letter FROM actors WHERE name_key IS NOT NULL ORDER BY letter')]
+    for letter in letters:
+        search_actors(letter)
+    return {'usernames': len(user_ids), 'actor_prefixes': len(letters)}
+
 # Film Display functions
 # =========================================================
 # Get all films (or filter by user)
-def get_all_films(user=None, limit=None, order_by='title ASC'):
-    conn = get_db_connection()
+# Set with_username=True to also get the owner's name as film['username'] (via a JOIN)
+# order_by must be one of FILM_ORDERINGS; after/before are cursors from make_film_cursor()
+# and return the films that come after/before that position in the ordering (keyset pagination)
+def get_all_films(user=None, limit=None, order_by='title ASC', with_username=False, after=None, before=None):
+    query, params, reverse = build_films_query(None, user, limit, order_by, with_username, after, before)
+
+    # Execute the query (on the user's shard, or on every shard)
+    key, descending = film_sort_key(order_by, reverse)
+    films = query_shards(user, query, params, key, descending, limit)
+    if reverse:
+        films.reverse()
+
+    return films
+
+# Get films as the database cursor itself, which fetches one row at a time as it is iterated,
+# so any number of films can be sent without holding them all in memory
+# columns limits the SELECT to those FILM_COLUMNS (the id and the ordering's column are always included)
+# (with several shards, their cursors are merged as they are read)
+def iter_films(user=None, columns=None, limit=None, order_by='title ASC', with_username=False, after=None):
+    query, params, reverse = build_films_query(columns, user, limit, order_by, with_username, after, None)
+    if user or get_shard_count() == 1:
+        return get_db_connection(get_user_shard(user) if user else 0).execute(query, params)
+    key, descending = film_sort_key(order_by, reverse)
+    cursors = [get_db_connection(shard).execute(query, params) for shard in range(get_shard_count())]
+    return islice(heapq.merge(*cursors, key=key, reverse=descending), limit)
+
+# The sort key of a film row in an ordering (for merging shards), and whether it is descending
+# (reverse is build_films_query()'s flag for rows that come back backwards)
+def film_sort_key(order_by, reverse=False):
+    column, direction = FILM_ORDERINGS[order_by]
+    return (lambda film: (film[column], film['id'])), (direction == 'DESC') != reverse
+
+# Build the SELECT used by get_all_films() and iter_films(), returns (query, params, reverse)
+# reverse is True when the rows come back in reverse order (paging backwards with before)
+def build_films_query(columns, user, limit, order_by, with_username, after, before):
+    if order_by not in FILM_ORDERINGS:
+        raise ValueError(f'Unsupported film ordering: {order_by}')
+    column, direction = FILM_ORDERINGS[order_by]
+
     # Construct base query
-    query = 'SELECT * FROM films'
+    selected = select_film_columns(columns, required=('id', column))
+    if with_username:
+        query = f'SELECT {selected}, users.username AS username FROM films LEFT JOIN users ON users.id = films.user'
+    else:
+        query = f'SELECT {selected} FROM films'
+    conditions = []
+    params = []
     # If user is specified, filter films by that user
     if user:
-        query += ' WHERE user = ?'
-    # Add ORDER BY to the query
-    query += f' ORDER BY {order_by}'
+        conditions.append('films.user = ?')
+        params.append(user)
+
+    # Paging backwards walks the ordering in reverse, then flips the results back at the end
+    reverse = before is not None
+    if reverse:
+        direction = 'DESC' if direction == 'ASC' else 'ASC'
+    cursor = before if reverse else after
+    if cursor is not None:
+        comparison = '>' if direction == 'ASC' else '<'
+        conditions.append(f'(films.{column}, films.id) {comparison} (?, ?)')
+        params.extend(cursor)
+
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    # Add ORDER BY to the query (the id keeps the order stable for films with the same title/date)
+    query += f' ORDER BY films.{column} {direction}, films.id {direction}'
     # Add LIMIT if specified
     if limit:
-        query += f' LIMIT {limit}'
+        query += ' LIMIT ?'
+        params.append(int(limit))
 
-    # Execute the query
-    if user:
-        films = conn.execute(query, (user,)).fetchall()
+    return query, params, reverse
+
+# The films columns to SELECT: all of them when columns is None, otherwise just those FILM_COLUMNS
+# plus the required ones, raises ValueError for anything that isn't a film column
+def select_film_columns(columns, required=('id',)):
+    if columns is None:
+        return 'films.*'
+    unknown = set(columns) - set(FILM_COLUMNS)
+    if unknown:
+        raise ValueError(f'Unknown film columns: {", ".join(sorted(unknown))}')
+    # Column names are only ever taken from FILM_COLUMNS, never from the request
+    return ', '.join(f'films.{name}' for name in FILM_COLUMNS if name in required or name in columns)
+
+# Build a cursor string ("<sort value>,<id>") for a film's position in an ordering
+def make_film_cursor(film, order_by='title ASC'):
+    column, direction = FILM_ORDERINGS[order_by]
+    return f"{film[column]},{film['id']}"
+
+# Turn a cursor string back into a (sort value, id) pair, raises ValueError if it is malformed
+def parse_film_cursor(cursor):
+    if cursor is None:
+        return None
+    # Titles can contain commas, so the id is whatever follows the last one
+    value, film_id = cursor.rsplit(',', 1)
+    return value, int(film_id)
+
+# Get one page of films plus the cursors for the next/previous pages (None when there are none)
+def get_films_page(user=None, page_size=24, order_by='title ASC', with_username=False, after=None, before=None):
+    # Ask for one extra film to find out whether there is another page
+    films = get_all_films(user, limit=page_size + 1, order_by=order_by, with_username=with_username,
+                          after=parse_film_cursor(after), before=parse_film_cursor(before))
+    more = len(films) > page_size
+    if before is not None:
+        films = films[-page_size:] if more else films
+        has_prev, has_next = more, True
     else:
-        films = conn.execute(query).fetchall()
+        films = films[:page_size]
+        has_prev, has_next = after is not None, more
 
-    conn.close()
-    
-    return films
+    next_cursor = make_film_cursor(films[-1], order_by) if films and has_next else None
+    prev_cursor = make_film_cursor(films[0], order_by) if films and has_prev else None
+    return films, next_cursor, prev_cursor
 
 # Get a film by its ID
-def get_film_by_id(film_id, include_actors=True):
-    conn = get_db_connection()
-    film = conn.execute('SELECT * FROM films WHERE id = ?', (film_id,)).fetchone()
-    conn.close()
+# Set with_username=True to also get the owner's name as film['username'] (via a JOIN)
+# columns limits the SELECT to those FILM_COLUMNS, like iter_films() (the id is always included)
+def get_film_by_id(film_id, include_actors=True, with_username=False, columns=None):
+    conn = get_db_connection(get_film_shard(film_id))
+    selected = select_film_columns(columns)
+    if with_username:
+        film = conn.execute(f'''
+            SELECT {selected}, users.username AS username
+            FROM films
+            LEFT JOIN users ON users.id = films.user
+            WHERE films.id = ?
+        ''', (film_id,)).fetchone()
+    else:
+        film = conn.execute(f'SELECT {selected} FROM films WHERE films.id = ?', (film_id,)).fetchone()
 
     if not include_actors:
         return film
@@ -102,81 +993,450 @@ def get_film_by_id(film_id, include_actors=True):
     return film, film_actors, film_actor_ids
 
 
+# Get the films similar to a film ("You might also like"), best first
+# They are worked out ahead of time by db/similar.py, so this is one lookup on film_similar's primary key
+def get_similar_films(film_id):
+    conn = get_db_connection(get_film_shard(film_id))
+    return conn.execute('''
+        SELECT films.id, films.title, films.release_year, films.poster, films.genre
+        FROM film_similar
+        JOIN films ON films.id = film_similar.similar_id
+        WHERE film_similar.film_id = ?
+        ORDER BY film_similar.score DESC
+    ''', (film_id,)).fetchall()
+
+
+# User stats functions
+# =========================================================
+# Stats kept in user_film_stats are returned in this order, with their values sorted like this
+USER_STATS_ORDER = {
+    'genre': lambda item: (-item[1], item[0]),
+    'watched': lambda item: item[0],
+    'rating': lambda item: (item[0] == '', int(item[0] or 0)),
+    'decade': lambda item: (item[0] == '', int(item[0] or 0)),
+}
+
+# Get a user's film statistics from user_film_stats (one primary key range, however many films they have)
+# Returns {'total': 12, 'genre': [('Drama', 5), ...], 'watched': [('0', 4), ('1', 8)], 'rating': [...], 'decade': [...]}
+def get_user_stats(user_id):
+    conn = get_db_connection(get_user_shard(user_id))
+    rows = conn.execute('SELECT stat, value, count FROM user_film_stats WHERE user = ?', (user_id,)).fetchall()
+    stats = {'total': 0, **{stat: [] for stat in USER_STATS_ORDER}}
+    for row in rows:
+        if row['stat'] == 'total':
+            stats['total'] = row['count']
+        elif row['stat'] in stats:
+            stats[row['stat']].append((row['value'], row['count']))
+    for stat, key in USER_STATS_ORDER.items():
+        stats[stat].sort(key=key)
+    return stats
+
+# Count every film again (stats.sql refills user_film_stats when it is empty), in one transaction
+def rebuild_user_stats(conn):
+    with open(os.path.join(BASE_DIR, 'stats.sql')) as f:
+        script = f.read()
+    with write_turn(conn):
+        conn.executescript('BEGIN IMMEDIATE; DELETE FROM user_film_stats;' + script + 'COMMIT;')
+    return conn.execute("SELECT count(DISTINCT user) FROM user_film_stats").fetchone()[0]
+
+
+# Change feed functions
+# =========================================================
+# Raised when a client asks for changes that have already been pruned (it has to fetch everything again)
+class ChangesExpired(Exception):
+    pass
+
+# A position in the change feed is the last seq seen on each shard: '120' with one shard, '120.87.93' with three
+def parse_change_position(position):
+    seqs = [int(seq) for seq in str(position).split('.')]
+    if len(seqs) != get_shard_count() or min(seqs) < 0:
+        raise ValueError(f'Invalid change feed position: {position}')
+    return seqs
+
+def format_change_position(seqs):
+    return seqs[0] if len(seqs) == 1 else '.'.join(str(seq) for seq in seqs)
+
+# The seq of the newest change ever written on a shard (0 if there are none)
+def get_latest_change_seq(conn):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return row['seq'] if row else 0
+
+# The position of the newest change, a client's starting point before a full sync
+def get_latest_change_position():
+    return format_change_position([get_latest_change_seq(get_db_connection(shard)) for shard in range(get_shard_count())])
+
+# Get the changes after position `since` (from parse_change_position()), compacted so each film/film's
+# actors/user appears once with its latest op (a film inserted then updated is still an 'insert'), oldest first
+# Returns (changes, next_since, has_more); at most `limit` changes are read, `next_since` is where to carry on
+# Raises ChangesExpired if changes after `since` have been pruned
+def get_changes(since, limit=CHANGES_BATCH_SIZE):
+    rows = []
+    for shard, shard_since in enumerate(since):
+        conn = get_db_connection(shard)
+        latest = get_latest_change_seq(conn)
+        shard_rows = conn.execute('''
+            SELECT seq, entity, entity_id, op, changed FROM changes
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?
+        ''', (shard_since, limit + 1)).fetchall()
+
+        # seq has no gaps (a rolled back change rolls back its number too), so a missing
+        # seq after `since` means it was pruned
+        if shard_since < latest and (not shard_rows or shard_rows[0]['seq'] != shard_since + 1):
+            raise ChangesExpired(since)
+        rows.extend((shard, row) for row in shard_rows)
+
+    # Changes from several shards are interleaved by time (each shard's stay in seq order)
+    if len(since) > 1:
+        rows.sort(key=lambda item: (item[1]['changed'], item[0], item[1]['seq']))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_since = list(since)
+    compacted = {}
+    for shard, row in rows:
+        next_since[shard] = row['seq']
+        # Shards each keep a copy of the users, so a user's change is listed once for all of them
+        key = (row['entity'], row['entity_id'])
+        # pop() so the entry moves to the end, keeping the list in order of each one's latest change
+        previous = compacted.pop(key, None)
+        op = row['op']
+        if previous is not None and previous['op'] == 'insert' and op == 'update':
+            op = 'insert'
+        if key[0] == 'film' and op == 'delete':
+            # A deleted film's actors don't need syncing any more
+            compacted.pop(('film_actors', key[1]), None)
+        compacted[key] = {'seq': format_change_position(next_since), 'entity': row['entity'], 'id': row['entity_id'],
+                          'op': op, 'changed': row['changed']}
+
+    return list(compacted.values()), format_change_position(next_since), has_more
+
+# Delete changes older than `retention_days` (seq follows time, so this reads from the oldest change
+# up to the first one worth keeping, no index on 'changed' needed), returns the number deleted
+def prune_changes(conn, retention_days):
+    with write_transaction(conn):
+        cursor = conn.execute('''
+            DELETE FROM changes
+            WHERE seq < coalesce((SELECT seq FROM changes WHERE changed >= datetime('now', ?) ORDER BY seq LIMIT 1),
+                                 (SELECT max(seq) + 1 FROM changes))
+        ''', (f'-{retention_days} days',))
+    return cursor.rowcount
+
+# Prune a database's change feed at most once every CHANGES_PRUNE_SECONDS
+# (called by the similar films updater's background thread after films change, see db/similar.py)
+_last_changes_prunes = {}
+_changes_prune_lock = threading.Lock()
+
+def prune_changes_if_due(db_path, retention_days):
+    with _changes_prune_lock:
+        if time.monotonic() - _last_changes_prunes.get(db_path, float('-inf')) < CHANGES_PRUNE_SECONDS:
+            return 0
+        _last_changes_prunes[db_path] = time.monotonic()
+    pool = get_pool(db_path)
+    conn = pool.acquire()
+    try:
+        return prune_changes(conn, retention_days)
+    finally:
+        pool.release(conn)
+
+
+# Film Search functions
+# =========================================================
+# Turn what the user typed into an FTS5 query: every word must match, and the last
+# word also matches as a prefix so results appear while a word is still being typed
+def make_search_query(query):
+    words = ''.join(ch if ch.isalnum() else ' ' for ch in query).split()
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+# Search films by title, tagline, director, genre, review and actor names (optionally for one user)
+# Returns (results, next_cursor); results are ranked best first (bm25) and each one has the film
+# columns plus 'title_marked' and 'snippet' with the matched words wrapped in SEARCH_MARK_START/END
+def search_films(query, user=None, limit=20, cursor=None):
+    match = make_search_query(query)
+    if match is None:
+        return [], None
+
+    sql = f'''
+        SELECT films.*, users.username AS username,
+               films_fts.rank AS search_rank,
+               highlight(films_fts, 0, ?, ?) AS title_marked,
+               snippet(films_fts, -1, ?, ?, '…', {SEARCH_SNIPPET_WORDS}) AS snippet
+        FROM films_fts
+        JOIN films ON films.id = films_fts.rowid
+        LEFT JOIN users ON users.id = films.user
+        WHERE films_fts MATCH ?
+    '''
+    params = [SEARCH_MARK_START, SEARCH_MARK_END, SEARCH_MARK_START, SEARCH_MARK_END, match]
+    # If user is specified, only search that user's films
+    if user:
+        sql += ' AND films.user = ?'
+        params.append(user)
+    # Continue after the last result of the previous page ("<rank>,<id>")
+    if cursor:
+        rank, film_id = cursor.rsplit(',', 1)
+        sql += ' AND (films_fts.rank, films_fts.rowid) > (?, ?)'
+        params.extend([float(rank), int(film_id)])
+    # Ask for one extra result to find out whether there is another page
+    sql += ' ORDER BY films_fts.rank, films_fts.rowid LIMIT ?'
+    params.append(int(limit) + 1)
+
+    # Each shard ranks its own films (bm25 uses per-index statistics, so ranks across shards are close, not exact)
+    results = query_shards(user, sql, params, lambda result: (result['search_rank'], result['id']), limit=int(limit) + 1)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = f"{results[-1]['search_rank']!r},{results[-1]['id']}"
+    return results, next_cursor
+
+
 # Actor Display functions
 # =========================================================
-# Get all actors
-def get_all_actors():
+# Turn a name (or what was typed so far) into the form stored in actors.name_key
+# This matches the column's lower(trim(name)), which only lowercases ASCII letters
+def normalize_actor_name(name):
+    return ''.join(char.lower() if char.isascii() else char for char in name.strip())
+
+# Actor name prefixes already looked up: {prefix: (time looked up, actors, whether that is every match)}
+_actor_prefix_cache = OrderedDict()
+_actor_prefix_cache_lock = threading.Lock()
+
+# Find actors whose name starts with what was typed (case-insensitive), for the typeahead in the film forms
+# Returns up to `limit` dicts of {'id', 'name'} ordered by name, found with a range scan of the name_key index
+# Results are kept in a small prefix cache: once a prefix has found every match, longer prefixes are
+# filtered from its results, so typing a name letter by letter mostly doesn't query at all
+def search_actors(prefix, limit=ACTOR_SEARCH_LIMIT):
+    key = normalize_actor_name(prefix)
+    if not key:
+        return []
+
+    now = time.monotonic()
+    with _actor_prefix_cache_lock:
+        for length in range(len(key), 0, -1):
+            cached = _actor_prefix_cache.get(key[:length])
+            if cached is None or now - cached[0] > ACTOR_PREFIX_CACHE_SECONDS:
+                continue
+            looked_up, actors, complete = cached
+            if complete or (length == len(key) and len(actors) >= limit):
+                _actor_prefix_cache.move_to_end(key[:length])
+                return [actor for actor in actors if actor['name_key'].startswith(key)][:limit]
+
+    # name_key >= 'abc' AND name_key < 'abc\U0010ffff' matches every name starting with 'abc'
     conn = get_db_connection()
-    actors = conn.execute('SELECT * FROM actors ORDER BY name ASC').fetchall()
-    conn.close()
+    rows = conn.execute('''
+        SELECT id, name, name_key FROM actors
+        WHERE name_key >= ? AND name_key < ?
+        ORDER BY name_key, name
+        LIMIT ?
+    ''', (key, key + '\U0010ffff', limit + 1)).fetchall()
+    actors = [{'id': row['id'], 'name': row['name'], 'name_key': row['name_key']} for row in rows[:limit]]
+
+    with _actor_prefix_cache_lock:
+        _actor_prefix_cache[key] = (now, actors, len(rows) <= limit)
+        _actor_prefix_cache.move_to_end(key)
+        while len(_actor_prefix_cache) > ACTOR_PREFIX_CACHE_SIZE:
+            _actor_prefix_cache.popitem(last=False)
     return actors
 
+# Get the actors of a film (only the columns the pages use), ordered by name
 def get_film_actors(film_id):
-    conn = get_db_connection()
+    conn = get_db_connection(get_film_shard(film_id))
     film_actors = conn.execute('''
-        SELECT *
-        FROM actors
-        JOIN film_actors ON actors.id = film_actors.actor_id
+        SELECT actors.id, actors.name, actors.birth_year
+        FROM film_actors
+        JOIN actors ON actors.id = film_actors.actor_id
         WHERE film_actors.film_id = ?
+        ORDER BY actors.name
     ''', (film_id,)).fetchall()
     
     # Create a list of actor IDs for easier checking
     film_actor_ids = [actor["id"] for actor in film_actors]
 
-    conn.close()
     return film_actors, film_actor_ids
 
-# Film CRUD functions
-# =========================================================
-# Create a new film
-def create_film(user_id, title, tagline, director, poster, release_year, genre, watched, rating, review):
+# Get an actor by ID (None if there is no such actor)
+def get_actor(actor_id):
     conn = get_db_connection()
-    conn.execute('INSERT INTO films (user, title, tagline, director, poster, release_year, genre, watched, rating, review) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                 (user_id, title, tagline, director, poster, release_year, genre, watched, rating, review))
-    conn.commit()
-    conn.close()
+    return conn.execute('SELECT id, name, birth_year, height FROM actors WHERE id = ?', (actor_id,)).fetchone()
 
-def create_film(user_id, title, tagline, director, poster, release_year, genre, watched, rating, review):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('INSERT INTO films (user, title, tagline, director, poster, release_year, genre, watched, rating, review) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                (user_id, title, tagline, director, poster, release_year, genre, watched, rating, review))
-    conn.commit()
+# Get one page of an actor's films (newest first) plus the cursor for the next page (None on the last page)
+# before is the film ID the previous page ended at; the films are read from the (actor_id, film_id)
+# index one page at a time, so an actor in tens of thousands of films costs the same as one in ten
+def get_actor_films(actor_id, limit=24, before=None):
+    params = [actor_id]
+    condition = ''
+    if before is not None:
+        condition = 'AND film_actors.film_id < ?'
+        params.append(int(before))
+    params.append(limit + 1)
+    films = query_shards(None, f'''
+        SELECT {ACTOR_FILM_COLUMNS}
+        FROM film_actors
+        JOIN films ON films.id = film_actors.film_id
+        LEFT JOIN users ON users.id = films.user
+        WHERE film_actors.actor_id = ? {condition}
+        ORDER BY film_actors.film_id DESC
+        LIMIT ?
+    ''', params, lambda film: film['id'], reverse=True, limit=limit + 1)
+
+    next_cursor = films[limit - 1]['id'] if len(films) > limit else None
+    return films[:limit], next_cursor
 
-    film_id = cur.lastrowid  # GET THE ID
-    conn.close()
+# Get the newest films of many actors at once, returns {actor_id: [films]} with at most per_actor each
+# Everything is fetched by one query: each actor gets its own LIMITed index range scan, joined with UNION ALL
+# (exclude_film leaves out one film, eg: the one whose page lists these actors)
+def get_films_for_actors(actor_ids, per_actor=3, exclude_film=None):
+    actor_ids = list(dict.fromkeys(int(actor_id) for actor_id in actor_ids))
+    films_by_actor = {actor_id: [] for actor_id in actor_ids}
+    if not actor_ids:
+        return films_by_actor
+
+    for start in range(0, len(actor_ids), ACTOR_BATCH_SIZE):
+        batch = actor_ids[start:start + ACTOR_BATCH_SIZE]
+        branch = f'''
+            SELECT * FROM (
+                SELECT film_actors.actor_id AS actor_id, {ACTOR_FILM_COLUMNS}
+                FROM film_actors
+                JOIN films ON films.id = film_actors.film_id
+                LEFT JOIN users ON users.id = films.user
+                WHERE film_actors.actor_id = ? AND film_actors.film_id != ?
+                ORDER BY film_actors.film_id DESC
+                LIMIT ?
+            )
+        '''
+        params = []
+        for actor_id in batch:
+            params.extend([actor_id, exclude_film or 0, per_actor])
+        for shard in range(get_shard_count()):
+            for film in get_db_connection(shard).execute(' UNION ALL '.join([branch] * len(batch)), params):
+                films_by_actor[film['actor_id']].append(film)
+
+    # With several shards each one gave its newest films, keep the newest of them all
+    if get_shard_count() > 1:
+        for actor_id, films in films_by_actor.items():
+            films_by_actor[actor_id] = sorted(films, key=lambda film: film['id'], reverse=True)[:per_actor]
+    return films_by_actor
+
+# Film CRUD functions
+# =========================================================
+# Create a new film (and link its actors) in a single transaction, returns the new film's ID
+def create_film(user_id, title, tagline, director, poster, release_year, genre, watched, rating, review, actor_ids=None):
+    with user_transaction(user_id) as conn:
+        cur = conn.execute('INSERT INTO films (id, user, title, tagline, director, poster, release_year, genre, watched, rating, review) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (allocate_film_ids(conn), user_id, title, tagline, director, poster, release_year, genre, watched, rating, review))
+        film_id = cur.lastrowid  # GET THE ID
+        if actor_ids:
+            conn.executemany('INSERT INTO film_actors (film_id, actor_id) VALUES (?, ?)',
+                             [(film_id, actor_id) for actor_id in sorted({int(actor_id) for actor_id in actor_ids})])
+        film_changed(conn, film_id, user_id)
 
     return film_id
 
-# Update a film by its ID
-def update_film(film_id, title, tagline, director, poster, release_year, genre, watched, rating, review):
-    conn = get_db_connection()
-    conn.execute('UPDATE films SET title = ?, tagline = ?, director = ?, poster = ?, release_year = ?, genre = ?, watched = ?, rating = ?, review = ? WHERE id = ?',
-                 (title, tagline, director, poster, release_year, genre, watched, rating, review, film_id))
-    conn.commit()
-    conn.close()
+# Update a film by its ID (and its actors too, if actor_ids is given) in a single transaction
+def update_film(film_id, title, tagline, director, poster, release_year, genre, watched, rating, review, actor_ids=None):
+    with film_transaction(film_id) as conn:
+        conn.execute('UPDATE films SET title = ?, tagline = ?, director = ?, poster = ?, release_year = ?, genre = ?, watched = ?, rating = ?, review = ?, updated = CURRENT_TIMESTAMP WHERE id = ?',
+                     (title, tagline, director, poster, release_year, genre, watched, rating, review, film_id))
+        if actor_ids is not None:
+            update_film_actors(film_id, actor_ids)
+        film_changed(conn, film_id, get_film_owner(film_id))
+
+# Raised when a bulk edit includes films that aren't the user's (or don't exist), nothing is changed
+class FilmsNotOwned(Exception):
 
-# Delete a film by its ID
+    def __init__(self, film_ids):
+        super().__init__(f'Not your films: {", ".join(map(str, film_ids))}')
+        self.film_ids = film_ids
+
+# Check and convert the changes of a bulk edit, eg: {'watched': 'true', 'rating': '4'} -> {'watched': 1, 'rating': 4}
+# Raises ValueError for unknown columns or values
+def parse_bulk_changes(changes):
+    unknown = [column for column in changes if column not in BULK_EDIT_COLUMNS]
+    if unknown:
+        raise ValueError(f'Only {", ".join(BULK_EDIT_COLUMNS)} can be changed, not {", ".join(unknown)}')
+    parsed = {}
+    if 'watched' in changes:
+        watched = changes['watched']
+        if isinstance(watched, str):
+            watched = {'1': True, 'true': True, 'on': True, '0': False, 'false': False}.get(watched.lower())
+        if not isinstance(watched, bool):
+            raise ValueError('watched must be true or false')
+        parsed['watched'] = int(watched)
+    if 'rating' in changes:
+        rating = changes['rating']
+        if rating in (None, ''):
+            parsed['rating'] = None
+        elif str(rating).isdigit() and 1 <= int(rating) <= 5:
+            parsed['rating'] = int(rating)
+        else:
+            raise ValueError('rating must be from 1 to 5 (or null to clear it)')
+    if 'genre' in changes:
+        if not isinstance(changes['genre'], str):
+            raise ValueError('genre must be text')
+        parsed['genre'] = changes['genre'].strip()
+    return parsed
+
+# Make the same changes (eg: {'watched': True, 'rating': 4}) to many of a user's films in one transaction
+# The whole selection's ownership is checked with one query (raising FilmsNotOwned if any film isn't
+# the user's), then one UPDATE sets just the columns being changed, on just the films where they
+# differ, so untouched films keep their updated time and their cached pages. The film change listeners
+# are told once for the batch. Returns the IDs of the films that were changed
+# Raises ValueError for changes parse_bulk_changes() doesn't accept or more than BULK_EDIT_MAX_FILMS films
+def bulk_update_films(user_id, film_ids, changes):
+    changes = parse_bulk_changes(changes)
+    try:
+        film_ids = sorted({int(film_id) for film_id in film_ids})
+    except (TypeError, ValueError):
+        raise ValueError('Film IDs must be whole numbers') from None
+    if len(film_ids) > BULK_EDIT_MAX_FILMS:
+        raise ValueError(f'At most {BULK_EDIT_MAX_FILMS} films can be changed at once')
+    if not film_ids or not changes:
+        return []
+
+    # The IDs are passed as one JSON array, so the number of films isn't limited by SQLite's parameter limit
+    selection = json.dumps(film_ids)
+    values = list(changes.values())
+    with user_transaction(user_id) as conn:
+        owned = {row['id'] for row in conn.execute(
+            'SELECT id FROM films WHERE id IN (SELECT value FROM json_each(?)) AND user = ?', (selection, user_id))}
+        if len(owned) < len(film_ids):
+            raise FilmsNotOwned([film_id for film_id in film_ids if film_id not in owned])
+
+        assignments = ', '.join(f'{column} = ?' for column in changes)
+        differs = ' OR '.join(f'{column} IS NOT ?' for column in changes)
+        changed = [row['id'] for row in conn.execute(f'''
+            UPDATE films SET {assignments}, updated = CURRENT_TIMESTAMP
+            WHERE id IN (SELECT value FROM json_each(?)) AND ({differs})
+            RETURNING id
+        ''', (*values, selection, *values)).fetchall()]
+        for film_id in changed:
+            film_changed(conn, film_id, user_id)
+    return sorted(changed)
+
+# Delete a film by its ID (its film_actors rows are removed by ON DELETE CASCADE)
 def delete_film(film_id):
-    conn = get_db_connection()
-    conn.execute('DELETE FROM films WHERE id = ?', (film_id,))
-    conn.commit()
-    conn.close()
+    with film_transaction(film_id) as conn:
+        user_id = get_film_owner(film_id)
+        conn.execute('DELETE FROM films WHERE id = ?', (film_id,))
+        film_changed(conn, film_id, user_id)
 
 # Update a film actors
+# Only the links that actually changed are deleted/inserted
 def update_film_actors(id, actor_ids):
-    conn = get_db_connection()
-    # First, delete existing actor associations for the film
-    conn.execute('DELETE FROM film_actors WHERE film_id = ?', (id,))
-    # Then, insert the new actor associations
-    for actor_id in actor_ids:
-        conn.execute('INSERT INTO film_actors (film_id, actor_id) VALUES (?, ?)', (id, actor_id))
-    conn.commit()
-    conn.close()
+    with film_transaction(id) as conn:
+        current_ids = {row['actor_id'] for row in conn.execute('SELECT actor_id FROM film_actors WHERE film_id = ?', (id,))}
+        new_ids = {int(actor_id) for actor_id in actor_ids}
+        removed = sorted(current_ids - new_ids)
+        added = sorted(new_ids - current_ids)
+        if not removed and not added:
+            return
 
-# Delete film actors associations
-def delete_film_actors(film_id):
-    conn = get_db_connection()
-    conn.execute('DELETE FROM film_actors WHERE film_id = ?', (film_id,))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+        conn.executemany('DELETE FROM film_actors WHERE film_id = ? AND actor_id = ?', [(id, actor_id) for actor_id in removed])
+        conn.executemany('INSERT INTO film_actors (film_id, actor_id) VALUES (?, ?)', [(id, actor_id) for actor_id in added])
+        # The film's page shows its actors, so this counts as an update to the film
+        conn.execute('UPDATE films SET updated = CURRENT_TIMESTAMP WHERE id = ?', (id,))
+        film_changed(conn, id, get_film_owner(id))
@@ -11,6 +11,15 @@ connection = sqlite3.connect('database.db')
 with open('schema.sql') as f:
     connection.executescript(f.read())
 
+# Then the full-text search index and the triggers that keep it up to date
+with open('search.sql') as f:
+    connection.executescript(f.read())
+
+# And the per-user statistics table and change feed, with their triggers
+for name in ('stats.sql', 'changes.sql'):
+    with open(name) as f:
+        connection.executescript(f.read())
+
 # Create a cursor object to execute SQL commands
 cur = connection.cursor()
 
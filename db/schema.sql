@@ -1,3 +1,12 @@
+DROP TABLE IF EXISTS films_fts;
+DROP TABLE IF EXISTS user_film_stats;
+DROP TABLE IF EXISTS changes;
+DROP TABLE IF EXISTS user_shards;
+DROP TABLE IF EXISTS shard_moves;
+DROP TABLE IF EXISTS shard_info;
+DROP TABLE IF EXISTS film_similar;
+DROP TABLE IF EXISTS film_actors;
+DROP TABLE IF EXISTS actors;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS films;
 
@@ -10,6 +19,7 @@ CREATE TABLE users (
 CREATE TABLE films (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     user INTEGER NOT NULL REFERENCES users(id),
     title TEXT NOT NULL,
     tagline TEXT,
@@ -21,3 +31,68 @@ CREATE TABLE films (
     rating INTEGER,
     review TEXT
 );
+
+CREATE TABLE actors (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    birth_year INTEGER,
+    height FLOAT,
+    -- Lowercased name for the actor typeahead (computed by SQLite, so writers never set it)
+    name_key TEXT GENERATED ALWAYS AS (lower(trim(name))) VIRTUAL
+);
+
+CREATE TABLE film_actors (
+    film_id INTEGER NOT NULL,
+    actor_id INTEGER NOT NULL,
+    PRIMARY KEY (film_id, actor_id),
+    FOREIGN KEY (film_id) REFERENCES films(id) ON DELETE CASCADE,
+    FOREIGN KEY (actor_id) REFERENCES actors(id) ON DELETE CASCADE
+);
+
+-- Indexes for the film list orderings (see FILM_ORDERINGS in db.py)
+-- SQLite appends the rowid (film id) to every index entry, so these also cover the id tie-breaker
+CREATE INDEX idx_films_title ON films (title);
+CREATE INDEX idx_films_created ON films (created);
+CREATE INDEX idx_films_user_title ON films (user, title);
+CREATE INDEX idx_films_user_created ON films (user, created);
+-- Used to find films by the same director (similar films)
+CREATE INDEX idx_films_director ON films (director);
+
+-- Index for the actor typeahead: prefix searches on name_key are range scans of this index
+CREATE INDEX idx_actors_name_key ON actors (name_key, name);
+
+-- Reverse index for looking up an actor's films (the primary key only helps looking up a film's actors)
+CREATE INDEX idx_film_actors_actor ON film_actors (actor_id, film_id);
+
+-- Each film's most similar films, worked out by db/similar.py ('flask films similar' rebuilds it)
+-- similar_id has no foreign key: rows for a deleted film are replaced when the lists are refreshed
+CREATE TABLE film_similar (
+    film_id INTEGER NOT NULL REFERENCES films(id) ON DELETE CASCADE,
+    similar_id INTEGER NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (film_id, similar_id)
+) WITHOUT ROWID;
+CREATE INDEX idx_film_similar_similar ON film_similar (similar_id);
+
+-- Which shard holds each user's films (only used with DATABASE_SHARDS, see db.py)
+CREATE TABLE user_shards (
+    user_id INTEGER PRIMARY KEY,
+    shard INTEGER NOT NULL
+);
+
+-- Users being moved to another shard (a row is left behind if a move is interrupted, see shards.py)
+CREATE TABLE shard_moves (
+    user_id INTEGER PRIMARY KEY,
+    source INTEGER NOT NULL,
+    target INTEGER NOT NULL,
+    started TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- In a shard: its number and the next film ID to hand out
+CREATE TABLE shard_info (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    shard INTEGER NOT NULL,
+    next_film_id INTEGER NOT NULL
+);
+
+-- The full-text search table and its triggers are in search.sql
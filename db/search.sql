@@ -0,0 +1,60 @@
+-- Full-text search index for films
+-- This file is safe to run more than once: init_db.py runs it after schema.sql,
+-- and db.py runs it against existing databases the first time it connects
+
+-- One row per film (rowid = films.id) with the text columns and the names of its actors
+CREATE VIRTUAL TABLE IF NOT EXISTS films_fts USING fts5 (
+    title,
+    tagline,
+    director,
+    genre,
+    review,
+    actors,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+-- Keep films_fts in sync with films
+CREATE TRIGGER IF NOT EXISTS films_fts_insert AFTER INSERT ON films BEGIN
+    INSERT INTO films_fts (rowid, title, tagline, director, genre, review, actors)
+    VALUES (new.id, new.title, new.tagline, new.director, new.genre, new.review,
+            (SELECT group_concat(actors.name, ' ') FROM film_actors JOIN actors ON actors.id = film_actors.actor_id WHERE film_actors.film_id = new.id));
+END;
+
+CREATE TRIGGER IF NOT EXISTS films_fts_update AFTER UPDATE OF title, tagline, director, genre, review ON films BEGIN
+    UPDATE films_fts
+    SET title = new.title, tagline = new.tagline, director = new.director, genre = new.genre, review = new.review
+    WHERE rowid = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS films_fts_delete AFTER DELETE ON films BEGIN
+    DELETE FROM films_fts WHERE rowid = old.id;
+END;
+
+-- Keep the actor names in films_fts in sync with film_actors and actors
+CREATE TRIGGER IF NOT EXISTS film_actors_fts_insert AFTER INSERT ON film_actors BEGIN
+    UPDATE films_fts
+    SET actors = (SELECT group_concat(actors.name, ' ') FROM film_actors JOIN actors ON actors.id = film_actors.actor_id WHERE film_actors.film_id = new.film_id)
+    WHERE rowid = new.film_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS film_actors_fts_delete AFTER DELETE ON film_actors BEGIN
+    UPDATE films_fts
+    SET actors = (SELECT group_concat(actors.name, ' ') FROM film_actors JOIN actors ON actors.id = film_actors.actor_id WHERE film_actors.film_id = old.film_id)
+    WHERE rowid = old.film_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS actors_fts_update AFTER UPDATE OF name ON actors BEGIN
+    UPDATE films_fts
+    SET actors = (SELECT group_concat(actors.name, ' ') FROM film_actors JOIN actors ON actors.id = film_actors.actor_id WHERE film_actors.film_id = films_fts.rowid)
+    WHERE rowid IN (SELECT film_id FROM film_actors WHERE actor_id = new.id);
+END;
+
+-- Fill the index for films that were added before it existed
+INSERT INTO films_fts (rowid, title, tagline, director, genre, review, actors)
+SELECT films.id, films.title, films.tagline, films.director, films.genre, films.review,
+       (SELECT group_concat(actors.name, ' ') FROM film_actors JOIN actors ON actors.id = film_actors.actor_id WHERE film_actors.film_id = films.id)
+FROM films
+WHERE NOT EXISTS (SELECT 1 FROM films_fts WHERE films_fts.rowid = films.id);
+
+-- Rank results with bm25, weighting matches in the title highest (column order as above)
+INSERT INTO films_fts (films_fts, rank) VALUES ('rank', 'bm25(10.0, 2.0, 4.0, 2.0, 1.0, 4.0)');
@@ -0,0 +1,173 @@
+# Moving users between shards
+# =========================================================
+# Adds 'flask films shards' (how many users/films each shard holds), 'flask films move-user'
+# and 'flask films rebalance' (moves users from the fullest shards to the emptiest ones).
+#
+# A user is moved while the site keeps running: the old shard's write lock is held for the whole
+# move, so their films can still be read but not changed (writers wait, as for any other write).
+# The move is first recorded in the catalogue's shard_moves table. The films are copied to the new
+# shard with the same IDs, user_shards is pointed at it, then the films are deleted from the old
+# shard and the shard_moves row with them. Writes that were waiting for the old shard find the user
+# (or film) gone and start again on the new one (see routed_transaction() in db.py).
+#
+# Each step can be run again, so a move that was interrupted (the process was killed, the disk
+# filled up) is finished from wherever it stopped: by the next move-user or rebalance, or when a
+# pre-fork server starts (see preload.py). Until then the user's films may be listed twice.
+import time
+import click
+from db.db import (forget_shard_lookups, get_db_connection, get_latest_change_seq, get_shard_count, get_shard_paths,
+                   get_user_shard, get_usernames, notify_films_changed, transaction, write_transaction)
+from db.similar import refresh_similar_films, similar_films_updater
+
+
+# Moving
+# =========================================================
+# Move a user's films to another shard, returns the number of films moved
+def move_user(user_id, target):
+    moved = dict(finish_moves(user_id)).get(user_id, 0)
+    source = get_user_shard(user_id, cached=False)
+    if source == target:
+        return moved
+    with transaction() as conn:
+        conn.execute('INSERT INTO shard_moves (user_id, source, target) VALUES (?, ?, ?)', (user_id, source, target))
+    return run_move(user_id, source, target)
+
+# Finish the moves that were interrupted (just the user's with user_id), returns [(user_id, films moved)]
+def finish_moves(user_id=None):
+    query = 'SELECT user_id, source, target FROM shard_moves'
+    params = ()
+    if user_id is not None:
+        query += ' WHERE user_id = ?'
+        params = (user_id,)
+    moves = get_db_connection().execute(query, params).fetchall()
+    return [(move['user_id'], run_move(*move)) for move in moves]
+
+# Carry out (or finish) a move recorded in shard_moves, returns the number of films moved
+def run_move(user_id, source, target):
+    source_conn = get_db_connection(source)
+    target_conn = get_db_connection(target)
+
+    # Hold the old shard's write lock until the move is done
+    try:
+        with write_transaction(source_conn):
+            # Until user_shards points at the new shard the old one still has every film, so they are copied
+            # (again, if the move was interrupted part way through)
+            if get_user_shard(user_id, cached=False) == source:
+                films = source_conn.execute('SELECT * FROM films WHERE user = ?', (user_id,)).fetchall()
+                links = source_conn.execute('''
+                    SELECT film_actors.film_id, film_actors.actor_id
+                    FROM film_actors
+                    JOIN films ON films.id = film_actors.film_id
+                    WHERE films.user = ?
+                ''', (user_id,)).fetchall()
+
+                # Copy the films and their actor links (the new shard's triggers add them to its search index, stats and change feed)
+                with transaction(target) as conn:
+                    conn.execute('DELETE FROM films WHERE user = ?', (user_id,))
+                    if films:
+                        columns = films[0].keys()
+                        conn.executemany(f'INSERT INTO films ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                                         [tuple(film) for film in films])
+                        conn.executemany('INSERT INTO film_actors (film_id, actor_id) VALUES (?, ?)', [tuple(link) for link in links])
+
+                # From here on the user's reads and writes go to the new shard
+                # (when the catalogue is also the old shard, this joins the transaction holding its lock)
+                with transaction() as conn:
+                    conn.execute('''
+                        INSERT INTO user_shards (user_id, shard) VALUES (?, ?)
+                        ON CONFLICT (user_id) DO UPDATE SET shard = excluded.shard
+                    ''', (user_id, target))
+
+            # The films still exist (on the new shard), so the change feed tells clients to fetch them
+            # again rather than delete them
+            latest = get_latest_change_seq(source_conn)
+            source_conn.execute('DELETE FROM films WHERE user = ?', (user_id,))
+            source_conn.execute("UPDATE changes SET op = 'update' WHERE seq > ? AND entity = 'film' AND op = 'delete'", (latest,))
+
+        with transaction() as conn:
+            conn.execute('DELETE FROM shard_moves WHERE user_id = ?', (user_id,))
+    finally:
+        forget_shard_lookups()
+
+    film_ids = [row['id'] for row in target_conn.execute('SELECT id FROM films WHERE user = ?', (user_id,))]
+    # Similar films are only found within a shard, so both shards' lists are worked out again
+    if film_ids:
+        refresh_similar_films(target_conn, film_ids)
+        refresh_similar_films(source_conn, film_ids)
+        # Cached pages showing the films (or the user's list) are out of date
+        notify_films_changed([(film_id, user_id) for film_id in film_ids])
+    return len(film_ids)
+
+# Number of films each user has on each shard: {shard: {user_id: films}} (read from user_film_stats)
+def get_shard_loads():
+    return {shard: {row['user']: row['count'] for row in get_db_connection(shard).execute(
+                "SELECT user, count FROM user_film_stats WHERE stat = 'total'")}
+            for shard in range(get_shard_count())}
+
+# Work out which users to move so every shard holds about the same number of films
+# Greedy: move the user from the fullest shard that best halves its gap with the emptiest shard,
+# until no move makes that gap smaller. Returns [(user_id, films, from shard, to shard)]
+def plan_rebalance(loads):
+    loads = {shard: dict(users) for shard, users in loads.items()}
+    totals = {shard: sum(users.values()) for shard, users in loads.items()}
+    moves = []
+    while True:
+        fullest = max(totals, key=totals.get)
+        emptiest = min(totals, key=totals.get)
+        gap = totals[fullest] - totals[emptiest]
+        candidates = [(abs(gap / 2 - films), user_id, films) for user_id, films in loads[fullest].items() if 0 < films < gap]
+        if not candidates:
+            return moves
+        _, user_id, films = min(candidates)
+        moves.append((user_id, films, fullest, emptiest))
+        loads[emptiest][user_id] = loads[fullest].pop(user_id)
+        totals[fullest] -= films
+        totals[emptiest] += films
+
+
+# Command line
+# =========================================================
+@click.command('shards')
+def shards_command():
+    """Show how many users and films each shard holds."""
+    for shard, users in get_shard_loads().items():
+        click.echo(f'{shard}: {get_shard_paths()[shard]}  {len(users)} users, {sum(users.values())} films')
+    for move in get_db_connection().execute('SELECT user_id, source, target, started FROM shard_moves'):
+        click.echo(f'Unfinished move of {get_usernames([move["user_id"]]).get(move["user_id"])} from shard {move["source"]} '
+                   f'to shard {move["target"]} (started {move["started"]}), run move-user or rebalance to finish it')
+
+# Finish interrupted moves, telling the user about each one
+def echo_finished_moves():
+    for user_id, films in finish_moves():
+        click.echo(f'Finished moving {get_usernames([user_id]).get(user_id)} ({films} films)', err=True)
+
+@click.command('move-user')
+@click.argument('username')
+@click.argument('shard', type=int)
+def move_user_command(username, shard):
+    """Move USERNAME's films to SHARD (a position in DATABASE_SHARDS)."""
+    if not 0 <= shard < get_shard_count():
+        raise click.BadParameter(f'There are {get_shard_count()} shards', param_hint='SHARD')
+    user = get_db_connection().execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+    if user is None:
+        raise click.BadParameter(f'No user called {username!r}', param_hint='USERNAME')
+    started = time.perf_counter()
+    echo_finished_moves()
+    films = move_user(user['id'], shard)
+    similar_films_updater.join()
+    click.echo(f'Moved {films} films to shard {shard} in {time.perf_counter() - started:.1f}s', err=True)
+
+@click.command('rebalance')
+@click.option('--dry-run', is_flag=True, help='Only show the moves.')
+def rebalance_command(dry_run):
+    """Move users between shards until they hold about the same number of films."""
+    if not dry_run:
+        echo_finished_moves()
+    moves = plan_rebalance(get_shard_loads())
+    for user_id, films, source, target in moves:
+        click.echo(f'{get_usernames([user_id]).get(user_id)}: {films} films from shard {source} to shard {target}', err=True)
+        if not dry_run:
+            move_user(user_id, target)
+    if not moves:
+        click.echo('The shards are already balanced', err=True)
+    similar_films_updater.join()
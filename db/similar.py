@@ -0,0 +1,356 @@
+# Similar films ("You might also like")
+# =========================================================
+# Films are compared by what they have in common: shared actors, the same director and the
+# same genre, with better rated films nudged up. Each film is a sparse vector of those
+# features and two films score their cosine similarity. The top SIMILAR_FILMS_COUNT
+# neighbours of every film are stored in the film_similar table, so the film page only does
+# one indexed lookup.
+#
+# 'flask films similar' rebuilds the whole table. Working out every film's neighbours is the
+# sparse product of the film x feature matrix with its transpose; it is done with posting
+# lists (feature -> films) so only pairs of films that actually share something are visited.
+# After that, SimilarFilmsUpdater refreshes just the films affected by each change in a
+# background thread (it is registered as a db.py film change listener). The same thread also
+# prunes the change feed of each database that changed, at most hourly, off the write path.
+import heapq
+import logging
+import math
+import os
+import queue
+import threading
+import time
+import click
+from db.db import (get_database_path, get_pool, get_db_connection, get_shard_count, get_shard_paths, get_user_shard,
+                   prune_changes_if_due, write_transaction)
+
+# Number of similar films kept for each film
+SIMILAR_FILMS_COUNT = 6
+
+# Weight of each kind of shared feature
+ACTOR_WEIGHT = 1.0
+DIRECTOR_WEIGHT = 1.0
+GENRE_WEIGHT = 0.5
+# How much each rating star above/below 3 raises/lowers a recommendation's score
+RATING_WEIGHT = 0.05
+
+# Actors/directors in more films than this are too common to say two films are alike,
+# so they don't make films candidates for each other (they still count towards the score)
+MAX_FEATURE_FILMS = 2000
+
+# Number of rows written by each executemany during a rebuild
+WRITE_CHUNK_SIZE = 5000
+
+# A batch of more changed films than this (eg: a big bulk import) isn't refreshed film by film, which
+# would take longer than rebuilding the whole table: it is logged and left for 'flask films similar'
+REFRESH_MAX_FILMS = 5000
+
+log = logging.getLogger('films.similar')
+
+
+# Scoring
+# =========================================================
+# What a film is compared on: (title key, director, genre, rating, number of actors)
+def film_features(row, actor_count):
+    director = (row['director'] or '').strip() or None
+    return (row['title'] or '').strip().lower(), director, row['genre'] or None, row['rating'], actor_count
+
+# Length of a film's feature vector
+def vector_norm(features):
+    title, director, genre, rating, actor_count = features
+    return math.sqrt(actor_count * ACTOR_WEIGHT ** 2 + (DIRECTOR_WEIGHT ** 2 if director else 0)
+                     + (GENRE_WEIGHT ** 2 if genre else 0))
+
+# Score of `other` as a recommendation for a film (None if it shouldn't be recommended at all)
+def similarity(features, other, shared_actors):
+    # Another user's entry for the same film isn't a recommendation
+    if features[0] == other[0]:
+        return None
+    dot = shared_actors * ACTOR_WEIGHT ** 2
+    if features[1] and features[1] == other[1]:
+        dot += DIRECTOR_WEIGHT ** 2
+    if features[2] and features[2] == other[2]:
+        dot += GENRE_WEIGHT ** 2
+    norms = vector_norm(features) * vector_norm(other)
+    if not dot or not norms:
+        return None
+    rating = other[3] if other[3] is not None else 3
+    return round(dot / norms * (1 + RATING_WEIGHT * (rating - 3)), 6)
+
+
+# Full rebuild
+# =========================================================
+# Work out every film's similar films and replace the whole film_similar table
+# Returns the number of films that have at least one similar film
+def rebuild_similar_films(conn, count=SIMILAR_FILMS_COUNT):
+    # Load the film x feature matrix as posting lists (feature -> films) and per-film feature lists
+    films = {}
+    film_actors = {}
+    actor_films = {}
+    for row in conn.execute('SELECT film_id, actor_id FROM film_actors'):
+        film_actors.setdefault(row['film_id'], []).append(row['actor_id'])
+        actor_films.setdefault(row['actor_id'], []).append(row['film_id'])
+    director_films = {}
+    for row in conn.execute('SELECT id, title, director, genre, rating FROM films'):
+        features = film_features(row, len(film_actors.get(row['id'], ())))
+        films[row['id']] = features
+        if features[1]:
+            director_films.setdefault(features[1], []).append(row['id'])
+
+    rows = []
+    written = 0
+    with write_transaction(conn):
+        conn.execute('DELETE FROM film_similar')
+        for film_id, features in films.items():
+            # One row of the product: count shared actors with every film reached through the posting lists
+            shared = {}
+            for actor_id in film_actors.get(film_id, ()):
+                postings = actor_films[actor_id]
+                if len(postings) <= MAX_FEATURE_FILMS:
+                    for other_id in postings:
+                        shared[other_id] = shared.get(other_id, 0) + 1
+            if features[1] and len(director_films[features[1]]) <= MAX_FEATURE_FILMS:
+                for other_id in director_films[features[1]]:
+                    shared.setdefault(other_id, 0)
+            shared.pop(film_id, None)
+
+            # Common actors skipped above still count for the films that were reached
+            common = [actor_id for actor_id in film_actors.get(film_id, ()) if len(actor_films[actor_id]) > MAX_FEATURE_FILMS]
+            for actor_id in common:
+                for other_id in actor_films[actor_id]:
+                    if other_id in shared:
+                        shared[other_id] += 1
+
+            best = best_scores({other_id: similarity(features, films[other_id], actors)
+                                for other_id, actors in shared.items()}, count)
+            rows.extend((film_id, other_id, score) for other_id, score in best)
+            written += bool(best)
+            if len(rows) >= WRITE_CHUNK_SIZE:
+                conn.executemany('INSERT INTO film_similar (film_id, similar_id, score) VALUES (?, ?, ?)', rows)
+                rows = []
+        conn.executemany('INSERT INTO film_similar (film_id, similar_id, score) VALUES (?, ?, ?)', rows)
+    return written
+
+
+# Incremental refresh
+# =========================================================
+# Load the features of some films from the database: {film_id: features}
+def load_features(conn, film_ids):
+    film_ids = list(film_ids)
+    features = {}
+    for start in range(0, len(film_ids), 500):
+        batch = film_ids[start:start + 500]
+        placeholders = ', '.join('?' * len(batch))
+        for row in conn.execute(f'''
+            SELECT id, title, director, genre, rating,
+                   (SELECT count(*) FROM film_actors WHERE film_actors.film_id = films.id) AS actor_count
+            FROM films WHERE id IN ({placeholders})
+        ''', batch):
+            features[row['id']] = film_features(row, row['actor_count'])
+    return features
+
+# Find every film that shares an actor or the director with a film
+# Returns ({other_id: number of shared actors}, {other_id: features})
+def find_candidates(conn, film_id, features):
+    actor_ids = [row[0] for row in conn.execute('SELECT actor_id FROM film_actors WHERE film_id = ?', (film_id,))]
+    shared = {}
+    if actor_ids:
+        placeholders = ', '.join('?' * len(actor_ids))
+        # Only actors in at most MAX_FEATURE_FILMS films make candidates (counted on the (actor_id, film_id) index)
+        rare = [row[0] for row in conn.execute(f'''
+            SELECT actor_id FROM film_actors WHERE actor_id IN ({placeholders})
+            GROUP BY actor_id HAVING count(*) <= ?
+        ''', actor_ids + [MAX_FEATURE_FILMS])]
+        if rare:
+            rare_placeholders = ', '.join('?' * len(rare))
+            for row in conn.execute(f'SELECT DISTINCT film_id FROM film_actors WHERE actor_id IN ({rare_placeholders})', rare):
+                shared[row[0]] = 0
+    if features[1]:
+        directed = conn.execute('SELECT id FROM films WHERE director = ? LIMIT ?', (features[1], MAX_FEATURE_FILMS + 1)).fetchall()
+        if len(directed) <= MAX_FEATURE_FILMS:
+            for row in directed:
+                shared.setdefault(row[0], 0)
+    shared.pop(film_id, None)
+    if not shared:
+        return {}, {}
+
+    # Count every shared actor (common ones too) for the candidates
+    if actor_ids:
+        for row in conn.execute(f'''
+            SELECT film_id, count(*) FROM film_actors
+            WHERE actor_id IN ({placeholders}) AND film_id != ?
+            GROUP BY film_id
+        ''', actor_ids + [film_id]):
+            if row[0] in shared:
+                shared[row[0]] = row[1]
+    return shared, load_features(conn, shared)
+
+# The best `count` (other_id, score) pairs from {other_id: score}
+def best_scores(scores, count):
+    return heapq.nlargest(count, ((other_id, score) for other_id, score in scores.items() if score is not None),
+                          key=lambda item: item[1])
+
+# Replace one film's similar films, returns False (and writes nothing) if they are the same as the stored ones
+def write_similar(conn, film_id, best):
+    current = conn.execute('SELECT similar_id, score FROM film_similar WHERE film_id = ?', (film_id,)).fetchall()
+    if sorted(tuple(row) for row in current) == sorted(best):
+        return False
+    conn.execute('DELETE FROM film_similar WHERE film_id = ?', (film_id,))
+    conn.executemany('INSERT INTO film_similar (film_id, similar_id, score) VALUES (?, ?, ?)',
+                     [(film_id, other_id, score) for other_id, score in best])
+    return True
+
+# Work out one film's similar films again from scratch
+# Returns (whether its list changed, {other_id: shared actors}, {other_id: features})
+def refresh_film(conn, film_id, features, count):
+    shared, others = find_candidates(conn, film_id, features)
+    written = write_similar(conn, film_id, best_scores({other_id: similarity(features, other, shared[other_id])
+                                                        for other_id, other in others.items()}, count))
+    return written, shared, others
+
+# Refresh the similar films affected by changes to some films, returns the IDs of every film whose list changed
+# (a list worked out again that comes out the same isn't written, and isn't counted as changed)
+# A changed film gets its list worked out again. Films that share something with it only get
+# their score for the changed film merged into their lists, unless the changed film dropped
+# out of a list (or was deleted), in which case that list is worked out again as well.
+def refresh_similar_films(conn, film_ids, count=SIMILAR_FILMS_COUNT):
+    changed = set()
+    with write_transaction(conn):
+        for film_id in set(film_ids):
+            features = load_features(conn, [film_id]).get(film_id)
+            # Films currently recommending this one
+            listed_by = {row[0] for row in conn.execute('SELECT film_id FROM film_similar WHERE similar_id = ?', (film_id,))}
+            rework = set()
+
+            if features is None:
+                # Deleted: its own rows went with it (ON DELETE CASCADE), the films listing it need new lists
+                rework.update(listed_by)
+            else:
+                written, shared, others = refresh_film(conn, film_id, features, count)
+                if written:
+                    changed.add(film_id)
+                # The candidates' current lists, without the changed film
+                lists = {other_id: {} for other_id in others}
+                for other_id in lists:
+                    for row in conn.execute('SELECT similar_id, score FROM film_similar WHERE film_id = ? AND similar_id != ?',
+                                            (other_id, film_id)):
+                        lists[other_id][row[0]] = row[1]
+                for other_id, other in others.items():
+                    # Shared actors work both ways, but the rating used is the recommended film's
+                    score = similarity(other, features, shared[other_id])
+                    current = lists[other_id]
+                    if score is not None and (len(current) < count or score > min(current.values())):
+                        current[film_id] = score
+                        if write_similar(conn, other_id, best_scores(current, count)):
+                            changed.add(other_id)
+                    elif other_id in listed_by:
+                        rework.add(other_id)
+                # Films that listed it but no longer share anything with it
+                rework.update(listed_by - others.keys())
+
+            for other_id, other in load_features(conn, rework).items():
+                if refresh_film(conn, other_id, other, count)[0]:
+                    changed.add(other_id)
+    return changed
+
+
+# Background updates
+# =========================================================
+# Refreshes similar films in a background thread after films change, so saving a film
+# doesn't wait for it and viewing a film never pays for it
+class SimilarFilmsUpdater:
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        # Functions called as listener(film_ids) with the films whose similar films were changed by each refresh
+        self.refresh_listeners = []
+        self.stats = {'refreshed': 0, 'errors': 0}
+        # Days of change feed kept (None: not pruned), set from an app's CHANGES_RETENTION_DAYS by init_app()
+        self.changes_retention_days = None
+
+    def init_app(self, app):
+        self.changes_retention_days = app.config['CHANGES_RETENTION_DAYS']
+
+    def add_refresh_listener(self, listener):
+        self.refresh_listeners.append(listener)
+
+    # Film change listener (see add_film_change_listener in db.py), queues one refresh per database for the batch
+    # Films are only compared with films on the same shard, so the refresh runs on the owner's shard
+    def films_changed(self, changes):
+        by_database = {}
+        for film_id, user_id in changes:
+            db_path = get_shard_paths()[get_user_shard(user_id) if user_id is not None else 0]
+            by_database.setdefault(db_path, set()).add(film_id)
+        # The catalogue's change feed (users) is pruned too
+        by_database.setdefault(get_database_path(), set())
+        # The thread is started on first use, and again after a fork (a forked process only has the thread that forked)
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.thread = threading.Thread(target=self.run, name='similar-films', daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+        for db_path, film_ids in by_database.items():
+            self.queue.put((db_path, film_ids))
+
+    def run(self):
+        while True:
+            # Handle everything queued so far in one go (a film saved twice is refreshed once)
+            pending = [self.queue.get()]
+            while True:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            by_database = {}
+            for db_path, film_ids in pending:
+                by_database.setdefault(db_path, set()).update(film_ids)
+            try:
+                for db_path, film_ids in by_database.items():
+                    # A failed refresh (or listener) is logged, the thread carries on with the next changes
+                    try:
+                        if len(film_ids) > REFRESH_MAX_FILMS:
+                            log.warning("%s films changed in %s at once, run 'flask films similar' to update their similar films",
+                                        len(film_ids), db_path)
+                        elif film_ids:
+                            self.refresh(db_path, film_ids)
+                        if self.changes_retention_days is not None:
+                            prune_changes_if_due(db_path, self.changes_retention_days)
+                    except Exception:
+                        self.stats['errors'] += 1
+                        log.exception('Refreshing similar films or pruning the change feed failed in %s (films %s)', db_path, sorted(film_ids))
+            finally:
+                for _ in pending:
+                    self.queue.task_done()
+
+    def refresh(self, db_path, film_ids):
+        pool = get_pool(db_path)
+        conn = pool.acquire()
+        try:
+            changed = refresh_similar_films(conn, film_ids)
+        finally:
+            pool.release(conn)
+        self.stats['refreshed'] += len(changed)
+        if changed:
+            for listener in self.refresh_listeners:
+                listener(changed)
+
+    # Wait until every queued change has been handled (eg: in tests or before shutting down)
+    def join(self):
+        self.queue.join()
+
+    def get_stats(self):
+        return dict(self.stats, pending=self.queue.qsize())
+
+similar_films_updater = SimilarFilmsUpdater()
+
+
+# Command line
+# =========================================================
+@click.command('similar')
+def similar_command():
+    """Rebuild the similar films of every film (run after a big bulk import)."""
+    started = time.perf_counter()
+    films = sum(rebuild_similar_films(get_db_connection(shard)) for shard in range(get_shard_count()))
+    click.echo(f'Found similar films for {films} films in {time.perf_counter() - started:.1f}s', err=True)
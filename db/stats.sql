@@ -0,0 +1,71 @@
+-- Per-user film statistics, kept up to date by triggers so the stats page never has to scan a user's films
+-- One row per (user, stat, value), eg: (2, 'genre', 'Drama', 14). The stats are:
+--   total     value ''                            every film
+--   genre     the genre ('' when it has none)
+--   watched   '1' or '0'
+--   rating    the rating ('' when it has none)
+--   decade    eg: '1990' ('' without a release year)
+CREATE TABLE IF NOT EXISTS user_film_stats (
+    user INTEGER NOT NULL,
+    stat TEXT NOT NULL,
+    value TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user, stat, value)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS films_stats_insert AFTER INSERT ON films BEGIN
+    INSERT INTO user_film_stats (user, stat, value, count) VALUES
+        (new.user, 'total', '', 1),
+        (new.user, 'genre', coalesce(new.genre, ''), 1),
+        (new.user, 'watched', CASE WHEN new.watched THEN '1' ELSE '0' END, 1),
+        (new.user, 'rating', coalesce(new.rating, ''), 1),
+        (new.user, 'decade', CASE WHEN typeof(new.release_year) = 'integer' THEN new.release_year / 10 * 10 ELSE '' END, 1)
+    ON CONFLICT (user, stat, value) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS films_stats_delete AFTER DELETE ON films BEGIN
+    UPDATE user_film_stats SET count = count - 1
+    WHERE user = old.user AND (
+        (stat = 'total' AND value = '') OR
+        (stat = 'genre' AND value = coalesce(old.genre, '')) OR
+        (stat = 'watched' AND value = CASE WHEN old.watched THEN '1' ELSE '0' END) OR
+        (stat = 'rating' AND value = CAST(coalesce(old.rating, '') AS TEXT)) OR
+        (stat = 'decade' AND value = CAST(CASE WHEN typeof(old.release_year) = 'integer' THEN old.release_year / 10 * 10 ELSE '' END AS TEXT))
+    );
+    DELETE FROM user_film_stats WHERE user = old.user AND count <= 0;
+END;
+
+-- Only runs when a counted column actually changes (update_film() writes every column)
+CREATE TRIGGER IF NOT EXISTS films_stats_update AFTER UPDATE OF user, genre, watched, rating, release_year ON films
+WHEN old.user IS NOT new.user OR old.genre IS NOT new.genre OR old.watched IS NOT new.watched
+     OR old.rating IS NOT new.rating OR old.release_year IS NOT new.release_year
+BEGIN
+    UPDATE user_film_stats SET count = count - 1
+    WHERE user = old.user AND (
+        (stat = 'total' AND value = '') OR
+        (stat = 'genre' AND value = coalesce(old.genre, '')) OR
+        (stat = 'watched' AND value = CASE WHEN old.watched THEN '1' ELSE '0' END) OR
+        (stat = 'rating' AND value = CAST(coalesce(old.rating, '') AS TEXT)) OR
+        (stat = 'decade' AND value = CAST(CASE WHEN typeof(old.release_year) = 'integer' THEN old.release_year / 10 * 10 ELSE '' END AS TEXT))
+    );
+    DELETE FROM user_film_stats WHERE user = old.user AND count <= 0;
+    INSERT INTO user_film_stats (user, stat, value, count) VALUES
+        (new.user, 'total', '', 1),
+        (new.user, 'genre', coalesce(new.genre, ''), 1),
+        (new.user, 'watched', CASE WHEN new.watched THEN '1' ELSE '0' END, 1),
+        (new.user, 'rating', coalesce(new.rating, ''), 1),
+        (new.user, 'decade', CASE WHEN typeof(new.release_year) = 'integer' THEN new.release_year / 10 * 10 ELSE '' END, 1)
+    ON CONFLICT (user, stat, value) DO UPDATE SET count = count + 1;
+END;
+
+-- Count the films that were added before the table existed (or every film, after a rebuild empties it)
+INSERT INTO user_film_stats (user, stat, value, count)
+SELECT user, stat, value, count(*) FROM (
+    SELECT user, 'total' AS stat, '' AS value FROM films
+    UNION ALL SELECT user, 'genre', coalesce(genre, '') FROM films
+    UNION ALL SELECT user, 'watched', CASE WHEN watched THEN '1' ELSE '0' END FROM films
+    UNION ALL SELECT user, 'rating', CAST(coalesce(rating, '') AS TEXT) FROM films
+    UNION ALL SELECT user, 'decade', CAST(CASE WHEN typeof(release_year) = 'integer' THEN release_year / 10 * 10 ELSE '' END AS TEXT) FROM films
+)
+WHERE NOT EXISTS (SELECT 1 FROM user_film_stats)
+GROUP BY user, stat, value;
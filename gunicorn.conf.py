@@ -0,0 +1,24 @@
+# Gunicorn settings for production: gunicorn -c gunicorn.conf.py wsgi:app
+# preload_app builds and warms up the app in the master (see preload.py), so workers start quickly
+# and share its templates and caches. WEB_CONCURRENCY, GUNICORN_THREADS and BIND override the defaults.
+import logging
+import multiprocessing
+import os
+from preload import report_worker
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Each worker has its own page cache unless CACHE_REDIS_URL is set: their pages still follow every
+# worker's writes (through the change feed's position, see cache.py), a shared cache is just hit more often
+# SQLite lets many readers work at once, so each worker also handles requests on several threads
+# Enough threads that the admission limits (see admission.py) decide what waits, not the thread count
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+preload_app = True
+
+# Show the start-up reports ('films.startup') with gunicorn's own log lines
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(process)d] [%(name)s] %(message)s')
+
+# Every worker logs how long it took to start and its memory use (shared with the master and private)
+def post_worker_init(worker):
+    report_worker(worker.age)
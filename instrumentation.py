@@ -0,0 +1,267 @@
+# Request instrumentation
+# =========================================================
+# When SQL_INSTRUMENTATION is enabled, every statement run through get_db_connection() is
+# timed and counted per request (the app's connections are TimedConnections, other apps in the
+# process keep plain ones). Each response then gets a Server-Timing header (db, template and
+# total time), a structured 'films.timing' log line is written, and
+# statements slower than SLOW_QUERY_MS go to the 'films.slow_query' log with their
+# EXPLAIN QUERY PLAN. PROFILE_SAMPLING adds a sampling profiler that writes per-route
+# flame graph data (folded stacks) to PROFILE_DIR.
+# With both options off nothing is installed, so there is no cost at all.
+# Streamed responses (?all=1 pages, API lists) only run their queries while the body is sent,
+# after the headers, so they get no Server-Timing header and their log line ("streamed": true)
+# only covers the time up to the start of the body.
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import g, has_request_context, request, before_render_template, template_rendered
+
+# Statements slower than this many milliseconds are written to the slow query log
+SLOW_QUERY_MS = 100
+# Milliseconds between profiler samples, and seconds between writing the profiles to disk
+PROFILE_INTERVAL_MS = 5
+PROFILE_DUMP_SECONDS = 30
+
+timing_log = logging.getLogger('films.timing')
+slow_query_log = logging.getLogger('films.slow_query')
+
+
+# Timed connections
+# =========================================================
+# One statement run during a request
+class QueryRecord:
+
+    def __init__(self, conn, sql, parameters):
+        self.conn = conn
+        self.sql = sql
+        self.parameters = parameters
+        self.elapsed = 0.0
+        self.rows = 0
+
+# Cursor that adds the time spent fetching rows (SQLite does most of a SELECT's work here) to its statement
+class TimedCursor(sqlite3.Cursor):
+
+    record = None
+
+    def execute(self, sql, parameters=()):
+        self.record = start_record(self.connection, sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            finish_record(self.record, started, self)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.record = start_record(self.connection, sql, None)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            finish_record(self.record, started, self)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        finish_record(self.record, started, None, 1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        finish_record(self.record, started, None, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        finish_record(self.record, started, None, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            finish_record(self.record, started, None)
+            raise
+        finish_record(self.record, started, None, 1)
+        return row
+
+# Connection whose execute()/executemany() use TimedCursor
+class TimedConnection(sqlite3.Connection):
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Start recording a statement (only during a request)
+def start_record(conn, sql, parameters):
+    if not has_request_context() or 'sql_queries' not in g:
+        return None
+    record = QueryRecord(conn, sql, parameters)
+    g.sql_queries.append(record)
+    return record
+
+# Add time (and rows) to a statement's record
+def finish_record(record, started, cursor, rows=0):
+    if record is None:
+        return
+    record.elapsed += time.perf_counter() - started
+    if cursor is not None and cursor.rowcount > 0:
+        rows += cursor.rowcount
+    record.rows += rows
+
+
+# Per-request timing
+# =========================================================
+def start_request():
+    g.sql_queries = []
+    g.request_started = time.perf_counter()
+    g.template_time = 0.0
+
+def start_template(sender, template, context, **extra):
+    if has_request_context():
+        g.template_started = time.perf_counter()
+
+def finish_template(sender, template, context, **extra):
+    if has_request_context() and 'template_started' in g:
+        g.template_time += time.perf_counter() - g.pop('template_started')
+
+# Add the Server-Timing header and write the timing/slow query logs
+def finish_request(response, slow_query_ms):
+    if 'sql_queries' not in g:
+        return response
+    queries = g.sql_queries
+    db_time = sum(record.elapsed for record in queries)
+    total_time = time.perf_counter() - g.request_started
+
+    # A streamed body hasn't been produced yet, so its timings would leave out most of the work
+    if not response.is_streamed:
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={db_time * 1000:.2f};desc="{len(queries)} queries"',
+            f'tpl;dur={g.template_time * 1000:.2f}',
+            f'total;dur={total_time * 1000:.2f}',
+        ])
+    timing_log.info(json.dumps({
+        'method': request.method, 'path': request.path, 'endpoint': request.endpoint, 'status': response.status_code,
+        'streamed': response.is_streamed,
+        'queries': len(queries), 'rows': sum(record.rows for record in queries),
+        'db_ms': round(db_time * 1000, 2), 'template_ms': round(g.template_time * 1000, 2), 'total_ms': round(total_time * 1000, 2),
+    }))
+
+    for record in queries:
+        if record.elapsed * 1000 >= slow_query_ms:
+            slow_query_log.warning(json.dumps({
+                'endpoint': request.endpoint, 'ms': round(record.elapsed * 1000, 2), 'rows': record.rows,
+                'sql': ' '.join(record.sql.split()), 'plan': explain(record),
+            }))
+    return response
+
+# EXPLAIN QUERY PLAN for a recorded statement (as a list of plan lines)
+def explain(record):
+    if record.parameters is None or not record.sql.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')):
+        return []
+    try:
+        # The plain sqlite3.Connection.execute, so the EXPLAIN itself isn't recorded
+        rows = sqlite3.Connection.execute(record.conn, 'EXPLAIN QUERY PLAN ' + record.sql, record.parameters).fetchall()
+    except sqlite3.Error as error:
+        return [f'EXPLAIN failed: {error}']
+    return [row[3] for row in rows]
+
+
+# Sampling profiler
+# =========================================================
+# Samples the stack of every thread that is handling a request and counts the stacks per route
+# The results are written as folded stacks (one '<frame;frame;...> <count>' line each) to
+# PROFILE_DIR/<endpoint>.folded, which flamegraph.pl or speedscope can turn into a flame graph
+class SamplingProfiler:
+
+    def __init__(self, folder, interval_ms=PROFILE_INTERVAL_MS, dump_seconds=PROFILE_DUMP_SECONDS):
+        self.folder = folder
+        self.interval = interval_ms / 1000
+        self.dump_seconds = dump_seconds
+        self.active = {}  # thread id -> endpoint
+        self.samples = defaultdict(Counter)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        os.makedirs(self.folder, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+        atexit.register(self.dump)
+
+    def begin_request(self):
+        self.active[threading.get_ident()] = request.endpoint or 'unknown'
+
+    def end_request(self, exception=None):
+        self.active.pop(threading.get_ident(), None)
+
+    def run(self):
+        last_dump = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            frame = None
+            with self.lock:
+                for thread_id, endpoint in list(self.active.items()):
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        self.samples[endpoint][fold_stack(frame)] += 1
+            # Let go of the frames straight away: they keep their local variables (eg: open cursors) alive
+            del frames, frame
+            if time.monotonic() - last_dump >= self.dump_seconds:
+                self.dump()
+                last_dump = time.monotonic()
+
+    # Write every route's samples so far
+    def dump(self):
+        with self.lock:
+            samples = {endpoint: dict(stacks) for endpoint, stacks in self.samples.items()}
+        for endpoint, stacks in samples.items():
+            path = os.path.join(self.folder, f'{endpoint}.folded')
+            with open(path + '.part', 'w') as f:
+                for stack, count in stacks.items():
+                    f.write(f'{stack} {count}\n')
+            os.replace(path + '.part', path)
+
+# Turn a frame and its callers into 'module:function;module:function' (outermost first)
+def fold_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# Set up instrumentation for a Flask app from its config (does nothing when it is all switched off)
+def init_app(app):
+    if app.config.get('SQL_INSTRUMENTATION'):
+        slow_query_ms = app.config.get('SLOW_QUERY_MS', SLOW_QUERY_MS)
+        app.config['DB_CONNECTION_FACTORY'] = TimedConnection
+        app.before_request(start_request)
+        app.after_request(lambda response: finish_request(response, slow_query_ms))
+        before_render_template.connect(start_template, app)
+        template_rendered.connect(finish_template, app)
+
+    if app.config.get('PROFILE_SAMPLING'):
+        profiler = SamplingProfiler(app.config.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles')),
+                                    app.config.get('PROFILE_INTERVAL_MS', PROFILE_INTERVAL_MS))
+        app.before_request(profiler.begin_request)
+        app.teardown_request(profiler.end_request)
+        profiler.start()
+        # A forked process (eg: a pre-fork server's worker) only has the thread that forked, so it starts its own
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=profiler.start)
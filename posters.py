@@ -0,0 +1,167 @@
+# Poster image storage
+# =========================================================
+# Uploaded posters are stored once under the SHA-256 hash of their contents
+# (static/uploads/<first 2 hex chars>/<hash>.<ext>), so the same image uploaded twice
+# is only kept once and two users' files can never overwrite each other.
+# Smaller WebP thumbnails are made in a background thread pool so the upload request
+# does not have to wait for them.
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Pillow is only needed for thumbnails, posters are still stored without it
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Allowed image extensions for uploads
+ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+
+# Folder (inside static/) and URL prefix for stored posters
+UPLOADS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+UPLOADS_URL = '/static/uploads'
+
+# Thumbnail sizes: name -> width in pixels (height keeps the aspect ratio)
+THUMBNAIL_SIZES = {
+    'card': 240,
+    'detail': 600,
+}
+THUMBNAIL_QUALITY = 80
+
+# Size of each chunk read from the upload while it is hashed
+CHUNK_SIZE = 64 * 1024
+
+# Background workers for thumbnail generation
+THUMBNAIL_WORKERS = 2
+_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix='thumbnails')
+
+# Seconds before a thumbnail that didn't exist is looked for again (another worker may have made it since)
+THUMBNAIL_RECHECK_SECONDS = 60
+
+# What is known about each thumbnail, so templates don't check the disk every time:
+# {thumbnail path: (width in pixels, or None if it didn't exist, time.monotonic() it was checked)}
+_thumbnails = {}
+_thumbnails_lock = threading.Lock()
+
+log = logging.getLogger('films.posters')
+
+
+# Check the uploaded file has an allowed image extension, returns the extension or None
+def get_image_extension(filename):
+    if not filename or '.' not in filename:
+        return None
+    extension = filename.rsplit('.', 1)[1].lower()
+    return extension if extension in ALLOWED_IMAGE_EXTENSIONS else None
+
+# Store an uploaded poster (a werkzeug FileStorage) and return its URL, or None if it isn't an image
+# The upload is streamed into a temporary file and hashed on the way, then moved into place
+def save_poster(poster_file, uploads_folder=None):
+    uploads_folder = uploads_folder or UPLOADS_FOLDER
+    extension = get_image_extension(poster_file.filename if poster_file else None)
+    if extension is None:
+        return None
+    if extension == 'jpeg':
+        extension = 'jpg'
+
+    os.makedirs(uploads_folder, exist_ok=True)
+    sha256 = hashlib.sha256()
+    temp_fd, temp_path = tempfile.mkstemp(dir=uploads_folder, suffix='.part')
+    try:
+        with os.fdopen(temp_fd, 'wb') as temp_file:
+            while True:
+                chunk = poster_file.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                temp_file.write(chunk)
+
+        digest = sha256.hexdigest()
+        folder = os.path.join(uploads_folder, digest[:2])
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'{digest}.{extension}')
+        if os.path.exists(path):
+            # Already stored, keep the existing copy
+            os.remove(temp_path)
+        else:
+            # mkstemp files are private to this user, posters need to be readable by the web server
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    # Make the thumbnails in the background (logging anything that goes wrong, eg: a corrupt image)
+    if Image is not None:
+        _executor.submit(make_thumbnails, path).add_done_callback(lambda future: log_thumbnail_error(future, path))
+
+    return f'{UPLOADS_URL}/{digest[:2]}/{digest}.{extension}'
+
+# Path of a thumbnail for a stored poster, eg: <hash>.jpg -> <hash>-card.webp
+def get_thumbnail_path(path, size):
+    return f'{path.rsplit(".", 1)[0]}-{size}.webp'
+
+# Create every thumbnail size for a stored poster (runs in the background pool)
+def make_thumbnails(path):
+    with Image.open(path) as image:
+        image.load()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        for size, width in THUMBNAIL_SIZES.items():
+            thumbnail_path = get_thumbnail_path(path, size)
+            if os.path.exists(thumbnail_path):
+                continue
+            thumbnail = image.copy()
+            thumbnail.thumbnail((width, width * 4))
+            # Write to a temporary name first so a half-written file is never served
+            temp_path = f'{thumbnail_path}.part'
+            thumbnail.save(temp_path, 'WEBP', quality=THUMBNAIL_QUALITY)
+            os.replace(temp_path, thumbnail_path)
+            with _thumbnails_lock:
+                _thumbnails[thumbnail_path] = (thumbnail.width, time.monotonic())
+
+# Log the error of a background thumbnail job (nothing else waits for it, so it would be lost)
+def log_thumbnail_error(future, path):
+    error = future.exception()
+    if error is not None:
+        log.error('Making thumbnails failed for %s', path, exc_info=error)
+
+# Width of a thumbnail (a small image isn't made bigger, so it can be narrower than its size),
+# or None if it doesn't exist; checked on disk once, or again after THUMBNAIL_RECHECK_SECONDS if it was missing
+def get_thumbnail_width(thumbnail_path, size):
+    with _thumbnails_lock:
+        known = _thumbnails.get(thumbnail_path)
+    if known is not None and (known[0] is not None or time.monotonic() - known[1] < THUMBNAIL_RECHECK_SECONDS):
+        return known[0]
+    width = None
+    if os.path.exists(thumbnail_path):
+        width = THUMBNAIL_SIZES[size]
+        if Image is not None:
+            try:
+                with Image.open(thumbnail_path) as image:
+                    width = image.width
+            except OSError:
+                pass
+    with _thumbnails_lock:
+        _thumbnails[thumbnail_path] = (width, time.monotonic())
+    return width
+
+# Build a srcset value for a poster URL from whichever thumbnails exist ('' if there are none)
+# eg: <img src="{{ film['poster'] }}" srcset="{{ poster_srcset(film['poster']) }}">
+def poster_srcset(poster_url, uploads_folder=None):
+    uploads_folder = uploads_folder or UPLOADS_FOLDER
+    if not poster_url or not poster_url.startswith(UPLOADS_URL + '/'):
+        return ''
+    path = os.path.join(uploads_folder, poster_url[len(UPLOADS_URL) + 1:])
+    # One source per width (the thumbnails of a small poster can all be the same width)
+    sources = {}
+    for size in THUMBNAIL_SIZES:
+        width = get_thumbnail_width(get_thumbnail_path(path, size), size)
+        if width is not None:
+            sources.setdefault(width, get_thumbnail_path(poster_url, size))
+    return ', '.join(f'{url} {width}w' for width, url in sources.items())
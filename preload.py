@@ -0,0 +1,127 @@
+# Pre-fork preloading
+# =========================================================
+# A pre-fork WSGI server (eg: gunicorn with preload_app, see gunicorn.conf.py and wsgi.py) builds the
+# app once in its master process and then forks its workers. Memory the master filled in before
+# forking is shared with every worker (copy-on-write) until one of them changes it, so the slow
+# start-up work is done there, once: compiling every template, opening each database (which runs
+# the schema upgrade, pragmas and shard set-up, and finishes interrupted moves between shards) and
+# filling the username and actor caches.
+# The master's database connections are closed before it forks, each worker opens its own.
+#
+# The master logs how long it took to start and its memory use to 'films.startup', each worker logs
+# the same once it is ready, and /_debug/stats shows the memory of the worker that answered.
+import json
+import logging
+import os
+import time
+import click
+from flask import current_app
+from db.db import close_connections, get_db_connection, get_shard_count, warm_caches
+from db.shards import finish_moves
+try:
+    import resource
+except ImportError:
+    resource = None
+
+startup_log = logging.getLogger('films.startup')
+
+# When this process was forked (None in the master, or without a pre-fork server)
+_forked_at = None
+
+
+# Warming up
+# =========================================================
+# Do the start-up work for an app and return a report of how long each part took
+# started is a time.perf_counter() from before the app was imported, so the report covers the whole start-up
+def warm_up(app, started=None):
+    report = {'pid': os.getpid()}
+    timer = time.perf_counter()
+
+    # Compile every template (loaded from the bytecode cache when TEMPLATE_BYTECODE_CACHE is on)
+    templates = app.jinja_env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    for name in templates:
+        app.jinja_env.get_template(name)
+    report['templates'] = len(templates)
+    report['templates_ms'], timer = elapsed_ms(timer), time.perf_counter()
+
+    with app.app_context():
+        # Opening each database checks and upgrades its schema, sets its pragmas and prepares it as a shard
+        journal_modes = {get_db_connection(shard).execute('PRAGMA journal_mode').fetchone()[0]
+                         for shard in range(get_shard_count())}
+        get_db_connection()
+        if journal_modes != {'wal'}:
+            startup_log.warning(f'Expected every database to use WAL, got {sorted(journal_modes)}')
+        report['databases'] = get_shard_count()
+        # Finish any move between shards that was interrupted, before the workers can see the user's films twice
+        report['finished_moves'] = len(finish_moves())
+        report['databases_ms'], timer = elapsed_ms(timer), time.perf_counter()
+
+        report.update(warm_caches())
+        report['caches_ms'] = elapsed_ms(timer)
+
+    # Workers must not share the master's connections
+    close_connections()
+
+    if started is not None:
+        report['startup_ms'] = elapsed_ms(started)
+    report['memory'] = get_memory_stats()
+    app.extensions['preload'] = report
+    startup_log.info(json.dumps({'process': 'master', **report}))
+    return report
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 2)
+
+def record_fork():
+    global _forked_at
+    _forked_at = time.perf_counter()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=record_fork)
+
+# Log that a worker is ready: how long it took since the fork and how much memory it uses
+# (called by the server, see post_worker_init in gunicorn.conf.py)
+def report_worker(worker_id=None):
+    report = {'process': 'worker', 'worker': worker_id, 'pid': os.getpid()}
+    if _forked_at is not None:
+        report['startup_ms'] = elapsed_ms(_forked_at)
+    report['memory'] = get_memory_stats()
+    startup_log.info(json.dumps(report))
+    return report
+
+
+# Memory
+# =========================================================
+# Memory used by this process, in KiB
+# On Linux (from /proc/self/smaps_rollup): rss counts every page this process uses, shared the pages
+# it shares with other processes (eg: a worker with the master it was forked from), private the
+# pages only it uses, and pss its fair share (each shared page divided by the processes sharing it).
+# Elsewhere only the peak RSS is known.
+def get_memory_stats():
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        if resource is None:
+            return {}
+        return {'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    kib = lambda name: int(fields.get(name, '0').split()[0])
+    return {
+        'rss_kb': kib('Rss'),
+        'pss_kb': kib('Pss'),
+        'shared_kb': kib('Shared_Clean') + kib('Shared_Dirty'),
+        'private_kb': kib('Private_Clean') + kib('Private_Dirty'),
+    }
+
+# This process's memory and start-up report (shown by /_debug/stats)
+def get_process_stats():
+    return {'pid': os.getpid(), 'forked': _forked_at is not None, 'memory': get_memory_stats(),
+            'preload': current_app.extensions.get('preload')}
+
+
+# Command line
+# =========================================================
+@click.command('warm-up')
+def warm_up_command():
+    """Do the pre-fork start-up work and show how long it took."""
+    click.echo(json.dumps(warm_up(current_app._get_current_object()), indent=2))
@@ -0,0 +1,76 @@
+// Actor typeahead for the Add/Edit film forms
+// The form only lists the film's chosen actors; typing a name looks up matching actors
+// with /api/v1/actors?q=... and clicking one adds it to the list (clicking a chosen actor removes it)
+document.addEventListener('DOMContentLoaded', function () {
+    const select = document.getElementById('actor_ids');
+    const search = document.getElementById('actor_search');
+    const results = document.getElementById('actor_results');
+    if (!select || !search || !results) {
+        return;
+    }
+    let timer = null;
+
+    // Wait until typing pauses before asking the server
+    search.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(lookup, 150);
+    });
+
+    // Enter picks the first match instead of submitting the form
+    search.addEventListener('keydown', function (event) {
+        if (event.key === 'Enter') {
+            event.preventDefault();
+            const first = results.querySelector('button');
+            if (first) {
+                first.click();
+            }
+        }
+    });
+
+    select.addEventListener('mousedown', function (event) {
+        if (event.target.tagName === 'OPTION') {
+            event.preventDefault();
+            event.target.remove();
+        }
+    });
+
+    // Every listed actor is sent with the form
+    select.form.addEventListener('submit', function () {
+        for (const option of select.options) {
+            option.selected = true;
+        }
+    });
+
+    function lookup() {
+        const query = search.value.trim();
+        if (!query) {
+            results.replaceChildren();
+            return;
+        }
+        fetch(search.dataset.actorsUrl + '?q=' + encodeURIComponent(query))
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                // Ignore answers for something the user has already typed past
+                if (search.value.trim() !== query) {
+                    return;
+                }
+                results.replaceChildren(...data.actors.map(makeResult));
+            });
+    }
+
+    function makeResult(actor) {
+        const button = document.createElement('button');
+        button.type = 'button';
+        button.className = 'list-group-item list-group-item-action';
+        button.textContent = actor.name;
+        button.addEventListener('click', function () {
+            if (!select.querySelector('option[value="' + actor.id + '"]')) {
+                select.add(new Option(actor.name, actor.id, true, true));
+            }
+            search.value = '';
+            results.replaceChildren();
+            search.focus();
+        });
+        return button;
+    }
+});
@@ -0,0 +1,12 @@
+// Bulk edit page: the checkbox in the table heading ticks (or unticks) every film on the page
+document.addEventListener('DOMContentLoaded', function () {
+    const selectAll = document.getElementById('select_all');
+    if (!selectAll) {
+        return;
+    }
+    selectAll.addEventListener('change', function () {
+        document.querySelectorAll('input[name="film_ids"]').forEach(function (checkbox) {
+            checkbox.checked = selectAll.checked;
+        });
+    });
+});
@@ -0,0 +1,40 @@
+# Shared fixtures
+# =========================================================
+# Every test gets an app using its own copy of db/database.db, so the committed database is never changed
+import os
+import shutil
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# More settings for the app (a test module can override this, eg: to add DATABASE_SHARDS)
+@pytest.fixture
+def app_config():
+    return {}
+
+@pytest.fixture
+def app(tmp_path, app_config):
+    import app as appmod
+    from cache import MemoryCacheBackend
+    appmod.response_cache.backend = MemoryCacheBackend()
+    database = tmp_path / 'database.db'
+    shutil.copy(os.path.join(ROOT, 'db', 'database.db'), database)
+    yield appmod.create_app({'DATABASE': str(database), 'LOGIN_THROTTLE': False, 'TESTING': True,
+                             'WTF_CSRF_ENABLED': False, **app_config})
+    # The similar films updater refreshes in the background, let it finish with this test's database
+    appmod.similar_films_updater.join()
+
+# An app context, for tests that call the db.py functions directly
+@pytest.fixture
+def db(app):
+    with app.app_context():
+        yield
+
+# A test client logged in as user1 (who owns every film in db/database.db)
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 2
+    return client
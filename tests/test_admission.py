@@ -0,0 +1,86 @@
+# Admission control
+# =========================================================
+# Each class of request runs only so many at once, a few more wait their turn for a short while,
+# and anything beyond that is turned away with a 503
+import threading
+import time
+from admission import RouteClassLimit
+import pytest
+
+
+@pytest.fixture
+def app_config():
+    return {'ADMISSION_LIMITS': {'read': (1, 0, 0.05)}}
+
+@pytest.fixture
+def read_limit(app):
+    return app.extensions['admission'].limits['read']
+
+# Call limit.enter() in another thread, returns the thread and a list that gets enter()'s result
+def enter_in_thread(limit):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(limit.enter()))
+    thread.start()
+    return thread, result
+
+def test_waiting_request_times_out():
+    limit = RouteClassLimit(1, 1, 0.05)
+    assert limit.enter()
+    assert not limit.enter()
+    stats = limit.get_stats()
+    assert (stats['admitted'], stats['timed_out'], stats['in_flight'], stats['queued']) == (1, 1, 1, 0)
+
+def test_full_queue_turns_requests_away():
+    limit = RouteClassLimit(1, 1, 5.0)
+    assert limit.enter()
+    thread, result = enter_in_thread(limit)
+    while limit.get_stats()['queued'] < 1:
+        time.sleep(0.001)
+    assert not limit.enter()
+    assert limit.get_stats()['queue_full'] == 1
+    # Leaving hands the turn straight to the request that was waiting
+    limit.leave()
+    thread.join()
+    assert result == [True]
+    stats = limit.get_stats()
+    assert (stats['admitted'], stats['in_flight'], stats['queued']) == (2, 1, 0)
+    limit.leave()
+    assert limit.get_stats()['in_flight'] == 0
+
+def test_busy_pages_get_503(app, read_limit):
+    client = app.test_client()
+    assert read_limit.enter()
+    response = client.get('/about/')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    response = client.get('/api/v1/films/1')
+    assert response.status_code == 503
+    assert 'error' in response.get_json()
+    # Static files are never limited
+    assert client.get('/static/does-not-exist.css').status_code == 404
+    read_limit.leave()
+    assert client.get('/about/').status_code == 200
+    assert read_limit.get_stats()['in_flight'] == 0
+
+# A streamed list gives up its turn once its first chunk is ready, not when the client has read it all
+def test_streamed_response_frees_its_turn_after_the_first_chunk(app, read_limit):
+    client = app.test_client()
+    response = client.get('/api/v1/films', buffered=False)
+    body = iter(response.response)
+    next(body)
+    assert read_limit.get_stats()['in_flight'] == 0
+    assert client.get('/api/v1/films/1').status_code == 200
+    response.close()
+
+@pytest.mark.parametrize('method, path, content_type, route_class', [
+    ('GET', '/films/', '', 'read'),
+    ('POST', '/login/', '', 'auth'),
+    ('POST', '/register/', '', 'auth'),
+    ('POST', '/create/', 'multipart/form-data; boundary=x', 'upload'),
+    ('POST', '/update/1/', 'application/x-www-form-urlencoded', 'write'),
+    ('GET', '/static/css/style.css', '', None),
+    ('GET', '/_debug/stats', '', None),
+])
+def test_requests_are_classified_by_path(app, method, path, content_type, route_class):
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'CONTENT_TYPE': content_type}
+    assert app.extensions['admission'].classify(environ) == route_class
@@ -0,0 +1,69 @@
+# Bulk edits
+# =========================================================
+# bulk_update_films() changes only the user's own films (all or nothing), and only counts the
+# films whose values actually changed
+from db.db import BULK_EDIT_MAX_FILMS, FilmsNotOwned, bulk_update_films, get_db_connection
+import pytest
+
+# user1 owns films 1-4 in db/database.db: 1 and 2 are watched (rated 5 and 4), 3 and 4 aren't (no rating)
+USER_ID = 2
+OTHER_USER_ID = 3
+
+
+def get_films(*columns):
+    return {row['id']: tuple(row[column] for column in columns)
+            for row in get_db_connection().execute(f'SELECT id, {", ".join(columns)} FROM films')}
+
+def test_only_films_that_differ_are_changed(db):
+    before = get_films('updated')
+    assert bulk_update_films(USER_ID, [1, 2, 3], {'watched': True}) == [3]
+    after = get_films('watched', 'updated')
+    assert [after[film_id][0] for film_id in (1, 2, 3, 4)] == [1, 1, 1, 0]
+    # Films that already had the value keep their updated time
+    assert [after[film_id][1] for film_id in (1, 2, 4)] == [before[film_id][0] for film_id in (1, 2, 4)]
+    assert after[3][1] is not None
+
+def test_several_columns_and_clearing_the_rating(db):
+    assert bulk_update_films(USER_ID, ['1', '2', '3'], {'rating': None, 'genre': ' Drama '}) == [1, 2, 3]
+    films = get_films('rating', 'genre')
+    assert [films[film_id] for film_id in (1, 2, 3)] == [(None, 'Drama')] * 3
+    assert bulk_update_films(USER_ID, [1, 2, 3], {'rating': '', 'genre': 'Drama'}) == []
+
+def test_films_of_another_user_change_nothing(db):
+    before = get_films('watched')
+    with pytest.raises(FilmsNotOwned) as error:
+        bulk_update_films(OTHER_USER_ID, [1, 2], {'watched': False})
+    assert error.value.film_ids == [1, 2]
+    # A selection with one film that isn't the user's is refused as a whole
+    with pytest.raises(FilmsNotOwned) as error:
+        bulk_update_films(USER_ID, [1, 3, 999], {'watched': False})
+    assert error.value.film_ids == [999]
+    assert get_films('watched') == before
+
+@pytest.mark.parametrize('film_ids, changes', [
+    ([1], {'title': 'New'}),
+    ([1], {'watched': 'maybe'}),
+    ([1], {'rating': 6}),
+    ([1], {'genre': 5}),
+    (['one'], {'watched': True}),
+    (list(range(BULK_EDIT_MAX_FILMS + 1)), {'watched': True}),
+])
+def test_bad_edits_are_refused(db, film_ids, changes):
+    with pytest.raises(ValueError):
+        bulk_update_films(USER_ID, film_ids, changes)
+
+def test_nothing_to_change(db):
+    assert bulk_update_films(USER_ID, [], {'watched': True}) == []
+    assert bulk_update_films(USER_ID, [1], {}) == []
+
+def test_api_bulk_edit(app, client):
+    assert app.test_client().patch('/api/v1/films', json={'ids': [3], 'set': {'watched': True}}).status_code == 401
+    response = client.patch('/api/v1/films', json={'ids': [3, 4], 'set': {'watched': True, 'rating': 3}})
+    assert response.status_code == 200
+    assert response.get_json() == {'updated': [3, 4]}
+    assert client.patch('/api/v1/films', json={'ids': [3, 4], 'set': {'watched': True, 'rating': 3}}).get_json() == {'updated': []}
+    response = client.patch('/api/v1/films', json={'ids': [3, 999], 'set': {'watched': False}})
+    assert response.status_code == 403
+    assert response.get_json()['ids'] == [999]
+    assert client.patch('/api/v1/films', json={'ids': [3], 'set': {'rating': 9}}).status_code == 400
+    assert client.patch('/api/v1/films', json=[3]).status_code == 400
@@ -0,0 +1,79 @@
+# Change feed
+# =========================================================
+# /api/v1/changes lists what changed after a position, compacted, and answers 410 once that history is pruned
+from db.db import create_film, delete_film, get_db_connection, prune_changes, update_film
+import pytest
+
+USER_ID = 3
+
+
+@pytest.fixture
+def api(app):
+    return app.test_client()
+
+def get_position(api):
+    response = api.get('/api/v1/changes')
+    assert response.status_code == 200
+    assert response.get_json()['changes'] == []
+    return response.get_json()['next_since']
+
+def film_changes(response):
+    return [(change['id'], change['op']) for change in response.get_json()['changes'] if change['entity'] == 'film']
+
+def test_changes_after_a_position_are_compacted(app, api):
+    since = get_position(api)
+    with app.app_context():
+        film_id = create_film(USER_ID, 'New', '', 'Director', None, 2000, 'Drama', False, None, '')
+        update_film(film_id, 'Renamed', '', 'Director', None, 2000, 'Drama', True, 3, '', actor_ids=[])
+        delete_film(1)
+    response = api.get(f'/api/v1/changes?since={since}')
+    assert response.status_code == 200
+    assert response.cache_control.no_store
+    assert film_changes(response) == [(film_id, 'insert'), (1, 'delete')]
+    assert response.get_json()['has_more'] is False
+
+    # Carrying on from next_since finds nothing new
+    next_since = response.get_json()['next_since']
+    assert api.get(f'/api/v1/changes?since={next_since}').get_json()['changes'] == []
+
+def test_limit_pages_through_the_changes(app, api):
+    since = get_position(api)
+    with app.app_context():
+        film_ids = [create_film(USER_ID, f'Film {n}', '', 'Director', None, 2000, 'Drama', False, None, '') for n in range(3)]
+    listed = []
+    while True:
+        data = api.get(f'/api/v1/changes?since={since}&limit=2').get_json()
+        listed.extend(change['id'] for change in data['changes'] if change['entity'] == 'film')
+        since = data['next_since']
+        if not data['has_more']:
+            break
+    assert listed == film_ids
+
+def test_pruned_history_is_gone(app, api):
+    since = get_position(api)
+    with app.app_context():
+        create_film(USER_ID, 'New', '', 'Director', None, 2000, 'Drama', False, None, '')
+        conn = get_db_connection()
+        conn.execute("UPDATE changes SET changed = '2020-01-01 00:00:00'")
+        conn.commit()
+        assert prune_changes(conn, 30) > 0
+    response = api.get(f'/api/v1/changes?since={since}')
+    assert response.status_code == 410
+    # Starting again from the current position works
+    assert api.get(f'/api/v1/changes?since={get_position(api)}').status_code == 200
+
+def test_position_before_any_changes_is_gone_once_pruned(app, api):
+    with app.app_context():
+        create_film(USER_ID, 'New', '', 'Director', None, 2000, 'Drama', False, None, '')
+        conn = get_db_connection()
+        conn.execute("UPDATE changes SET changed = '2020-01-01 00:00:00'")
+        conn.commit()
+        prune_changes(conn, 30)
+    assert api.get('/api/v1/changes?since=0').status_code == 410
+
+@pytest.mark.parametrize('query', ['since=x', 'since=-1', 'since=1.2', 'since=0&limit=0', 'since=0&limit=x'])
+def test_bad_positions_and_limits(api, query):
+    assert api.get(f'/api/v1/changes?{query}').status_code == 400
+
+def test_no_position_is_not_cached(api):
+    assert api.get('/api/v1/changes').cache_control.no_store
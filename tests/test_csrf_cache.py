@@ -0,0 +1,43 @@
+# Cached pages and CSRF tokens
+# =========================================================
+# A cached page must never carry a CSRF token the visitor's session doesn't have
+# (run with: python -m pytest tests)
+import os
+import re
+import shutil
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def client(tmp_path):
+    import app as appmod
+    from cache import MemoryCacheBackend
+    appmod.response_cache.backend = MemoryCacheBackend()
+    database = tmp_path / 'database.db'
+    shutil.copy(os.path.join(ROOT, 'db', 'database.db'), database)
+    app = appmod.create_app({'DATABASE': str(database), 'LOGIN_THROTTLE': False, 'TESTING': True})
+    return app.test_client()
+
+def get_csrf_token(response):
+    return re.search(r'name="csrf_token" value="([^"]+)"', response.get_data(as_text=True)).group(1)
+
+def log_in(client, username, password):
+    token = get_csrf_token(client.get('/login/'))
+    response = client.post('/login/', data={'username': username, 'password': password, 'csrf_token': token})
+    assert response.status_code == 302
+
+# Logging in clears the session, so the first page with a form after it generates a new token:
+# that page must not be cached and shown to the user's next session
+def test_cached_page_token_matches_session_after_logging_in_again(client):
+    for _ in range(2):
+        log_in(client, 'user1', 'password')
+        client.get('/about/')
+        token = get_csrf_token(client.get('/film/1/'))
+        client.get('/logout/')
+    log_in(client, 'user1', 'password')
+    client.get('/about/')
+    token = get_csrf_token(client.get('/film/1/'))
+    response = client.post('/delete/1', data={'csrf_token': token})
+    assert response.status_code == 302
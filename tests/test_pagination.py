@@ -0,0 +1,60 @@
+# Cursor pagination
+# =========================================================
+# Walking a film list page by page (forwards and backwards) must list every film once, in order
+from db.db import create_film, get_all_films, get_films_page, parse_film_cursor
+import pytest
+
+# razzle has no films in db/database.db
+USER_ID = 3
+# Titles with commas (the cursor's separator) and several films with the same title (ordered by ID)
+TITLES = ['Alpha', 'Alpha', 'Alpha', 'Beta, Gamma', 'Beta', 'Delta, 2', 'Epsilon', 'Zeta', 'Eta']
+
+
+@pytest.fixture
+def films(db):
+    for title in TITLES:
+        create_film(USER_ID, title, '', 'Director', None, 2000, 'Drama', False, None, '')
+    return get_all_films(USER_ID)
+
+def walk_forwards(page_size, order_by='title ASC'):
+    pages = []
+    after = None
+    while True:
+        page, next_cursor, prev_cursor = get_films_page(USER_ID, page_size, order_by, after=after)
+        pages.append((page, next_cursor, prev_cursor))
+        if next_cursor is None:
+            return pages
+        after = next_cursor
+
+@pytest.mark.parametrize('page_size', [1, 2, 3, 4, 9, 10])
+@pytest.mark.parametrize('order_by', ['title ASC', 'title DESC', 'created DESC'])
+def test_walking_forwards_lists_every_film_once(films, page_size, order_by):
+    pages = walk_forwards(page_size, order_by)
+    listed = [film['id'] for page, _, _ in pages for film in page]
+    assert listed == [film['id'] for film in get_all_films(USER_ID, order_by=order_by)]
+    assert all(len(page) == page_size for page, _, _ in pages[:-1])
+
+# 9 films in pages of 3: the last page is full, and must not offer a next (empty) page
+def test_first_and_last_pages_have_no_cursor_beyond_them(films):
+    pages = walk_forwards(3)
+    assert len(pages) == 3
+    assert pages[0][2] is None
+    assert pages[-1][1] is None
+    assert all(prev_cursor is not None for _, _, prev_cursor in pages[1:])
+
+def test_walking_backwards_gives_the_same_pages(films):
+    pages = walk_forwards(4)
+    before = pages[-1][2]
+    for page, _, _ in reversed(pages[:-1]):
+        previous, next_cursor, before = get_films_page(USER_ID, 4, before=before)
+        assert [film['id'] for film in previous] == [film['id'] for film in page]
+        assert next_cursor is not None
+    assert before is None
+
+def test_cursor_keeps_commas_in_titles():
+    assert parse_film_cursor('Beta, Gamma,12') == ('Beta, Gamma', 12)
+    with pytest.raises(ValueError):
+        parse_film_cursor('no id')
+
+def test_malformed_cursor_is_a_bad_request(client):
+    assert client.get('/films/?after=Alpha,x').status_code == 400
@@ -0,0 +1,59 @@
+# Film search
+# =========================================================
+# Results are ranked (title matches first), highlighted, paged and kept in step with the films
+from db.db import SEARCH_MARK_END, SEARCH_MARK_START, create_film, delete_film, search_films, update_film
+import pytest
+
+USER_ID = 3
+
+
+@pytest.fixture
+def films(db):
+    return {
+        'review': create_film(USER_ID, 'Deep Space', '', 'Director', None, 2000, 'Drama', False, None, 'A nebula at the end'),
+        'title': create_film(USER_ID, 'Nebula', '', 'Director', None, 2001, 'Drama', False, None, ''),
+        'tagline': create_film(USER_ID, 'Far Away', 'Lost in a nebula', 'Director', None, 2002, 'Drama', False, None, ''),
+    }
+
+def test_title_matches_rank_first(films):
+    results, next_cursor = search_films('nebula')
+    assert [result['id'] for result in results] == [films['title'], films['tagline'], films['review']]
+    assert next_cursor is None
+
+def test_last_word_matches_as_a_prefix(films):
+    assert [result['id'] for result in search_films('nebu')[0]][0] == films['title']
+    assert search_films('deep spa')[0][0]['id'] == films['review']
+
+def test_matches_are_marked(films):
+    result = search_films('nebula')[0][0]
+    assert result['title_marked'] == f'{SEARCH_MARK_START}Nebula{SEARCH_MARK_END}'
+    review = next(result for result in search_films('nebula')[0] if result['id'] == films['review'])
+    assert f'{SEARCH_MARK_START}nebula{SEARCH_MARK_END}' in review['snippet']
+
+def test_nothing_to_search_for(films):
+    assert search_films(' ?! ') == ([], None)
+
+def test_paging_lists_every_result_once(films):
+    found = []
+    cursor = None
+    while True:
+        results, cursor = search_films('nebula', limit=1, cursor=cursor)
+        found.extend(result['id'] for result in results)
+        if cursor is None:
+            break
+    assert found == [result['id'] for result in search_films('nebula')[0]]
+
+def test_index_follows_updates_and_deletes(films):
+    update_film(films['title'], 'Comet', '', 'Director', None, 2001, 'Drama', False, None, '', actor_ids=[])
+    assert films['title'] not in [result['id'] for result in search_films('nebula')[0]]
+    assert search_films('comet')[0][0]['id'] == films['title']
+    delete_film(films['tagline'])
+    assert [result['id'] for result in search_films('nebula')[0]] == [films['review']]
+
+# The page escapes the film's text and only adds the <mark> tags itself
+def test_search_page_marks_matches(app):
+    with app.app_context():
+        create_film(USER_ID, '<b>Nebula</b>', '', 'Director', None, 2001, 'Drama', False, None, '')
+    page = app.test_client().get('/search?q=nebula').get_data(as_text=True)
+    assert '&lt;b&gt;<mark>Nebula</mark>&lt;/b&gt;' in page
+    assert '<b>Nebula</b>' not in page
@@ -0,0 +1,82 @@
+# Moving users between shards
+# =========================================================
+# A move copies the user's films to the new shard and removes them from the old one, and a move
+# that was interrupted part way through is finished without losing or duplicating films
+from db.db import forget_shard_lookups, get_all_films, get_db_connection, get_film_by_id, get_user_shard, transaction
+from db.shards import finish_moves, move_user
+import pytest
+
+# user1 owns every film in db/database.db
+USER_ID = 2
+
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {'DATABASE_SHARDS': [str(tmp_path / 'database.db'), str(tmp_path / 'shard1.db')]}
+
+def user_film_ids(shard):
+    return sorted(row['id'] for row in get_db_connection(shard).execute('SELECT id FROM films WHERE user = ?', (USER_ID,)))
+
+def unfinished_moves():
+    return get_db_connection().execute('SELECT count(*) FROM shard_moves').fetchone()[0]
+
+# Copy some of the user's films to a shard, as an interrupted move would have left them
+def copy_films(source, target, count=None):
+    films = get_db_connection(source).execute('SELECT * FROM films WHERE user = ?', (USER_ID,)).fetchall()[:count]
+    columns = films[0].keys()
+    with transaction(target) as conn:
+        conn.executemany(f'INSERT INTO films ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                         [tuple(film) for film in films])
+
+def test_move_user(app, db):
+    import app as appmod
+    film_ids = user_film_ids(0)
+    version = appmod.response_cache.get_version(f'user:{USER_ID}')
+    assert move_user(USER_ID, 1) == len(film_ids)
+    assert get_user_shard(USER_ID, cached=False) == 1
+    assert user_film_ids(0) == []
+    assert user_film_ids(1) == film_ids
+    assert get_film_by_id(film_ids[0], include_actors=False)['id'] == film_ids[0]
+    assert unfinished_moves() == 0
+    # Cached pages of the user's films are out of date
+    assert appmod.response_cache.get_version(f'user:{USER_ID}') != version
+
+def test_move_to_the_same_shard_does_nothing(db):
+    assert move_user(USER_ID, 0) == 0
+    assert unfinished_moves() == 0
+
+# The old shard's change feed tells clients to fetch the films again, not to delete them
+def test_old_shard_lists_moved_films_as_updated(db):
+    film_ids = user_film_ids(0)
+    move_user(USER_ID, 1)
+    ops = dict(get_db_connection(0).execute(
+        "SELECT entity_id, op FROM changes WHERE entity = 'film' AND entity_id IN (SELECT value FROM json_each(?))",
+        (str(film_ids),)).fetchall())
+    assert set(ops.values()) == {'update'}
+
+def test_move_interrupted_while_copying_is_finished(db):
+    film_ids = user_film_ids(0)
+    with transaction() as conn:
+        conn.execute('INSERT INTO shard_moves (user_id, source, target) VALUES (?, 0, 1)', (USER_ID,))
+    copy_films(0, 1, count=2)
+    assert len(get_all_films()) == len(film_ids) + 2
+
+    assert move_user(USER_ID, 1) == len(film_ids)
+    assert user_film_ids(0) == []
+    assert user_film_ids(1) == film_ids
+    assert len(get_all_films()) == len(film_ids)
+    assert unfinished_moves() == 0
+
+def test_move_interrupted_after_switching_shards_is_finished(db):
+    film_ids = user_film_ids(0)
+    with transaction() as conn:
+        conn.execute('INSERT INTO shard_moves (user_id, source, target) VALUES (?, 0, 1)', (USER_ID,))
+        conn.execute('INSERT INTO user_shards (user_id, shard) VALUES (?, 1)', (USER_ID,))
+    copy_films(0, 1)
+    forget_shard_lookups()
+
+    assert finish_moves() == [(USER_ID, len(film_ids))]
+    assert user_film_ids(0) == []
+    assert user_film_ids(1) == film_ids
+    assert unfinished_moves() == 0
+    assert finish_moves() == []
@@ -0,0 +1,11 @@
+# Production entry point for pre-fork WSGI servers, eg: gunicorn -c gunicorn.conf.py wsgi:app
+# The app is built and warmed up once, in the server's master process, before the workers are forked
+# (see preload.py). Settings come from FLASK_<NAME> environment variables, eg: FLASK_DATABASE=/srv/films.db
+import time
+started = time.perf_counter()
+
+from app import create_app
+from preload import warm_up
+
+app = create_app()
+warm_up(app, started)